@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import fcntl
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, astuple, fields
+
+
+LOGGER = logging.getLogger('audit_writer')
+
+AUDIT_TABLE = 'automation_audit'
+
+AUDIT_TABLE_DDL = (f"CREATE TABLE IF NOT EXISTS {AUDIT_TABLE} ("
+                   "id BIGINT AUTO_INCREMENT PRIMARY KEY, recorded_at DOUBLE, kind VARCHAR(16), "
+                   "host_name VARCHAR(64), action VARCHAR(64), result VARCHAR(32), duration DOUBLE, verified TINYINT, "
+                   "detail TEXT)")
+
+_STOP = object()
+
+
+@dataclass
+class AuditRecord:
+    """
+        Dataclass to handle one audited outcome: heal attempt (kind 'heal') (or) deployment action (kind 'deploy')
+    """
+    recorded_at: float
+    kind: str
+    host_name: str
+    action: str
+    result: str
+    duration: float = None
+    verified: bool = None
+    detail: str = ''
+
+
+AUDIT_COLUMNS = tuple(field.name for field in fields(AuditRecord))
+
+
+@dataclass
+class AuditStats:
+    """
+        Dataclass to handle accounting of AuditWriter
+    """
+    queued: int = 0
+    written: int = 0
+    batches: int = 0
+    spilled: int = 0
+    replayed: int = 0
+    dropped: int = 0
+    failures: int = 0
+    corrupt: int = 0
+
+    def report(self):
+        return (f"queued={self.queued} written={self.written} batches={self.batches} spilled={self.spilled} "
+                f"replayed={self.replayed} dropped={self.dropped} failures={self.failures} corrupt={self.corrupt}")
+
+
+class AuditWriter:
+    """
+        Records heal and deploy outcomes into MySQL audit table without putting a database round trip on the hot path
+
+        record() only puts on a bounded queue. Background thread writes batches with one executemany + commit over a
+        connection taken from pool (connect() e.g. MySQLConnectionPool.get_connection), batch flushed once batch_size
+        records are queued (or) flush_interval seconds passed since its first one
+
+        MySQL unavailable (or) slower than slow_flush seconds per batch: batches are appended to local spill file
+        (JSON lines) and database is retried after retry_interval seconds, once it takes writes again the spill file is
+        written back first. Records are dropped (accounted) only when queue is full (or) spill file not writable.
+        Spilled lines not decodable (torn by crash mid-write) are moved aside to `<spill_path>.corrupt`
+
+        Several processes may share the spill file: appends and the hand-over to replay are serialized by flock on
+        `<spill_path>.lock`, only one process at a time writes the spill back (`<spill_path>.replay.lock`)
+
+        Usage:
+            AUDIT = AuditWriter(Database.connection_pool(ip, username, password).get_connection, 'audit.spill')
+            AUDIT.start()
+            AUDIT.record('heal', 'R1', 'bgp_down_duplicate_address', 'success', duration=1.4, verified=True)
+            AUDIT.close()
+    """
+    def __init__(self, connect, spill_path, batch_size=500, flush_interval=1.0, queue_size=100000, slow_flush=5.0,
+                 retry_interval=30, placeholder='%s', create_table=True):
+        self.connect = connect
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.slow_flush = slow_flush
+        self.retry_interval = retry_interval
+        self.create_table = create_table
+        self.stats = AuditStats()
+
+        self.insert = (f"INSERT INTO {AUDIT_TABLE} ({', '.join(AUDIT_COLUMNS)}) "
+                       f"VALUES ({', '.join([placeholder] * len(AUDIT_COLUMNS))})")
+        self.queue = queue.Queue(queue_size)
+        self.unavailable_until = 0.0
+        self.thread = threading.Thread(target=self._run, name='AuditWriter', daemon=True)
+
+    def start(self):
+        if self.create_table:
+            try:
+                self._execute(lambda cursr: cursr.execute(AUDIT_TABLE_DDL))
+            except Exception as err:
+                LOGGER.error(f"audit table {AUDIT_TABLE} not created, spilling till database is available : {err}")
+                self.unavailable_until = time.monotonic() + self.retry_interval
+        self.thread.start()
+
+    def record(self, kind, host_name, action, result, duration=None, verified=None, detail=''):
+        """
+            Thread safe, non-blocking. Queue one outcome for audit
+        """
+        try:
+            self.queue.put_nowait(AuditRecord(time.time(), kind, host_name, action, result, duration, verified,
+                                              detail))
+            self.stats.queued += 1
+        except queue.Full:
+            self.stats.dropped += 1
+
+    def close(self):
+        """
+            Write out queued records (to database, else spill file)
+        """
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def _execute(self, operation):
+        conn = self.connect()
+        try:
+            cursr = conn.cursor()
+            try:
+                operation(cursr)
+            finally:
+                cursr.close()
+            conn.commit()
+        finally:
+            # pooled connection goes back to pool
+            conn.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(astuple(item))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch:
+                try:
+                    self._flush(batch)
+                except Exception:
+                    # writer thread must outlive any one batch
+                    self.stats.failures += 1
+                    LOGGER.exception(f"audit flush of {len(batch)} records failed")
+
+    def _flush(self, rows):
+        if time.monotonic() >= self.unavailable_until and self._write(rows):
+            try:
+                self._replay_spill()
+            except OSError as err:
+                LOGGER.error(f"audit spill {self.spill_path} not written back, retrying with next batch : {err}")
+            return
+        self._spill(rows)
+
+    def _write(self, rows):
+        start = time.monotonic()
+        try:
+            self._execute(lambda cursr: cursr.executemany(self.insert, rows))
+        except Exception as err:
+            self.stats.failures += 1
+            self.unavailable_until = time.monotonic() + self.retry_interval
+            LOGGER.error(f"audit write of {len(rows)} records failed, spilling for {self.retry_interval}s : {err}")
+            return False
+
+        self.stats.written += len(rows)
+        self.stats.batches += 1
+
+        elapsed = time.monotonic() - start
+        if elapsed > self.slow_flush:
+            # written, but database too slow for the pace of records.. spill for a while to not fall behind
+            self.unavailable_until = time.monotonic() + self.retry_interval
+            LOGGER.error(f"audit write took {elapsed:.1f}s, spilling for {self.retry_interval}s")
+        return True
+
+    def _spill(self, rows):
+        try:
+            with self._locked(f'{self.spill_path}.lock'), open(self.spill_path, 'a') as file:
+                file.writelines(json.dumps(row) + '\n' for row in rows)
+            self.stats.spilled += len(rows)
+        except OSError as err:
+            self.stats.dropped += len(rows)
+            LOGGER.error(f"audit spill to {self.spill_path} failed, {len(rows)} records lost : {err}")
+
+    def _replay_spill(self):
+        """
+            Write back spilled records once database takes writes again, what is left stays for next time
+        """
+        with self._locked(f'{self.spill_path}.replay.lock', blocking=False) as locked:
+            # spill file may be shared by several processes (scripts, workers), one of them writes it back at a time
+            if locked:
+                self._replay_locked()
+
+    def _replay_locked(self):
+        # renamed first so that records spilled meanwhile (if write back fails) go to new file, under the append lock
+        # so that no record is appended to the file once it is being replayed
+        replaying = f'{self.spill_path}.replay'
+        while True:
+            if not os.path.exists(replaying):
+                with self._locked(f'{self.spill_path}.lock'):
+                    if not os.path.exists(self.spill_path):
+                        return
+                    os.replace(self.spill_path, replaying)
+
+            rows, corrupt = [], []
+            with open(replaying) as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                        if not isinstance(row, list) or len(row) != len(AUDIT_COLUMNS):
+                            raise ValueError(f"not an audit row of {len(AUDIT_COLUMNS)} columns")
+                        rows.append(tuple(row))
+                    except ValueError:
+                        corrupt.append(line if line.endswith('\n') else line + '\n')
+            if corrupt:
+                self._quarantine(corrupt)
+                # written back without them so that they are quarantined only once
+                self._rewrite(replaying, rows)
+
+            for start in range(0, len(rows), self.batch_size):
+                if not self._write(rows[start:start + self.batch_size]):
+                    # written part is dropped from replay file so that it is not written twice
+                    self._rewrite(replaying, rows[start:])
+                    return
+                self.stats.replayed += len(rows[start:start + self.batch_size])
+
+            os.unlink(replaying)
+            LOGGER.info(f"audit spill of {len(rows)} records written back to database")
+
+    def _quarantine(self, lines):
+        corrupt_path = f'{self.spill_path}.corrupt'
+        with open(corrupt_path, 'a') as file:
+            file.writelines(lines)
+        self.stats.corrupt += len(lines)
+        LOGGER.error(f"{len(lines)} undecodable audit spill lines moved to {corrupt_path}")
+
+    @staticmethod
+    @contextmanager
+    def _locked(path, blocking=True):
+        # exclusive advisory lock on lock file next to the spill file, yields False when not blocking and held
+        with open(path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _rewrite(path, rows):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.writelines(json.dumps(row) + '\n' for row in rows)
+        os.replace(temp_path, path)
@@ -1,159 +1,252 @@
 import time
 import sys
 import os
+import signal
+import logging
+
+from ncclient.transport import TransportError
 
 from utils_library import *
+from event_engine import EventEngine
+from rule_engine import RuleEngine, RuleContext, RemediationGuard
+from notification_journal import JournalWriter
+from fleet_health import FleetHealth
+from audit_writer import AuditWriter
+from instrumentation import METRICS, TRACE, PipelineTrace, MetricsServer, start_queue_logging
+
+
+LOGGER = logging.getLogger('auto_healing')
+
+
+# Remediation rules declared in YAML, hot reloaded on change (or) SIGHUP
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Rules', 'healing_rules.yaml')
+
+# Storm protection of remediation: identical events within 1s handled once, per device at most 3 heals at once then
+# one every 5s, (device, rule, interface/peer) failing 3 times in a row not retried for 5 minutes
+DEDUP_WINDOW = 1.0
+REMEDIATION_RATE = 0.2
+REMEDIATION_BURST = 3
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 300
+
+# Recent Events kept for correlation at least this long, longer if any rule correlates over bigger window
+EVENT_STORE_TTL = 300
+
+# Every received notification journaled here so that storms can be replayed (notification_journal.replay)
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Journal')
 
+# Heal outcomes audited into MySQL in background, spilled here while database is unavailable
+AUDIT_SPILL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audit_spill.jsonl')
 
-class EventTrigger(threading.Thread):
+# Prometheus scrape endpoint (/metrics) and pipeline trace dump (/trace), local only
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+
+class EventTrigger:
     """
         This handles every NETCONF notifications as individual Event so that sooner the Event happens, required
         processing can be triggered using Event-Driven Programming (Call-back style)
 
-        Each of NETCONF notification event handled as separate Thread so that improves Reliability of not missing
-        any of NETCONF notifications
+        Notifications of every monitored device are handed to one shared EventEngine which multiplexes them in a single
+        asyncio event loop into bounded work queue, fixed pool of workers runs auto-healing so that during Network
+        Chaos lot of NETCONF notification events can't create unbounded threads on Central host. Overflow of the queue
+        is accounted (or) pushed back to device as per the engine overflow policy
+
+        EventStore (time-windowed correlation store, shared by all monitored devices) used to analyze recent Past
+        Events in-case of needing Multi-Criteria verifications
+
+        DevicePool (optional) hands leased warm sessions to auto-healing so that remediation RPCs don't share the
+        session blocked on notifications and don't pay for new connection either. Required with engine overflow
+        'block': reader of monitored session waits in submit() then, reply of remediation RPC on it is never read
+
+        SsotCache (optional) gives auto-healing the latest IPAM record of device from memory for every event
+
+        Subscription filter (optional) e.g. clog_subscription_filter(RULES.interest()) makes router send only the
+        events we act on. Rules reloaded later change dispatch right away but not the filter fixed at subscribe time
+
+        BgpStateCache (optional) fed by BGP telemetry lets auto-healing wait event-driven for peer to get established
+
+        Every notification is traced through the pipeline stages (PipelineTrace) into METRICS histograms and TRACE
 
-        Semaphore used to limit maximum threads at a time so that during Network Chaos, possibility of lof of
-        NETCONF notification events triggered on which Central host CPU's not taking hit. ( Default set to 10 )
+        RuleEngine (optional, default RULES) holds the remediation rules notifications are dispatched to
 
-        Thread Safe dictionary object used for common access across NETCONF notification events which required to
-        analyze Past Events in-case of needing Multi-Criteria verifications
+        AuditWriter (optional) records every heal outcome off the hot path
     """
-    def __init__(self, device, device_dc, stream, max_threads=10):
-        super().__init__()
+    def __init__(self, device, device_dc, stream, engine, pool=None, ssot=None, nc_filter=None, event_store=None,
+                 bgp_cache=None, rules=None, audit=None):
+        if engine.overflow == 'block' and pool is None:
+            raise ValueError("engine overflow 'block' needs DevicePool for remediation, monitored session would "
+                             "deadlock")
+
         self.device = device
         self.device_dc = device_dc
-        self.stop_event = threading.Event()
-        self.semaphore = threading.Semaphore(max_threads)
         self.stream = stream
+        self.nc_filter = nc_filter
+        self.engine = engine
+        self.pool = pool
+        self.ssot = ssot
+        self.listener = None
 
-        self.thread_safe_dict = ThreadSafeDict()
-
-        # Subscribe for NETCONF notifications for Events
-        self.device.nc_con.create_subscription(stream_name=self.stream)
+        self.event_store = event_store if event_store is not None else EventStore()
+        self.bgp_cache = bgp_cache
+        self.rules = rules
+        self.audit = audit
 
-    def run(self):
-        # continuously in loop monitor for new NETCONF notifications till thread stopped
-        while not self.stop_event.is_set():
-            nc_rpc_reply = self.device.nc_con.take_notification()
+    def __str__(self):
+        return f"{self.device_dc.host_name}/{self.stream}"
 
-            # Trigger the callback in a separate thread with semaphore
-            run_callback_in_thread(self.device, self.device_dc, nc_rpc_reply, self.thread_safe_dict, self.semaphore)
+    def start(self):
+        # Route notifications to the engine first, then subscribe for NETCONF notifications for Events
+        self.listener = self.engine.attach(self.device.nc_con._session, self)
+        self.device.nc_con.create_subscription(stream_name=self.stream, filter=self.nc_filter)
 
     def stop(self):
-        self.stop_event.set()
+        if self.listener is not None:
+            self.engine.detach(self.device.nc_con._session, self.listener)
+            self.listener = None
+
+    def handle(self, nc_rpc_reply):
+        """
+            Called by engine worker for every notification of this device
+        """
+        trace = PipelineTrace(self.device_dc.host_name, getattr(nc_rpc_reply, 'received', None))
+        trace.mark('queued')
+
+        device_dc = (self.ssot.get(self.device_dc.host_name) if self.ssot else None) or self.device_dc
+        interfaces = self.ssot.interfaces() if self.ssot else None
+        auto_healing(self.device, device_dc, nc_rpc_reply, self.event_store, self.pool, self.bgp_cache, trace,
+                     self.rules, interfaces, self.audit)
+
+
+def handle_notification(event_trigger, nc_rpc_reply):
+    """
+        EventEngine handler, dispatch notification to EventTrigger of the device it was received from
+    """
+    event_trigger.handle(nc_rpc_reply)
+
+
+def configure_interface_ip(context, fields, interface, duplicate=None):
+    """
+        Action: restore intended IP/mask of interface from Single Source-of-Truth, not in-case SSOT says the duplicate
+        address (if given) belongs to this very interface i.e. the other side is the one to fix (None, not applicable)
+    """
+    device_dc = context.device_dc
+    LOGGER.info(f"--- --- --- --- AUTO_HEALING in-progress {device_dc.host_name}... --- --- --- ---")
+
+    interfaces = context.interfaces if context.interfaces is not None else InterfaceTable.from_records([device_dc])
+    intended = interfaces.intended(device_dc.host_name, interface)
+    if intended is None:
+        LOGGER.error(f"no intended IP for {interface} in Single Source-of-Truth, can't auto-heal")
+        return False
+
+    if duplicate is not None:
+        owner = interfaces.owner(duplicate)
+        if owner == (device_dc.host_name, interface):
+            LOGGER.error(f"duplicate address {duplicate} is intended on {device_dc.host_name} {interface}, other "
+                         f"device to be fixed")
+            return None
+        LOGGER.info(f"duplicate address {duplicate} owned by {' '.join(owner) if owner else 'nobody'} per SSOT")
+
+    ip_format, mask_format = intended
+
+    try:
+        # lease warm session from pool for remediation RPCs, else use the monitored session
+        heal_device = context.heal_device()
+        context.mark('rpc_sent')
+        healed = heal_device.edit_config_interface(interface=interface, ip_address=ip_format, mask=mask_format,
+                                                   refresh=True)
+    except (RPCError, TimeoutError, TransportError) as err:
+        # rpc-error, no session leased (or) no turn on it in time (RpcDeadlineExceeded), session lost
+        LOGGER.error(f"remediation RPC on {device_dc.host_name} failed : {err!r}")
+        healed = False
+    context.mark('rpc_acked')
+    if not healed:
+        METRICS.inc('healing_rpc_errors_total', device=device_dc.host_name)
+
+    return healed
+
+
+def invalidate_snapshots(context, fields):
+    """
+        Action: drop cached running config snapshots of the device, housekeeping only hence nothing reported
+    """
+    context.device.snapshots.invalidate(context.device.ip)
+    return None
 
 
-# Function to run the callback in a separate thread
-def run_callback_in_thread(device, device_dc, nc_rpc_reply, thread_safe_dict, semaphore):
+def bgp_established(context, fields, peer, timeout=20):
     """
-        this helps each of callback to process NETCONF notification event as separate Thread
+        Check: BGP peer established again, event-driven on BGP telemetry else polling the peer..
     """
+    return wait_bgp_established(context.heal_device(), peer, context.bgp_cache, timeout=float(timeout),
+                                since=context.acted_at)
+
+
+# Actions and checks healing rules can name
+ACTIONS = {
+    'configure_interface_ip': configure_interface_ip,
+    'invalidate_snapshots': invalidate_snapshots,
+}
+
+CHECKS = {
+    'bgp_established': bgp_established,
+}
+
+GUARD = RemediationGuard(dedup_window=DEDUP_WINDOW, rate=REMEDIATION_RATE, burst=REMEDIATION_BURST,
+                         failure_threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN)
 
-    callback_thread = threading.Thread(target=auto_healing, args=(device, device_dc, nc_rpc_reply,
-                                                                  thread_safe_dict, semaphore))
-    callback_thread.start()
+RULES = RuleEngine(RULES_FILE, ACTIONS, CHECKS, guard=GUARD)
 
 
-# Define the callback function to be run in a separate thread
-def auto_healing(device, device_dc, nc_rpc_reply, thread_safe_dict, semaphore):
+def register_guard_metrics(guard):
+    """
+        Counters of events/remediations the guard held back, read at scrape time
+    """
+    for reason in ('deduplicated', 'coalesced', 'rate_limited', 'circuit_open', 'circuits_opened'):
+        METRICS.register_callback(f'healing_{reason}_total', 'counter', lambda reason=reason: guard.stats[reason],
+                                  f"Remediation guard: {reason.replace('_', ' ')}")
+
+
+def auto_healing(device, device_dc, nc_rpc_reply, event_store, pool=None, bgp_cache=None, trace=None, rules=None,
+                 interfaces=None, audit=None):
     """
         This is core function handling auto-healing as below,
             1)  Detect the issue by processing current NETCONF notification event and as required also previous one
-            2)  Auto-heal by applying the fix if known defined scenarios
-
-        Note:  This is expandable to include more Scenarios under same category(bgp) or across new categories ospf etc
-    """
-
-    with (semaphore):
-        nc_rpc_reply_xml = nc_rpc_reply.notification_xml
-
-        # Parse the XML data using xmltodict- this will create an OrderedDict object
-        nc_reply_dict = xmltodict.parse(nc_rpc_reply_xml)
-
-        try:
-            event_type = nc_reply_dict['notification']['clogMessageGenerated']['object-1']['clogHistFacility']
-            event_info = nc_reply_dict['notification']['clogMessageGenerated']['object-4']['clogHistMsgText']
-            message = (
-                f"{threading.current_thread().name} / #{threading.active_count()} : "
-                f"    NETCONF_NOTIFICATION : {event_type:^18} -- {event_info:<20}"
-            )
-            print(message)
-
-            # This dict data-structure helps populate NETCONF interested notifications to process Multi Criteria..
-            # Make sure efficient lookup dict O(1) by keeping relevant info as dict KEY
-            if event_type == 'IP':
-                event_type = nc_reply_dict['notification']['clogMessageGenerated']['object-3']['clogHistMsgName']
-
-            thread_safe_dict.set_item(event_type, event_info)
-
-            # process current event and also as required check relevant Multiple Criteria to execute Auto-healing
-            if event_type == 'BGP':
-                match event_info:
-                    case _ if mg_1 := re.match(r'neighbor ([0-9.]+) Down', event_info):
-                        message = (
-                            f"{threading.current_thread().name} / #{threading.active_count()} : "
-                            f"    LOG : <processing> netconf_notification : BGP neighbor down"
-                        )
-                        print(message)
-
-                        # check if any already Duplicate IP notification from NETCONF
-                        if thread_safe_dict.contains_item('DUPADDR'):
-                            message = (
-                                f"{threading.current_thread().name} / #{threading.active_count()} : "
-                                f"    LOG : --- --- --- --- AUTO_HEALING in-progress... --- --- --- ---"
-                            )
-                            print(message)
-
-                            mg_2 = re.match(r'Duplicate address ([0-9.]+) on (.*), sourced by ',
-                                            thread_safe_dict.get_item('DUPADDR'))
-
-                            if mg_1.groups()[0] == mg_2.groups()[0]:
-                                ip_format = eval(f'device_dc.{mg_2.groups()[1]}_ip')
-                                mask_format = eval(f'device_dc.{mg_2.groups()[1]}_mask')
-
-                                if device.edit_config_interface(interface=mg_2.groups()[1],
-                                                         ip_address=ip_format,
-                                                         mask=mask_format):
-                                    loop_ctrl = 0
-                                else:
-                                    loop_ctrl = 20
-
-                            # Verify Auto-healing actually fixed it..
-                            while loop_ctrl < 20:
-                                if device.verify_bgp_mib():
-                                    message = (
-                                        f"{threading.current_thread().name} / #{threading.active_count()} : "
-                                        f"    LOG : --- --- --- --- AUTO_HEALING attempt success --- --- --- ---"
-                                    )
-                                    print(message)
-                                    break
-
-                                loop_ctrl += 1
-                                time.sleep(1)
-
-                            if loop_ctrl == 20:
-                                message = (
-                                    f"{threading.current_thread().name} / #{threading.active_count()} : "
-                                    f"    ERROR : --- --- --- --- AUTO_HEALING attempt failed --- --- --- ---"
-                                )
-                                print(message)
-
-                    # here, can expand Auto Healing to cover for more BGP cases
-                    case 'add more':
-                        print('more')
-
-            # here, can expand Auto Healing to cover for more protocols etc..
-            # importantly, if we handle directly event 'DUPADDR' we can reduce down-time a lot because BGP takes
-            # approx 180 seconds by default to detect fault without special configs like BFD enabled so blackhole trafic
-            if event_type == 'DUPADDR':
-                match event_info:
-                    case 'xxx xx':
-                        print('do')
-
-        except KeyError:
-            # Multi level Nested dictionary from XML and safe to skip not-interested Events
-            pass
+            2)  Auto-heal by applying the fix of the healing rules (Rules/healing_rules.yaml) the event triggers
+
+        Stages are marked on trace: parsed, correlated, rpc_sent, rpc_acked, verified
+
+        Note:  This is expandable by adding rules to the YAML file, new kind of remediation registered in ACTIONS/CHECKS
+    """
+    if trace is None:
+        trace = PipelineTrace(device_dc.host_name)
+    rules = rules or RULES
+
+    # Fast extraction of interested fields only, Events no rule is triggered by rejected before building anything
+    event = parse_clog_notification(nc_rpc_reply.notification_xml, rules.interest())
+    if event is None:
+        return
+
+    event_type, event_name, event_info = event
+    trace.mark('parsed')
+    METRICS.inc('healing_events_total', device=device_dc.host_name, event=event_name)
+    LOGGER.info(f"NETCONF_NOTIFICATION : {device_dc.host_name} {event_type:^18} -- {event_info:<20}")
+
+    context = RuleContext(device, device_dc, event_store, pool, bgp_cache, trace, interfaces)
+    for rule_name, outcome in rules.dispatch(event_type, event_name, event_info, context):
+        METRICS.inc('healing_attempts_total', device=device_dc.host_name, rule=rule_name, result=outcome)
+        if audit is not None:
+            audit.record('heal', device_dc.host_name, rule_name, outcome, duration=time.monotonic() - trace.started,
+                         verified=outcome == 'success' if outcome in ('success', 'failed') else None,
+                         detail=event_info)
+        if outcome == 'success':
+            LOGGER.info(f"--- --- --- --- AUTO_HEALING {rule_name} success {device_dc.host_name} --- --- --- ---")
+        elif outcome == 'failed':
+            LOGGER.error(f"--- --- --- --- AUTO_HEALING {rule_name} failed {device_dc.host_name} --- --- --- ---")
+        else:
+            # storm protection, heal already in flight (or) device remediations limited for now
+            LOGGER.info(f"AUTO_HEALING {rule_name} on {device_dc.host_name} not started : {outcome}")
 
 
 # Main function to set up the event trigger
@@ -169,41 +262,114 @@ def main():
         print(f"usage: {os.path.basename(__file__)} <database_username> <database_password>")
         sys.exit(1)
 
+    # Logging through queue so that event workers never wait on terminal output, metrics served over HTTP
+    LOG_LISTENER = start_queue_logging()
+    METRICS_SERVER = MetricsServer(METRICS_HOST, METRICS_PORT)
+    METRICS_SERVER.start()
+    register_guard_metrics(GUARD)
+
     # Connect to Database for Single Source of Truth
     DB = Database(ip='localhost', username=sys.argv[1], password=sys.argv[2])
 
-    R1_DC = DB.fetch_by_device('R1')
-    # R2_DC = DB.fetch_by_device('R2')
+    # Heal outcomes written to audit table in batches by background thread over pooled connections
+    AUDIT = AuditWriter(Database.connection_pool('localhost', sys.argv[1], sys.argv[2]).get_connection,
+                        AUDIT_SPILL_FILE)
+    AUDIT.start()
 
-    # Gracefully close the Database connection
-    DB.close()
+    # Bulk load SSOT into memory, Database connection kept open only for change-detection refresh of the cache
+    SSOT = SsotCache(DB, ttl=300)
+    SSOT.load()
+
+    R1_DC = SSOT.get('R1')
+    # R2_DC = SSOT.get('R2')
+
+    # Warm NETCONF session pool shared by monitoring and auto-healing remediation
+    POOL = DevicePool(max_per_device=4, max_sessions=100)
 
-    # Connect to Routers of topology
-    R1 = Device(ip=R1_DC.mgmt_ip, username=R1_DC.user_name, password=R1_DC.password)
-    # R2 = Device(ip=R2_DC.mgmt_ip, username=R2_DC.user_name, password=R2_DC.password)
+    # Connect to Routers of topology, monitored session is held for lifetime of event trigger
+    R1 = POOL.acquire(R1_DC)
+    # R2 = POOL.acquire(R2_DC)
+
+    # Baseline health of every device in SSOT polled concurrently (one `<get>` of all peers each) and kept in memory
+    FLEET = FleetHealth(SSOT, POOL, interval=30)
+    FLEET.start()
+    LOGGER.info(f"fleet Baseline health {FLEET.report()}")
 
     # Verify the Baseline health of topology
-    if not verify_baseline_health(R1):
-        print("Topology devices not per expected Baselines..")
+    if not verify_baseline_health(R1, FLEET):
+        LOGGER.error("Topology devices not per expected Baselines..")
+        FLEET.stop()
+        POOL.release(R1)
+        POOL.close()
+        DB.close()
+        AUDIT.close()
+        METRICS_SERVER.stop()
+        LOG_LISTENER.stop()
         sys.exit(0)
 
+    # Raw notifications journaled off the hot path by writer thread, batched fsync
+    JOURNAL = JournalWriter(JOURNAL_DIR)
+    JOURNAL.start()
+
+    # Single asyncio event engine multiplexes notifications of all monitored devices, 10 workers at a time
+    ENGINE = EventEngine(handler=handle_notification, workers=10, queue_size=1000, overflow='drop_oldest',
+                         journal=JOURNAL)
+    ENGINE.start()
+
+    # BGP operational state streamed by YANG-push telemetry on its own session, else verification polls the peer
+    R1_BGP = BgpStateCache()
+    R1_TELEMETRY = BgpTelemetry(POOL.acquire(R1_DC), R1_BGP)
+    try:
+        R1_TELEMETRY.start()
+    except RPCError as err:
+        LOGGER.info(f"BGP telemetry not available, falling back to polling : {err}")
+
+    # Healing rules are reloaded when their file changes, SIGHUP forces reload right away
+    signal.signal(signal.SIGHUP, lambda signum, frame: RULES.reload())
+
+    # Correlation store of recent Events shared by all the monitored devices
+    EVENTS = EventStore(ttl=max(EVENT_STORE_TTL, RULES.current().max_window))
+
     # For Auto healing, create an event trigger for interested NETCONF streams example: "NETCONF" stream..
-    R1_event_trigger_snmpevents = EventTrigger(R1, R1_DC, 'snmpevents', 10)
+    R1_event_trigger_snmpevents = EventTrigger(R1, R1_DC, 'snmpevents', ENGINE, POOL, SSOT,
+                                               clog_subscription_filter(RULES.interest()), EVENTS, R1_BGP,
+                                               audit=AUDIT)
     R1_event_trigger_snmpevents.start()
 
     # Main thread continues to do any other parallel tasks as required..
     try:
         while True:
-            print(f"{threading.current_thread().name}...")
+            LOGGER.debug(f"{threading.current_thread().name}...")
             time.sleep(1)
     except KeyboardInterrupt:
-        print("Stopping event trigger...")
+        LOGGER.info("Stopping event trigger...")
         R1_event_trigger_snmpevents.stop()
-        R1_event_trigger_snmpevents.join()
+        ENGINE.stop()
+        LOGGER.info(f"event engine {ENGINE.stats.report()}")
+        JOURNAL.close()
+        LOGGER.info(f"notification journal {JOURNAL.stats.report()}")
+        AUDIT.close()
+        LOGGER.info(f"audit writer {AUDIT.stats.report()}")
 
     # Gracefully close the Router NETCONF connections
-    R1.close()
-    # R2.close()
+    if R1_BGP.is_live():
+        R1_TELEMETRY.stop()
+    POOL.release(R1_TELEMETRY.device)
+    POOL.release(R1)
+    # POOL.release(R2)
+    FLEET.stop()
+    POOL.close()
+    LOGGER.info(f"NETCONF session pool {POOL.stats.report()}")
+    LOGGER.info(f"RPC scheduler {POOL.rpc_report()}")
+    LOGGER.info(f"running config snapshots {POOL.snapshots.report()}")
+    LOGGER.info(f"remediation guard {GUARD.report()}")
+    LOGGER.info(f"pipeline trace holds {len(TRACE)} stage events")
+
+    # Gracefully close the Database connection
+    DB.close()
+
+    METRICS_SERVER.stop()
+    LOG_LISTENER.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+"""
+    Thin client of automation_daemon.py over its local Unix socket, standard library only so that it starts in
+    milliseconds (nothing of ncclient, mysql, jinja is imported here)
+
+    usage: python automation_ctl.py status
+           python automation_ctl.py health [R1]
+           python automation_ctl.py deploy ospf_enable --devices R1,R2
+           python automation_ctl.py interface R1 GigabitEthernet4 19.1.0.1 255.255.255.0
+           python automation_ctl.py greenfield [--force]
+           python automation_ctl.py refresh
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import http.client
+from urllib.parse import urlencode
+
+
+SOCKET_PATH = os.environ.get('AUTOMATION_SOCKET', '/tmp/network_automation.sock')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(method, path, body=None, socket_path=SOCKET_PATH, timeout=None):
+    """
+        One request to the daemon, returns (HTTP status, decoded JSON response)
+    """
+    connection = UnixHTTPConnection(socket_path, timeout)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--timeout', type=float, default=None, help="seconds, default waits for action to finish")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('status')
+
+    health = commands.add_parser('health')
+    health.add_argument('device', nargs='?')
+
+    deploy = commands.add_parser('deploy')
+    deploy.add_argument('action', help="ospf_enable, ospf_disable..")
+    deploy.add_argument('--devices', default='R1', help="comma separated host names (or) 'all'")
+    deploy.add_argument('--parallel', type=int, default=10)
+    deploy.add_argument('--canary', type=int, default=1)
+    deploy.add_argument('--waves', default='10,50,100', help="cumulative percentage of devices per wave")
+    deploy.add_argument('--max-failure-rate', type=float, default=0.2)
+    deploy.add_argument('--convergence-timeout', type=float, default=60)
+    deploy.add_argument('--no-rollback', action='store_true')
+
+    interface = commands.add_parser('interface')
+    interface.add_argument('device')
+    interface.add_argument('interface')
+    interface.add_argument('ip_address')
+    interface.add_argument('mask')
+
+    greenfield = commands.add_parser('greenfield')
+    greenfield.add_argument('yaml_file', nargs='?')
+    greenfield.add_argument('--force', action='store_true', help="re-render all the devices")
+
+    commands.add_parser('refresh')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        method, path, body = 'GET', '/status', None
+    elif args.command == 'health':
+        method, path, body = 'GET', f"/health?{urlencode({'device': args.device})}" if args.device else '/health', None
+    elif args.command == 'deploy':
+        method, path = 'POST', '/deploy'
+        body = {'action': args.action, 'devices': args.devices, 'parallel': args.parallel, 'canary': args.canary,
+                'waves': [int(percent) for percent in args.waves.split(',')],
+                'max_failure_rate': args.max_failure_rate, 'convergence_timeout': args.convergence_timeout,
+                'rollback': not args.no_rollback}
+    elif args.command == 'interface':
+        method, path = 'POST', '/interface'
+        body = {'device': args.device, 'interface': args.interface, 'ip_address': args.ip_address,
+                'mask': args.mask}
+    elif args.command == 'greenfield':
+        method, path = 'POST', '/greenfield'
+        body = {'yaml_file': os.path.abspath(args.yaml_file) if args.yaml_file else None, 'force': args.force}
+    else:
+        method, path, body = 'POST', '/refresh', {}
+
+    try:
+        status, result = request(method, path, body, args.socket, args.timeout)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"ERROR : automation daemon not running on {args.socket}")
+        sys.exit(2)
+
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if status == 200 and result.get('ok', True) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import os
+import sys
+import json
+import time
+import stat
+import socket
+import signal
+import logging
+import argparse
+import ipaddress
+import threading
+import socketserver
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from utils_library import *
+from fleet_health import FleetHealth
+from audit_writer import AuditWriter
+from deploy_brownfield import Rollout, ACTIONS
+from deploy_greenfield import handle_yaml, GREENFIELD_DIR
+from instrumentation import start_queue_logging
+
+
+LOGGER = logging.getLogger('automation_daemon')
+
+# Local control API, only reachable by the owner of the socket file
+SOCKET_PATH = os.environ.get('AUTOMATION_SOCKET', '/tmp/network_automation.sock')
+
+# Deployment outcomes audited into MySQL in background, spilled here while database is unavailable
+AUDIT_SPILL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audit_spill.jsonl')
+
+# largest request body accepted, requests are small JSON documents
+MAX_BODY = 1024 * 1024
+
+
+class AutomationState:
+    """
+        Warm state of the daemon: SSOT cache (change-detection refresh over open Database connection), NETCONF
+        session pool, fleet Baseline health and audit writer, shared by all the requests so that routine operation
+        pays none of the per-run startup of the scripts (imports, MySQL connect, SSH handshakes, health sweep)
+
+        Rollouts of same device serialize on its RPC scheduler (one deployment RPC at a time per device), greenfield
+        renders one at a time
+    """
+    def __init__(self, database, ssot, pool, health, audit=None):
+        self.database = database
+        self.ssot = ssot
+        self.pool = pool
+        self.health = health
+        self.audit = audit
+        self.started = time.time()
+        self.greenfield_lock = threading.Lock()
+
+    def _devices(self, devices):
+        if devices in (None, 'all'):
+            return self.ssot.devices()
+        host_names = devices.split(',') if isinstance(devices, str) else list(devices)
+        found = self.ssot.get_many(host_names)
+        missing = set(host_names) - {device_dc.host_name for device_dc in found}
+        if missing:
+            raise LookupError(f"devices not in Single Source-of-Truth : {', '.join(sorted(missing))}")
+        return found
+
+    def status(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'devices': len(self.ssot.devices()),
+            'ssot_age': time.monotonic() - self.ssot.loaded_at,
+            'health': self.health.summary(),
+            'pool': self.pool.stats.report(),
+            'open_sessions': self.pool.open_sessions,
+            'rpc': self.pool.rpc_report(),
+            'snapshots': self.pool.snapshots.report(),
+            'audit': self.audit.stats.report() if self.audit is not None else None,
+        }
+
+    def device_health(self, device=None, max_age=None):
+        """
+            Fleet health summary, (or) BGP peers and health of device as of its last poll
+        """
+        if device is None:
+            return {'summary': self.health.summary(), 'unhealthy': self.health.unhealthy()}
+
+        if self.ssot.get(device) is None:
+            raise LookupError(f"device {device} not in Single Source-of-Truth")
+        state = self.health.get(device)
+        return {
+            'device': device,
+            'healthy': self.health.healthy(device, max_age),
+            'peers': state.peers if state is not None else {},
+            'age': time.monotonic() - state.polled_at if state is not None else None,
+            'error': state.error if state is not None else None,
+        }
+
+    def deploy(self, action, devices=None, parallel=10, canary=1, waves=(10, 50, 100), max_failure_rate=0.2,
+               convergence_timeout=60, rollback=True):
+        """
+            Brownfield action (ospf_enable, ospf_disable..) rolled out as deploy_brownfield.py does
+        """
+        if action not in ACTIONS:
+            raise ValueError(f"unknown action {action}, one of {', '.join(sorted(ACTIONS))}")
+
+        rollout = Rollout(self.pool, action, parallel=parallel, canary=canary, waves=[int(wave) for wave in waves],
+                          max_failure_rate=max_failure_rate, convergence_timeout=convergence_timeout,
+                          rollback=rollback, health=self.health, audit=self.audit)
+        ok = rollout.run(self._devices(devices))
+        return {
+            'ok': ok,
+            'halted': rollout.halted,
+            'waves': [{'name': wave.name, 'elapsed': wave.elapsed,
+                       'devices': [asdict(result) for result in wave.devices]} for wave in rollout.results],
+            'rolled_back': [asdict(result) for result in rollout.rolled_back],
+        }
+
+    def interface(self, device, interface, ip_address, mask):
+        """
+            Configure IP/mask of interface of device
+        """
+        ipaddress.IPv4Interface(f'{ip_address}/{mask}')
+        device_dc, = self._devices([device])
+
+        start = time.monotonic()
+        error = ''
+        try:
+            with self.pool.lease(device_dc, timeout=30) as nc_device, rpc_priority('deployment'):
+                ok = nc_device.edit_config_interface(interface, ip_address, mask, refresh=True)
+        except Exception as err:
+            ok, error = False, repr(err)
+        elapsed = time.monotonic() - start
+
+        if self.audit is not None:
+            self.audit.record('deploy', device, 'interface_config', 'success' if ok else 'failed', duration=elapsed,
+                              detail=error or f'{interface} {ip_address}/{mask}')
+        return {'ok': ok, 'device': device, 'elapsed': elapsed, 'error': error}
+
+    def greenfield(self, yaml_file=None, force=False):
+        """
+            Render greenfield configs (incremental), template compiled once and kept while unchanged
+        """
+        with self.greenfield_lock:
+            rendered, skipped = handle_yaml(yaml_file or os.path.join(GREENFIELD_DIR, 'devices.yaml'), force=force)
+        return {'ok': True, 'rendered': rendered, 'skipped': skipped}
+
+    def refresh(self):
+        """
+            Re-load SSOT right away (only if changed)
+        """
+        self.ssot.refresh()
+        return {'ok': True, 'devices': len(self.ssot.devices())}
+
+
+# method, path -> (AutomationState method, arguments taken from JSON body (or) query string)
+ROUTES = {
+    ('GET', '/status'): ('status', ()),
+    ('GET', '/health'): ('device_health', ('device', 'max_age')),
+    ('POST', '/deploy'): ('deploy', ('action', 'devices', 'parallel', 'canary', 'waves', 'max_failure_rate',
+                                     'convergence_timeout', 'rollback')),
+    ('POST', '/interface'): ('interface', ('device', 'interface', 'ip_address', 'mask')),
+    ('POST', '/greenfield'): ('greenfield', ('yaml_file', 'force')),
+    ('POST', '/refresh'): ('refresh', ()),
+}
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+        JSON over HTTP/1.1 on Unix socket, see ROUTES. Responds {"ok": ..., ...} (or) {"ok": false, "error": ...} with
+        400 for bad request, 404 for unknown device (or) path, 500 when action raised
+    """
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        arguments = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if 'max_age' in arguments:
+            try:
+                arguments['max_age'] = float(arguments['max_age'])
+                if not 0 <= arguments['max_age'] < float('inf'):
+                    raise ValueError("not a finite non-negative number")
+            except ValueError as err:
+                self._respond(400, {'ok': False, 'error': f"bad max_age {arguments['max_age']} : {err}"})
+                return
+        self._dispatch('GET', url.path, arguments)
+
+    def do_POST(self):
+        length = (self.headers.get('Content-Length') or '0').strip()
+        if not (length.isascii() and length.isdigit()):
+            # negative length would read till client closes, blocking the handler thread
+            self._respond(400, {'ok': False, 'error': f"bad Content-Length {length!r}"})
+            return
+        length = int(length)
+        if length > MAX_BODY:
+            self._respond(413, {'ok': False, 'error': f"request body over {MAX_BODY} bytes"})
+            return
+        try:
+            arguments = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(arguments, dict):
+                raise ValueError("request body is not a JSON object")
+        except ValueError as err:
+            self._respond(400, {'ok': False, 'error': f"bad request body : {err}"})
+            return
+        self._dispatch('POST', urlsplit(self.path).path, arguments)
+
+    def _dispatch(self, method, path, arguments):
+        route = ROUTES.get((method, path))
+        if route is None:
+            self._respond(404, {'ok': False, 'error': f"no such endpoint {method} {path}"})
+            return
+
+        name, allowed = route
+        unknown = set(arguments) - set(allowed)
+        if unknown:
+            self._respond(400, {'ok': False, 'error': f"unknown arguments : {', '.join(sorted(unknown))}"})
+            return
+
+        start = time.monotonic()
+        try:
+            result = getattr(self.state, name)(**arguments)
+            code = 200
+        except LookupError as err:
+            result, code = {'ok': False, 'error': str(err)}, 404
+        except (TypeError, ValueError) as err:
+            result, code = {'ok': False, 'error': str(err)}, 400
+        except Exception as err:
+            LOGGER.error(f"{method} {path} failed : {err!r}")
+            result, code = {'ok': False, 'error': repr(err)}, 500
+
+        result.setdefault('ok', code == 200)
+        elapsed = time.monotonic() - start
+        result['elapsed_ms'] = round(elapsed * 1000, 3)
+        LOGGER.info(f"{method} {path} {code} {elapsed * 1000:.1f}ms")
+        self._respond(code, result)
+
+    def _respond(self, code, result):
+        body = json.dumps(result, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return 'local'
+
+    def log_message(self, format, *args):
+        # requests logged by _dispatch with timing
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # peer of Unix socket has no address, http.server expects (host, port)
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class ControlServer:
+    """
+        Control API of AutomationState served on Unix socket from a daemon thread, socket file mode 0600
+    """
+    def __init__(self, path, state):
+        self.path = path
+        _remove_stale_socket(path)
+
+        handler = type('ControlHandler', (ControlHandler,), {'state': state})
+        umask = os.umask(0o177)
+        try:
+            self.server = UnixHTTPServer(path, handler)
+        finally:
+            os.umask(umask)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='ControlServer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_stale_socket(path):
+    """
+        Socket file left by daemon which didn't exit cleanly is removed, one of running daemon is not
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise RuntimeError(f"{path} exists and is not a socket")
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"automation daemon already running on {path}")
+
+
+def main():
+    """
+        Resident automation daemon keeping SSOT, NETCONF sessions and Baseline health warm, routine operations
+        (brownfield OSPF rollout, interface config, health query, greenfield render) are requested through
+        automation_ctl.py over the local Unix socket. SIGHUP re-loads SSOT, SIGTERM (or) Ctrl-C stops
+    """
+
+    # MySQL Database login credentials  taken through command line arguments for security reasons..
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('database_username')
+    parser.add_argument('database_password')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--health-interval', type=float, default=30, help="seconds between health polls of device")
+    parser.add_argument('--health-parallel', type=int, default=32, help="devices health polled at a time")
+    parser.add_argument('--max-sessions', type=int, default=100, help="NETCONF sessions kept fleet-wide")
+    args = parser.parse_args()
+
+    LOG_LISTENER = start_queue_logging()
+
+    # Connect to Database for Single Source of Truth, kept open for change-detection refresh of the cache
+    DB = Database(ip='localhost', username=args.database_username, password=args.database_password)
+    SSOT = SsotCache(DB, ttl=300)
+    SSOT.load()
+
+    AUDIT = AuditWriter(Database.connection_pool('localhost', args.database_username,
+                                                 args.database_password).get_connection, AUDIT_SPILL_FILE)
+    AUDIT.start()
+
+    # Warm NETCONF session pool, deployment sessions and health polls of same device share its RPC scheduler
+    POOL = DevicePool(max_per_device=4, max_sessions=args.max_sessions)
+
+    # Baseline health of whole fleet polled upfront then kept fresh in background
+    HEALTH = FleetHealth(SSOT, POOL, interval=args.health_interval, max_parallel=args.health_parallel)
+    HEALTH.start()
+    LOGGER.info(f"fleet Baseline health {HEALTH.report()}")
+
+    SERVER = ControlServer(args.socket, AutomationState(DB, SSOT, POOL, HEALTH, AUDIT))
+    SERVER.start()
+    LOGGER.info(f"automation daemon serving on {args.socket}")
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGHUP, lambda signum, frame: SSOT.refresh())
+    try:
+        while not stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+    LOGGER.info("Stopping automation daemon...")
+    SERVER.stop()
+    HEALTH.stop()
+    POOL.close()
+    LOGGER.info(f"NETCONF session pool {POOL.stats.report()}")
+    AUDIT.close()
+    LOGGER.info(f"audit writer {AUDIT.stats.report()}")
+    DB.close()
+    LOG_LISTENER.stop()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+    End-to-end benchmark of EventTrigger/auto_healing under notification storm against netconf_simulator.py, for each
+    number of simulated devices reports
+        notif/sec       notifications handled per second by auto-healing (offered = devices x rate)
+        heal p50/p99    time from DUPADDR + BGP neighbor Down fault to verified heal (peer seen established again)
+        rss/threads     resident memory and thread count of auto-healing process and of the simulator
+
+    Notification storm starts once all the devices are subscribed. Simulator runs as separate process so that its own memory/threads and CPU don't count as auto-healing's, setup
+    is the same as auto_healing.main(): SsotCache over simulated SQLite SSOT, DevicePool, EventEngine, EventStore and
+    one EventTrigger with clog_subscription_filter(RULES.interest()) per device
+
+    With --journal every received notification is recorded into notification journal (a directory per number of
+    devices), for replay by benchmarks/journal_replay.py
+
+    usage: python benchmarks/auto_healing_storm.py [--devices 1,10,100,1000] [--rate 10] [--duration 30]
+                                                   [--mix noise=98,fault=2] [--workers 10] [--journal DIR]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils_library import SsotCache, DevicePool, EventStore, clog_subscription_filter
+from event_engine import EventEngine
+from auto_healing import EventTrigger, handle_notification, RULES, EVENT_STORE_TTL
+from instrumentation import start_queue_logging
+from notification_journal import JournalWriter
+from netconf_simulator import SqliteDatabase, process_usage
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netconf_simulator.py')
+
+
+class Simulator:
+    """
+        netconf_simulator.py child process driven over its stdin/stdout
+    """
+    def __init__(self, devices, port, rate, mix, ssot):
+        self.process = subprocess.Popen([sys.executable, SIMULATOR, '--devices', str(devices), '--port', str(port),
+                                         '--rate', str(rate), '--mix', mix, '--ssot', ssot, '--hold'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        ready = self.process.stdout.readline()
+        if not ready:
+            raise RuntimeError(f"simulator of {devices} devices failed to start")
+        self.ready = json.loads(ready)
+
+    def command(self, command):
+        self.process.stdin.write(command + '\n')
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def stop(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, -(-len(values) * percent // 100) - 1))]
+
+
+def run(devices, rate, duration, mix, workers, port, journal_dir=None):
+    ssot_path = f'/tmp/auto_healing_storm_{os.getpid()}.db'
+    simulator = Simulator(devices, port, rate, mix, ssot_path)
+
+    journal = None
+    if journal_dir is not None:
+        journal = JournalWriter(os.path.join(journal_dir, f'{devices}-devices'))
+        journal.start()
+
+    db = SqliteDatabase(ssot_path)
+    ssot = SsotCache(db)
+    ssot.load()
+
+    pool = DevicePool(max_per_device=3, max_sessions=devices * 3, port=port)
+    engine = EventEngine(handler=handle_notification, workers=workers, queue_size=1000, overflow='drop_oldest',
+                         journal=journal)
+    events = EventStore(ttl=max(EVENT_STORE_TTL, RULES.current().max_window))
+    triggers = []
+
+    def monitor(device_dc):
+        trigger = EventTrigger(pool.acquire(device_dc), device_dc, 'snmpevents', engine, pool, ssot,
+                               clog_subscription_filter(RULES.interest()), events)
+        triggers.append(trigger)
+        trigger.start()
+
+    # auto-healing logs every notification through queue logger as in production, to /dev/null here
+    devnull = open(os.devnull, 'w')
+    log_listener = start_queue_logging(stream=devnull)
+    try:
+        engine.start()
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(monitor, ssot.devices()))
+        setup = time.monotonic() - start
+
+        simulator.command('start')
+        processed = engine.stats.processed
+        time.sleep(duration)
+        processed = engine.stats.processed - processed
+        simulator_stats = simulator.command('stats')
+        client = process_usage()
+    finally:
+        for trigger in triggers:
+            trigger.stop()
+        engine.stop(drain=False)
+        if journal is not None:
+            journal.close()
+        for trigger in triggers:
+            pool.release(trigger.device)
+        pool.close()
+
+        simulator.stop()
+        db.close()
+        os.unlink(ssot_path)
+
+        log_listener.stop()
+        logging.getLogger().handlers.clear()
+        devnull.close()
+
+    latencies = simulator_stats['heal_latencies']
+    return {
+        'devices': devices,
+        'setup': setup,
+        'offered': devices * rate,
+        'sent': simulator_stats.get('notifications_sent', 0) / simulator_stats['elapsed'],
+        'processed': processed / duration,
+        'dropped': engine.stats.dropped + engine.stats.overflow,
+        'faults': simulator_stats.get('faults_injected', 0),
+        'heals': simulator_stats.get('heals_verified', 0),
+        'heal_p50': percentile(latencies, 50),
+        'heal_p99': percentile(latencies, 99),
+        'rss_mb': client['rss_mb'],
+        'threads': client['threads'],
+        'sim_rss_mb': simulator_stats['rss_mb'],
+        'sim_threads': simulator_stats['threads'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('--devices', default='1,10,100,1000', help="comma separated numbers of simulated devices")
+    parser.add_argument('--rate', type=float, default=10, help="notifications per second per device")
+    parser.add_argument('--duration', type=float, default=30, help="seconds measured per number of devices")
+    parser.add_argument('--mix', default='noise=98,fault=2')
+    parser.add_argument('--workers', type=int, default=10, help="EventEngine workers")
+    parser.add_argument('--port', type=int, default=8830)
+    parser.add_argument('--journal', help="record notifications into journal under this directory")
+    args = parser.parse_args()
+
+    print(f"{'devices':>8} {'setup(s)':>9} {'offered/s':>10} {'sent/s':>9} {'notif/s':>9} {'dropped':>8} "
+          f"{'faults':>7} {'heals':>6} {'heal p50':>9} {'heal p99':>9} {'rss(MB)':>8} {'threads':>8} "
+          f"{'sim rss':>8} {'sim thr':>8}")
+
+    for devices in [int(devices) for devices in args.devices.split(',')]:
+        result = run(devices, args.rate, args.duration, args.mix, args.workers, args.port, args.journal)
+        p50 = f"{result['heal_p50']:.2f}s" if result['heal_p50'] is not None else '-'
+        p99 = f"{result['heal_p99']:.2f}s" if result['heal_p99'] is not None else '-'
+        print(f"{result['devices']:>8} {result['setup']:>9.1f} {result['offered']:>10,.0f} {result['sent']:>9,.0f} "
+              f"{result['processed']:>9,.0f} {result['dropped']:>8} {result['faults']:>7} {result['heals']:>6} "
+              f"{p50:>9} {p99:>9} {result['rss_mb']:>8.0f} {result['threads']:>8} {result['sim_rss_mb']:>8.0f} "
+              f"{result['sim_threads']:>8}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+    Replay of notification journal (e.g. recorded by auto_healing_storm.py --journal) through EventEngine and
+    EventTrigger/auto_healing against netconf_simulator.py, in real time (or) N times faster, reports
+        notif/s         notifications replayed and handled per second
+        dropped         notifications dropped by the engine as work queue was full
+        outcomes        healing rule outcomes (success, failed, coalesced, rate_limited...) i.e. the heal decisions
+
+    Journal sources are "<host name>/<stream>" of the recorded EventTriggers, simulator serves R1..Rn so journals of
+    the lab topology (or) of the storm benchmark replay as is. Simulator doesn't inject faults of its own (rate 0),
+    remediation RPCs of replayed faults go to it and verification sees the peers established
+
+    usage: python benchmarks/journal_replay.py <journal_dir> [--speed 1,10,0] [--workers 10]
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils_library import SsotCache, DevicePool, EventStore
+from event_engine import EventEngine
+from auto_healing import EventTrigger, handle_notification, RULES, GUARD, EVENT_STORE_TTL
+from instrumentation import METRICS, start_queue_logging
+from notification_journal import read_journal
+from notification_journal import replay as replay_journal
+from netconf_simulator import SqliteDatabase
+from auto_healing_storm import Simulator
+
+
+def journal_sources(journal_dir):
+    sources = {}
+    for _, source, _ in read_journal(journal_dir):
+        sources[source] = sources.get(source, 0) + 1
+    return sources
+
+
+def outcomes():
+    counts = {}
+    for labels, value in METRICS.samples('healing_attempts_total').items():
+        labels = dict(labels)
+        key = (labels.get('rule', '-'), labels['result'])
+        counts[key] = counts.get(key, 0) + value
+    return counts
+
+
+def run(journal_dir, speed, workers, port):
+    sources = journal_sources(journal_dir)
+    host_names = {source.partition('/')[0] for source in sources}
+    devices = max(int(host_name[1:]) for host_name in host_names if host_name[1:].isdigit())
+
+    ssot_path = f'/tmp/journal_replay_{os.getpid()}.db'
+    simulator = Simulator(devices, port, 0, 'noise=100', ssot_path)
+
+    db = SqliteDatabase(ssot_path)
+    ssot = SsotCache(db)
+    ssot.load()
+
+    pool = DevicePool(max_per_device=3, max_sessions=devices * 3, port=port)
+    engine = EventEngine(handler=handle_notification, workers=workers, queue_size=1000, overflow='drop_oldest')
+    events = EventStore(ttl=max(EVENT_STORE_TTL, RULES.current().max_window))
+    triggers = {}
+
+    def prepare(source):
+        # replayed notifications are handed to engine directly, no subscription needed
+        stream = source.partition('/')[2]
+        device_dc = ssot.get(source.partition('/')[0])
+        if device_dc is not None:
+            triggers[source] = EventTrigger(pool.acquire(device_dc), device_dc, stream, engine, pool, ssot,
+                                            None, events)
+
+    # every replay starts with fresh dedup, single-flight, rate limit and breaker state
+    GUARD.reset()
+    before = outcomes()
+    devnull = open(os.devnull, 'w')
+    log_listener = start_queue_logging(stream=devnull)
+    try:
+        engine.start()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(prepare, sources))
+
+        # remediation of replayed faults finds simulator config already as intended, its LOG prints are muted too
+        start = time.monotonic()
+        with redirect_stdout(devnull):
+            replayed = replay_journal(read_journal(journal_dir, set(triggers)),
+                                      lambda source, notification: engine.submit(triggers[source], notification),
+                                      speed)
+            engine.stop(drain=True)
+        elapsed = time.monotonic() - start
+    finally:
+        engine.stop(drain=False)
+        for trigger in triggers.values():
+            pool.release(trigger.device)
+        pool.close()
+
+        simulator.stop()
+        db.close()
+        os.unlink(ssot_path)
+
+        log_listener.stop()
+        logging.getLogger().handlers.clear()
+        devnull.close()
+
+    after = outcomes()
+    return {
+        'speed': speed,
+        'devices': len(triggers),
+        'replayed': replayed,
+        'elapsed': elapsed,
+        'processed': engine.stats.processed / elapsed,
+        'dropped': engine.stats.dropped + engine.stats.overflow,
+        'outcomes': {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('journal_dir')
+    parser.add_argument('--speed', default='1', help="comma separated replay speeds, 0 is as fast as possible")
+    parser.add_argument('--workers', type=int, default=10, help="EventEngine workers")
+    parser.add_argument('--port', type=int, default=8830)
+    args = parser.parse_args()
+
+    print(f"{'speed':>6} {'devices':>8} {'replayed':>9} {'elapsed':>8} {'notif/s':>9} {'dropped':>8}  outcomes")
+    for speed in [float(speed) for speed in args.speed.split(',')]:
+        result = run(args.journal_dir, speed, args.workers, args.port)
+        outcomes_text = ', '.join(f'{rule}:{outcome}={count}'
+                                  for (rule, outcome), count in sorted(result['outcomes'].items()))
+        print(f"{result['speed']:>6g} {result['devices']:>8} {result['replayed']:>9} {result['elapsed']:>7.1f}s "
+              f"{result['processed']:>9,.0f} {result['dropped']:>8}  {outcomes_text or '-'}")
+        print(f"{'':>6} remediation guard {GUARD.report()}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
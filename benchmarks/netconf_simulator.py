@@ -0,0 +1,780 @@
+"""
+    Local stand-in of IOS-XE routers speaking just enough NETCONF for Device, EventTrigger and auto-healing to run
+    without real routers, over SSH "netconf" subsystem with base:1.0 end-of-message framing
+        <get>                   BGP4-MIB bgpPeerTable with subtree filter
+        <get-config>            running config (native interface/OSPF models) with subtree filter
+        <edit-config>           merge/replace/delete on running, restoring intended interface IP heals the BGP peer
+        <create-subscription>   clogMessageGenerated notifications at given rate and mix, subscription filter applied
+    any other RPC is answered with operation-not-supported rpc-error (so BGP telemetry falls back to polling)
+
+    Every simulated router listens on its own loopback address (127.1.x.y, Linux routes whole 127/8 to loopback) at
+    the same port so that each one is distinct device (mgmt_ip) for DevicePool and SSOT. Single Source-of-Truth of
+    the simulated topology is written as SQLite ipam_db_table served by SqliteDatabase (same API as Database)
+
+    Fault of the mix is the README scenario: interface IP of router changed to the BGP neighbor IP, router sends SYS
+    CONFIG_I, IP DUPADDR and shortly after BGP neighbor Down. Once edit-config restores intended IP the peer gets
+    established after convergence delay, time from fault to first `<get>` seeing it established is the verified heal
+    latency
+
+    usage: python benchmarks/netconf_simulator.py [--devices 10] [--port 8830] [--rate 10] [--mix noise=98,fault=2]
+                                                  [--ssot /tmp/ssot.db] [--hold]
+
+    Prints READY line (JSON) once listening, then reads commands from stdin: "stats" prints JSON line of statistics,
+    "reset" clears them, "start" starts the notification storm held back by --hold (e.g. till all devices are
+    subscribed), end of input stops the simulator
+"""
+
+import os
+import sys
+import copy
+import json
+import heapq
+import random
+import socket
+import sqlite3
+import zlib
+import argparse
+import logging
+import threading
+import selectors
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import paramiko
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils_library import DeviceData
+
+
+BASE_NS = 'urn:ietf:params:xml:ns:netconf:base:1.0'
+NATIVE_NS = 'http://cisco.com/ns/yang/Cisco-IOS-XE-native'
+BGP4_MIB_NS = 'urn:ietf:params:xml:ns:yang:smiv2:BGP4-MIB'
+CLOG_NS = 'urn:ietf:params:xml:ns:yang:smiv2:CISCO-SYSLOG-MIB'
+EOM = b']]>]]>'
+
+CAPABILITIES = [
+    'urn:ietf:params:netconf:base:1.0',
+    'urn:ietf:params:netconf:capability:writable-running:1.0',
+    'urn:ietf:params:netconf:capability:rollback-on-error:1.0',
+    'urn:ietf:params:netconf:capability:notification:1.0',
+    'urn:ietf:params:netconf:capability:interleave:1.0',
+    f'{NATIVE_NS}?module=Cisco-IOS-XE-native',
+    f'{BGP4_MIB_NS}?module=BGP4-MIB',
+    f'{CLOG_NS}?module=CISCO-SYSLOG-MIB',
+]
+
+# key leaves of list entries, edit-config merges into entry having same key
+LIST_KEYS = frozenset({'name', 'id', 'ip', 'bgpPeerRemoteAddr'})
+
+# (facility, msg_name, msg_text) of background syslog noise
+NOISE = [
+    ('LINEPROTO', 'UPDOWN', 'Line protocol on Interface GigabitEthernet3, changed state to up'),
+    ('SEC_LOGIN', 'LOGIN_SUCCESS', 'Login Success [user: admin] [Source: 10.0.0.9] [localport: 22]'),
+    ('BGP', 'ADJCHANGE', 'neighbor 10.255.0.1 Up'),
+    ('SYS', 'CONFIG_I', 'Configured from console by admin on vty0'),
+]
+
+MIX = {'noise': 98, 'fault': 2}
+
+# highest number of routers getting distinct 127.1.x.y address
+MAX_DEVICES = 255 * 254
+
+CLOG_NOTIFICATION = (
+    '<notification xmlns="urn:ietf:params:xml:ns:netconf:notification:1.0">'
+    '<eventTime>{event_time}</eventTime>'
+    '<clogMessageGenerated xmlns="urn:ietf:params:xml:ns:yang:smiv2:CISCO-SYSLOG-MIB">'
+    '<object-1><clogHistIndex>{index}</clogHistIndex><clogHistFacility>{facility}</clogHistFacility></object-1>'
+    '<object-2><clogHistIndex>{index}</clogHistIndex><clogHistSeverity>notice</clogHistSeverity></object-2>'
+    '<object-3><clogHistIndex>{index}</clogHistIndex><clogHistMsgName>{msg_name}</clogHistMsgName></object-3>'
+    '<object-4><clogHistIndex>{index}</clogHistIndex><clogHistMsgText>{msg_text}</clogHistMsgText></object-4>'
+    '</clogMessageGenerated></notification>'
+)
+
+
+class RpcFault(Exception):
+    """
+        Raised by RPC handlers, answered as `<rpc-error>`
+    """
+    def __init__(self, tag, message, error_type='protocol'):
+        super().__init__(message)
+        self.tag = tag
+        self.error_type = error_type
+
+
+class SimulatorStats:
+    """
+        Counters of the simulator, updated from session and sender threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = None
+        self.counters = None
+        self.heal_latencies = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.counters = Counter()
+            self.heal_latencies = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def heal(self, latency):
+        with self.lock:
+            self.counters['heals_verified'] += 1
+            self.heal_latencies.append(latency)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters)
+            snapshot['elapsed'] = time.monotonic() - self.started
+            snapshot['heal_latencies'] = list(self.heal_latencies)
+        snapshot.update(process_usage())
+        return snapshot
+
+
+class SimulatedRouter:
+    """
+        State of one simulated IOS-XE router: running config, BGP peer of GigabitEthernet2 and the fault in progress
+    """
+    def __init__(self, index, stats, convergence=0.2):
+        a, b = divmod(index, 254)
+        self.index = index
+        self.record = DeviceData(host_name=f'R{index + 1}', user_name='admin', password='admin',
+                                 mgmt_ip=f'127.1.{a}.{b + 1}',
+                                 GigabitEthernet1_ip=f'100.{a}.{b}.1', GigabitEthernet1_mask='255.255.255.0',
+                                 GigabitEthernet2_ip=f'19.{a}.{b}.1', GigabitEthernet2_mask='255.255.255.252',
+                                 GigabitEthernet4_ip=f'29.{a}.{b}.1', GigabitEthernet4_mask='255.255.255.0')
+        self.stats = stats
+        self.convergence = convergence
+        self.peer_ip = f'19.{a}.{b}.2'
+
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.clog_index = 0
+        self.fault_injected = None
+        self.fault_healed = None
+
+        self.running = etree.Element(f'{{{BASE_NS}}}data', nsmap={None: BASE_NS})
+        native = etree.SubElement(self.running, f'{{{NATIVE_NS}}}native', nsmap={None: NATIVE_NS})
+        interfaces = etree.SubElement(native, f'{{{NATIVE_NS}}}interface')
+        for number in ('1', '2', '4'):
+            interface = etree.SubElement(interfaces, f'{{{NATIVE_NS}}}GigabitEthernet')
+            etree.SubElement(interface, f'{{{NATIVE_NS}}}name').text = number
+            primary = interface
+            for tag in ('ip', 'address', 'primary'):
+                primary = etree.SubElement(primary, f'{{{NATIVE_NS}}}{tag}')
+            etree.SubElement(primary, f'{{{NATIVE_NS}}}address').text = getattr(self.record,
+                                                                               f'GigabitEthernet{number}_ip')
+            etree.SubElement(primary, f'{{{NATIVE_NS}}}mask').text = getattr(self.record,
+                                                                            f'GigabitEthernet{number}_mask')
+
+    def _interface_address(self, number):
+        return self.running.findtext(f'{{{NATIVE_NS}}}native/{{{NATIVE_NS}}}interface/'
+                                     f'{{{NATIVE_NS}}}GigabitEthernet[{{{NATIVE_NS}}}name="{number}"]/'
+                                     f'{{{NATIVE_NS}}}ip/{{{NATIVE_NS}}}address/{{{NATIVE_NS}}}primary/'
+                                     f'{{{NATIVE_NS}}}address')
+
+    def _set_interface_address(self, number, address):
+        leaf = self.running.find(f'{{{NATIVE_NS}}}native/{{{NATIVE_NS}}}interface/'
+                                 f'{{{NATIVE_NS}}}GigabitEthernet[{{{NATIVE_NS}}}name="{number}"]/'
+                                 f'{{{NATIVE_NS}}}ip/{{{NATIVE_NS}}}address/{{{NATIVE_NS}}}primary/'
+                                 f'{{{NATIVE_NS}}}address')
+        leaf.text = address
+
+    def get_config(self, criteria):
+        with self.lock:
+            return subtree_select(self.running, criteria)
+
+    def edit_config(self, config):
+        with self.lock:
+            apply_edit(self.running, config)
+            if (self.fault_injected is not None and self.fault_healed is None and
+                    self._interface_address('2') == self.record.GigabitEthernet2_ip):
+                self.fault_healed = time.monotonic()
+
+    def get_oper(self, criteria):
+        now = time.monotonic()
+        with self.lock:
+            if self.fault_injected is None:
+                state = 'established'
+            elif self.fault_healed is not None and now >= self.fault_healed + self.convergence:
+                # first read of the peer established after heal is the verification of auto-healing
+                self.stats.heal(now - self.fault_injected)
+                self.fault_injected = self.fault_healed = None
+                state = 'established'
+            else:
+                state = 'idle'
+
+        oper = etree.Element(f'{{{BASE_NS}}}data', nsmap={None: BASE_NS})
+        table = etree.SubElement(etree.SubElement(oper, f'{{{BGP4_MIB_NS}}}BGP4-MIB', nsmap={None: BGP4_MIB_NS}),
+                                 f'{{{BGP4_MIB_NS}}}bgpPeerTable')
+        entry = etree.SubElement(table, f'{{{BGP4_MIB_NS}}}bgpPeerEntry')
+        for tag, value in (('bgpPeerRemoteAddr', self.peer_ip), ('bgpPeerIdentifier', self.peer_ip),
+                           ('bgpPeerState', state), ('bgpPeerAdminStatus', 'start'),
+                           ('bgpPeerLocalAddr', self.record.GigabitEthernet2_ip), ('bgpPeerRemoteAs', '65001')):
+            etree.SubElement(entry, f'{{{BGP4_MIB_NS}}}{tag}').text = value
+
+        return subtree_select(oper, criteria)
+
+    def inject_fault(self):
+        """
+            Change GigabitEthernet2 IP to the BGP neighbor IP, returns syslog events it causes as (delay, event)
+            None in-case fault already in progress
+        """
+        with self.lock:
+            if self.fault_injected is not None:
+                return None
+            self.fault_injected = time.monotonic()
+            self._set_interface_address('2', self.peer_ip)
+
+        self.stats.count('faults_injected')
+        return [
+            (0.0, ('SYS', 'CONFIG_I', 'Configured from console by admin on vty0 (10.0.0.9)')),
+            (0.0, ('IP', 'DUPADDR', f'Duplicate address {self.peer_ip} on GigabitEthernet2, '
+                                    f'sourced by 5254.0012.3456')),
+            (0.05, ('BGP', 'ADJCHANGE', f'neighbor {self.peer_ip} Down Interface flap')),
+        ]
+
+    def notify(self, event):
+        """
+            Send syslog event to every subscription of the router whose filter accepts it
+        """
+        facility, msg_name, msg_text = event
+        with self.lock:
+            self.clog_index += 1
+            subscriptions = list(self.subscriptions)
+
+        notification = None
+        for subscription in subscriptions:
+            if not subscription.accepts(facility, msg_name):
+                self.stats.count('notifications_filtered')
+                continue
+            if notification is None:
+                notification = CLOG_NOTIFICATION.format(
+                    event_time=datetime.now(timezone.utc).isoformat(timespec='milliseconds'), index=self.clog_index,
+                    facility=facility, msg_name=msg_name, msg_text=msg_text)
+            if subscription.session.send(notification):
+                self.stats.count('notifications_sent')
+            else:
+                self.unsubscribe(subscription)
+
+    def subscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.append(subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+
+class Subscription:
+    """
+        create-subscription of one session, interest is set of (facility, msg_name) with '' msg_name meaning any
+        (None interest means no filter)
+    """
+    def __init__(self, session, nc_filter):
+        self.session = session
+        self.interest = None
+        if nc_filter is not None:
+            self.interest = set()
+            for criteria in nc_filter.iter(f'{{{CLOG_NS}}}clogMessageGenerated'):
+                facility = (criteria.findtext(f'.//{{{CLOG_NS}}}clogHistFacility') or '').strip()
+                msg_name = (criteria.findtext(f'.//{{{CLOG_NS}}}clogHistMsgName') or '').strip()
+                self.interest.add((facility, msg_name))
+
+    def accepts(self, facility, msg_name):
+        return (self.interest is None or (facility, '') in self.interest or
+                (facility, msg_name) in self.interest)
+
+
+class RouterServer(paramiko.ServerInterface):
+    """
+        SSH server side of one router, password authentication against the SSOT record
+    """
+    def __init__(self, router):
+        self.router = router
+
+    def check_auth_password(self, username, password):
+        if username == self.router.record.user_name and password == self.router.record.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class NetconfSession(paramiko.SubsystemHandler):
+    """
+        NETCONF session on "netconf" subsystem channel, run by paramiko in its own thread
+    """
+    def __init__(self, channel, name, server, simulator, router):
+        super().__init__(channel, name, server)
+        self.simulator = simulator
+        self.router = router
+        self.channel = channel
+        self.send_lock = threading.Lock()
+        self.session_id = simulator.next_session_id()
+        self.subscription = None
+
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.channel.sendall(message.encode() + EOM)
+            return True
+        except (OSError, EOFError, paramiko.SSHException):
+            return False
+
+    def start_subsystem(self, name, transport, channel):
+        stats = self.simulator.stats
+        stats.count('sessions_opened')
+        self.send(f'<hello xmlns="{BASE_NS}"><capabilities>'
+                  f'{"".join(f"<capability>{capability}</capability>" for capability in CAPABILITIES)}'
+                  f'</capabilities><session-id>{self.session_id}</session-id></hello>')
+
+        buffer = b''
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                while (end := buffer.find(EOM)) >= 0:
+                    message, buffer = buffer[:end], buffer[end + len(EOM):]
+                    if not self.handle(message):
+                        return
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            if self.subscription is not None:
+                self.router.unsubscribe(self.subscription)
+            stats.count('sessions_closed')
+            channel.close()
+
+    def handle(self, message):
+        """
+            Handle one framed message, returns False when session is to be closed
+        """
+        rpc = etree.fromstring(message.strip())
+        if etree.QName(rpc).localname == 'hello':
+            return True
+
+        operation = next(child for child in rpc if isinstance(child.tag, str))
+        name = etree.QName(operation).localname
+        self.simulator.stats.count(f'rpc_{name}')
+
+        try:
+            body = self.dispatch(name, operation)
+        except RpcFault as fault:
+            body = (f'<rpc-error><error-type>{fault.error_type}</error-type><error-tag>{fault.tag}</error-tag>'
+                    f'<error-severity>error</error-severity><error-message>{fault}</error-message></rpc-error>')
+
+        attributes = ''.join(f' {key}="{value}"' for key, value in rpc.attrib.items())
+        self.send(f'<rpc-reply xmlns="{BASE_NS}"{attributes}>{body}</rpc-reply>')
+
+        return name != 'close-session'
+
+    def dispatch(self, name, operation):
+        nc_filter = next((child for child in operation if etree.QName(child).localname == 'filter'), None)
+
+        if name == 'get':
+            if nc_filter is None or nc_filter.find(f'{{{BGP4_MIB_NS}}}BGP4-MIB') is None:
+                return '<data/>'
+            return etree.tostring(self.router.get_oper(nc_filter)).decode()
+
+        if name == 'get-config':
+            return etree.tostring(self.router.get_config(nc_filter)).decode()
+
+        if name == 'edit-config':
+            config = operation.find(f'{{{BASE_NS}}}config')
+            if config is None:
+                config = operation.find('config')
+            if config is None:
+                raise RpcFault('missing-element', 'config missing')
+            self.router.edit_config(config)
+            if self.simulator.config_notifications:
+                self.router.notify(('SYS', 'CONFIG_I', f'Configured from NETCONF by {self.router.record.user_name},'
+                                                       f' transaction-id {self.session_id}'))
+            return '<ok/>'
+
+        if name == 'create-subscription':
+            if self.subscription is not None:
+                raise RpcFault('in-use', 'subscription already active on this session')
+            self.subscription = Subscription(self, nc_filter)
+            self.router.subscribe(self.subscription)
+            self.simulator.schedule(self.router)
+            return '<ok/>'
+
+        if name in ('lock', 'unlock', 'discard-changes', 'close-session'):
+            return '<ok/>'
+
+        raise RpcFault('operation-not-supported', f'{name} not supported by simulator')
+
+
+class NetconfSimulator:
+    """
+        Simulated topology of routers, one accept thread for all listening sockets and sender threads emitting the
+        notification mix at given rate per router
+    """
+    def __init__(self, devices=10, port=8830, rate=10, mix=None, convergence=0.2, senders=2,
+                 config_notifications=True, hold=False, seed=None):
+        if devices > MAX_DEVICES:
+            raise ValueError(f"at most {MAX_DEVICES} simulated devices")
+
+        self.port = port
+        self.rate = rate
+        self.mix = mix or MIX
+        self.config_notifications = config_notifications
+        self.random = random.Random(seed)
+        self.stats = SimulatorStats()
+        self.routers = [SimulatedRouter(index, self.stats, convergence) for index in range(devices)]
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.session_ids = iter(range(1, sys.maxsize))
+        self.id_lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.transports = []
+        self.running = False
+        self.storm = threading.Event()
+        if not hold:
+            self.storm.set()
+
+        self.senders = [Sender(self) for _ in range(senders)]
+        self.accept_thread = threading.Thread(target=self._accept_loop, name='SimAccept', daemon=True)
+
+    def next_session_id(self):
+        with self.id_lock:
+            return next(self.session_ids)
+
+    def start(self):
+        # clients going away mid-session is expected, not worth paramiko error logs
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+        for router in self.routers:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((router.record.mgmt_ip, self.port))
+            listener.listen(64)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, router)
+
+        self.running = True
+        self.accept_thread.start()
+        for sender in self.senders:
+            sender.start()
+
+    def stop(self):
+        self.running = False
+        for sender in self.senders:
+            sender.stop()
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+        for transport in self.transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.5):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                sock.setblocking(True)
+                transport = paramiko.Transport(sock)
+                # handshakes queue up behind each other while many clients connect at once
+                transport.banner_timeout = transport.handshake_timeout = transport.auth_timeout = 120
+                transport.add_server_key(self.host_key)
+                transport.set_subsystem_handler('netconf', NetconfSession, self, key.data)
+                transport.start_server(event=threading.Event(), server=RouterServer(key.data))
+                self.transports.append(transport)
+
+    def schedule(self, router):
+        self.senders[router.index % len(self.senders)].add(router)
+
+    def next_event(self, router):
+        """
+            Pick next event of the mix for router, faults cause several syslog events as (delay, event)
+        """
+        kinds = list(self.mix)
+        kind = self.random.choices(kinds, [self.mix[kind] for kind in kinds])[0]
+        if kind == 'fault':
+            events = router.inject_fault()
+            if events is not None:
+                return events
+        return [(0.0, self.random.choice(NOISE))]
+
+    def write_ssot(self, path):
+        """
+            Single Source-of-Truth of simulated topology as SQLite ipam_db_table
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        columns = list(DeviceData.__dataclass_fields__)
+        with sqlite3.connect(path) as conn:
+            conn.execute(f"CREATE TABLE ipam_db_table ({', '.join(f'{column} TEXT' for column in columns)}, "
+                         f"PRIMARY KEY (host_name))")
+            conn.executemany(f"INSERT INTO ipam_db_table VALUES ({', '.join(['?'] * len(columns))})",
+                             [tuple(getattr(router.record, column) for column in columns) for router in self.routers])
+        conn.close()
+
+
+class Sender(threading.Thread):
+    """
+        Emits notification mix of its share of routers at simulator rate (per router), due times kept in heap
+    """
+    def __init__(self, simulator):
+        super().__init__(name='SimSender', daemon=True)
+        self.simulator = simulator
+        self.heap = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+
+    def add(self, router):
+        with self.condition:
+            if not any(entry[3] is router and entry[2] is None for entry in self.heap):
+                self._push(time.monotonic(), None, router)
+                self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def _push(self, due, event, router):
+        # caller holds self.condition
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, event, router))
+
+    def run(self):
+        interval = 1.0 / self.simulator.rate if self.simulator.rate else None
+        while True:
+            with self.condition:
+                while not self.stopping and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.stopping:
+                    return
+                due, _, event, router = heapq.heappop(self.heap)
+
+            if event is not None:
+                router.notify(event)
+                continue
+
+            if interval is None or not router.subscriptions:
+                # tick stops once router has no subscription, schedule() restarts it
+                continue
+
+            now = time.monotonic()
+            events = self.simulator.next_event(router) if self.simulator.storm.is_set() else []
+            with self.condition:
+                for delay, next_event in events:
+                    self._push(now + delay, next_event, router)
+                # catch up at most one second worth of ticks when sender falls behind
+                self._push(max(due + interval, now - 1.0), None, router)
+
+
+
+class SqliteDatabase:
+    """
+        SQLite stand-in of Database with the same API over the same ipam_db_table, for simulated Single Source-of-Truth
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connected = True
+
+    def _query(self, query, parameters=()):
+        with self.lock:
+            return self.conn.execute(query, parameters).fetchall()
+
+    def fetch_by_device(self, host_name):
+        rows = self._query("SELECT * FROM ipam_db_table WHERE host_name = ?", (host_name,))
+        return DeviceData(*rows[0]) if rows else None
+
+    def fetch_all(self, batch_size=500):
+        for row in self._query("SELECT * FROM ipam_db_table"):
+            yield DeviceData(*row)
+
+    def fetch_many(self, host_names, batch_size=500):
+        host_names = list(host_names)
+        for start in range(0, len(host_names), batch_size):
+            batch = host_names[start:start + batch_size]
+            for row in self._query(f"SELECT * FROM ipam_db_table WHERE host_name IN ({', '.join(['?'] * len(batch))})",
+                                   batch):
+                yield DeviceData(*row)
+
+    def has_interface_table(self):
+        return bool(self._query("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                                "name = 'ipam_interface_table'"))
+
+    def fetch_interfaces(self, batch_size=500):
+        yield from self._query("SELECT host_name, interface, ip_address, mask FROM ipam_interface_table")
+
+    def table_checksum(self):
+        checksum = 0
+        for row in self._query("SELECT * FROM ipam_db_table ORDER BY host_name"):
+            checksum = zlib.crc32(repr(row).encode(), checksum)
+        return checksum
+
+    def ping(self):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+        self.conn.close()
+
+
+def process_usage():
+    """
+        Resident memory (MiB) and thread count of the current process
+    """
+    rss = None
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return {'rss_mb': rss, 'threads': threading.active_count()}
+
+
+def subtree_select(node, criteria):
+    """
+        Copy of node keeping only what subtree filter criteria (RFC 6241 6.2) selects, None in-case content match
+        nodes don't match. Criteria without children selects whole node
+    """
+    children = [child for child in criteria if isinstance(child.tag, str)] if criteria is not None else []
+    if not children:
+        return copy.deepcopy(node)
+
+    content = [child for child in children if len(child) == 0 and (child.text or '').strip()]
+    for match in content:
+        leaf = node.find(match.tag)
+        if leaf is None or (leaf.text or '').strip() != match.text.strip():
+            return None
+    if len(content) == len(children):
+        return copy.deepcopy(node)
+
+    selected = etree.Element(node.tag, nsmap=node.nsmap)
+    for child in children:
+        for data_child in node.iterchildren(child.tag):
+            if child in content:
+                selected.append(copy.deepcopy(data_child))
+            elif (sub := subtree_select(data_child, child)) is not None:
+                selected.append(sub)
+
+    return selected
+
+
+def apply_edit(target, source):
+    """
+        Apply edit-config `<config>` content on running config, merge by default with replace/create/delete/remove
+        operations of base:1.0
+    """
+    for child in source:
+        if not isinstance(child.tag, str):
+            continue
+
+        operation = child.get(f'{{{BASE_NS}}}operation') or child.get('operation') or 'merge'
+        match = next((candidate for candidate in target.iterchildren(child.tag)
+                      if _entry_key(candidate) == _entry_key(child)), None)
+
+        if operation in ('delete', 'remove'):
+            if match is not None:
+                target.remove(match)
+            elif operation == 'delete':
+                raise RpcFault('data-missing', f'{etree.QName(child).localname} not present', 'application')
+        elif match is None or operation in ('replace', 'create'):
+            if match is not None and operation == 'create':
+                raise RpcFault('data-exists', f'{etree.QName(child).localname} already present', 'application')
+            new = copy.deepcopy(child)
+            for element in new.iter():
+                element.attrib.pop(f'{{{BASE_NS}}}operation', None)
+                element.attrib.pop('operation', None)
+            if match is None:
+                target.append(new)
+            else:
+                target.replace(match, new)
+        elif len(child) == 0:
+            match.text = child.text
+        else:
+            apply_edit(match, child)
+
+
+def _entry_key(element):
+    first = next((child for child in element if isinstance(child.tag, str)), None)
+    if first is None or len(first) != 0 or etree.QName(first).localname not in LIST_KEYS:
+        return None
+    return first.tag, (first.text or '').strip()
+
+
+def parse_mix(mix):
+    """
+        "noise=98,fault=2" -> {'noise': 98, 'fault': 2}
+    """
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in MIX:
+            raise ValueError(f"unknown event kind {kind}, expected one of {sorted(MIX)}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8830)
+    parser.add_argument('--rate', type=float, default=10, help="notifications per second per device")
+    parser.add_argument('--mix', default='noise=98,fault=2', help="weights of event kinds (noise, fault)")
+    parser.add_argument('--convergence', type=float, default=0.2, help="seconds for BGP peer to establish after heal")
+    parser.add_argument('--senders', type=int, default=2)
+    parser.add_argument('--ssot', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulated_ssot.db'))
+    parser.add_argument('--hold', action='store_true', help="hold notifications back till \"start\" command")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = NetconfSimulator(devices=args.devices, port=args.port, rate=args.rate, mix=parse_mix(args.mix),
+                                 convergence=args.convergence, senders=args.senders, hold=args.hold, seed=args.seed)
+    simulator.write_ssot(args.ssot)
+    simulator.start()
+    print(json.dumps({'ready': True, 'devices': args.devices, 'port': args.port, 'ssot': args.ssot}), flush=True)
+
+    for line in sys.stdin:
+        command = line.strip()
+        if command == 'stats':
+            print(json.dumps(simulator.stats.snapshot()), flush=True)
+        elif command == 'reset':
+            simulator.stats.reset()
+            print(json.dumps({'reset': True}), flush=True)
+        elif command == 'start':
+            simulator.stats.reset()
+            simulator.storm.set()
+            print(json.dumps({'started': True}), flush=True)
+
+    simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
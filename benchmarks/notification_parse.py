@@ -0,0 +1,104 @@
+"""
+    Benchmark of NETCONF notification parsing as notifications parsed per second,
+        before  : xmltodict.parse of full notification then KeyError for not-interested Events
+        after   : parse_clog_notification() fast path with precompiled XPath and early reject
+        filter  : same fast path when router applies clog_subscription_filter(), so only interested Events arrive
+
+    Notification mix is mostly syslog/trap noise with few BGP and DUPADDR events as seen during Network Chaos
+
+    usage: python benchmarks/notification_parse.py [notifications]
+"""
+
+import os
+import sys
+import time
+import random
+
+import xmltodict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils_library import parse_clog_notification, CLOG_EVENTS
+
+
+CLOG_NOTIFICATION = (
+    '<notification xmlns="urn:ietf:params:xml:ns:netconf:notification:1.0">'
+    '<eventTime>2024-01-01T00:00:00.000Z</eventTime>'
+    '<clogMessageGenerated xmlns="urn:ietf:params:xml:ns:yang:smiv2:CISCO-SYSLOG-MIB">'
+    '<object-1><clogHistIndex>{index}</clogHistIndex><clogHistFacility>{facility}</clogHistFacility></object-1>'
+    '<object-2><clogHistIndex>{index}</clogHistIndex><clogHistSeverity>notice</clogHistSeverity></object-2>'
+    '<object-3><clogHistIndex>{index}</clogHistIndex><clogHistMsgName>{msg_name}</clogHistMsgName></object-3>'
+    '<object-4><clogHistIndex>{index}</clogHistIndex><clogHistMsgText>{msg_text}</clogHistMsgText></object-4>'
+    '<object-5><clogHistIndex>{index}</clogHistIndex><clogHistTimestamp>{index}</clogHistTimestamp></object-5>'
+    '</clogMessageGenerated></notification>'
+)
+
+LINK_NOTIFICATION = (
+    '<notification xmlns="urn:ietf:params:xml:ns:netconf:notification:1.0">'
+    '<eventTime>2024-01-01T00:00:00.000Z</eventTime>'
+    '<linkDown xmlns="urn:ietf:params:xml:ns:yang:smiv2:IF-MIB">'
+    '<object-1><ifIndex>{index}</ifIndex><ifAdminStatus>up</ifAdminStatus></object-1>'
+    '<object-2><ifIndex>{index}</ifIndex><ifOperStatus>down</ifOperStatus></object-2>'
+    '</linkDown></notification>'
+)
+
+# (weight, facility, msg_name, msg_text)
+MIX = [
+    (40, 'SYS', 'CONFIG_I', 'Configured from console by admin on vty0'),
+    (25, 'LINEPROTO', 'UPDOWN', 'Line protocol on Interface GigabitEthernet3, changed state to down'),
+    (15, None, None, None),
+    (10, 'BGP', 'ADJCHANGE', 'neighbor 19.1.0.2 Down Interface flap'),
+    (10, 'IP', 'DUPADDR', 'Duplicate address 19.1.0.2 on GigabitEthernet4, sourced by 5254.0012.3456'),
+]
+
+
+def build_notifications(count, interest=None):
+    weights = [weight for weight, *_ in MIX]
+    notifications = []
+    for index, (_, facility, msg_name, msg_text) in enumerate(random.choices(MIX, weights, k=count)):
+        if interest is not None and (facility not in interest or (interest[facility] is not None and
+                                                                  msg_name not in interest[facility])):
+            continue
+        if facility is None:
+            notifications.append(LINK_NOTIFICATION.format(index=index))
+        else:
+            notifications.append(CLOG_NOTIFICATION.format(index=index, facility=facility, msg_name=msg_name,
+                                                          msg_text=msg_text))
+    return notifications
+
+
+def parse_xmltodict(notification_xml):
+    nc_reply_dict = xmltodict.parse(notification_xml)
+    try:
+        event_type = nc_reply_dict['notification']['clogMessageGenerated']['object-1']['clogHistFacility']
+        event_info = nc_reply_dict['notification']['clogMessageGenerated']['object-4']['clogHistMsgText']
+        if event_type == 'IP':
+            event_type = nc_reply_dict['notification']['clogMessageGenerated']['object-3']['clogHistMsgName']
+        return event_type, event_info
+    except KeyError:
+        return None
+
+
+def measure(name, parse, notifications, offered):
+    start = time.perf_counter()
+    accepted = sum(1 for notification in notifications if parse(notification) is not None)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<36} {offered / elapsed:>14,.0f} {accepted:>12,}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(7)
+
+    notifications = build_notifications(count)
+    filtered = build_notifications(count, CLOG_EVENTS)
+
+    print(f"{'parser':<36} {'notif/sec':>14} {'accepted':>12}   ({count:,} notifications offered)")
+    measure('xmltodict (before)', parse_xmltodict, notifications, count)
+    measure('parse_clog_notification', parse_clog_notification, notifications, count)
+    measure('parse_clog_notification + filter', parse_clog_notification, filtered, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+    Micro-benchmark of per-RPC NETCONF payload build cost,
+        before  : open + read Templates/*.xml from disk and str.format on every call
+        after   : precompiled TemplateRegistry, both cache miss (uncached render) and memoized render
+
+    usage: python benchmarks/template_build.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils_library import TEMPLATES, TEMPLATES_DIR
+
+
+PAYLOADS = {
+    'bgp_oper': {},
+    'interface_config': {'mg_1_groups_0': '2', 'ip_address': '19.1.0.1', 'mask_1': '255.255.255.0'},
+    'ospf_config': {'process_id': '10', 'router_id': '1.1.1.1', 'network_ip': '19.1.0.0',
+                    'network_mask': '0.0.0.255', 'area_id': '0', 'action': ''},
+}
+
+
+def build_from_disk(name, variables):
+    with open(os.path.join(TEMPLATES_DIR, f'{name}.xml'), 'r') as file:
+        return file.read().format(**variables)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"{'template':<18} {'disk+format':>14} {'precompiled':>14} {'memoized':>14}   (usec per payload)")
+    for name, variables in PAYLOADS.items():
+        assert build_from_disk(name, variables) == TEMPLATES.render(name, **variables)
+
+        before = timeit.timeit(lambda: build_from_disk(name, variables), number=iterations)
+        compiled = timeit.timeit(lambda: TEMPLATES.render_uncached(name, **variables), number=iterations)
+        memoized = timeit.timeit(lambda: TEMPLATES.render(name, **variables), number=iterations)
+
+        print(f"{name:<18} {before / iterations * 1e6:>14.2f} {compiled / iterations * 1e6:>14.2f} "
+              f"{memoized / iterations * 1e6:>14.2f}")
+
+    print(f"LOG : render cache {TEMPLATES.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,355 @@
 import sys
 import time
 import os
+import logging
+import argparse
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
 
 from utils_library import *
+from fleet_health import FleetHealth
+from audit_writer import AuditWriter
+from instrumentation import LOG_FORMAT
+
+
+# Router-ID of OSPF per device, default is the IP of GigabitEthernet4 in Single Source-of-Truth
+OSPF_ROUTER_IDS = {'R1': '1.1.1.1'}
+
+
+def ospf_config_snippets(device, device_dc, action):
+    """
+        OSPF process 10 area 0 on the network of GigabitEthernet4 taken from Single Source-of-Truth
+    """
+    network = ipaddress.IPv4Network(f"{device_dc.GigabitEthernet4_ip}/{device_dc.GigabitEthernet4_mask}",
+                                    strict=False)
+
+    return [device.ospf_config(process_id='10',
+                               router_id=OSPF_ROUTER_IDS.get(device_dc.host_name, device_dc.GigabitEthernet4_ip),
+                               network_ip=str(network.network_address), network_mask=str(network.hostmask),
+                               area_id='0',
+                               action=action)]
+
+
+# Deployment outcomes audited into MySQL in background, spilled here while database is unavailable
+AUDIT_SPILL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audit_spill.jsonl')
+
+
+# action -> (function building config snippets of the action, action which rolls it back)
+# Note: This is expandable by adding more cases like "mpls_enable", "mpls_disable" etc
+ACTIONS = {
+    'ospf_enable': (lambda device, device_dc: ospf_config_snippets(device, device_dc, 'enable'), 'ospf_disable'),
+    'ospf_disable': (lambda device, device_dc: ospf_config_snippets(device, device_dc, 'disable'), 'ospf_enable'),
+}
+
+
+@dataclass
+class DeviceResult:
+    """
+        Dataclass to handle outcome and timing of Brownfield deployment on single device
+    """
+    host_name: str
+    status: str = 'pending'
+    deploy_time: float = 0.0
+    convergence_time: float = 0.0
+    error: str = ''
+    applied: bool = False
+
+
+@dataclass
+class WaveResult:
+    """
+        Dataclass to handle outcome and timing of one rollout wave
+    """
+    name: str
+    devices: list
+    elapsed: float = 0.0
+
+    def failure_rate(self):
+        done = [result for result in self.devices if result.status != 'skipped']
+        failed = [result for result in done if result.status not in ('success', 'unchanged')]
+        return len(failed) / len(done) if done else 0.0
+
+
+def wait_for_convergence(device, timeout=60, interval=0.5, max_interval=4, backoff=1.5, healthy_polls=3,
+                         dwell=5):
+    """
+        Adaptive convergence polling instead of fixed sleep, polls Baseline health quickly at first then backing off
+        till timeout, returns seconds taken to converge (or) None
+
+        Converged only once healthy_polls consecutive polls spanning at least dwell seconds are all healthy, so that
+        peer flapping right after the change isn't taken as converged. Returned time is when the healthy run began.
+        dwell is capped at half the timeout so that short timeout still leaves room for the healthy run
+    """
+    dwell = min(dwell, timeout / 2)
+    start = time.monotonic()
+    deadline = start + timeout
+    healthy_since, healthy_count = None, 0
+    while True:
+        if verify_baseline_health(device):
+            now = time.monotonic()
+            if healthy_since is None:
+                healthy_since = now
+            healthy_count += 1
+            if healthy_count >= healthy_polls and now - healthy_since >= dwell:
+                return healthy_since - start
+            wait = max(interval, dwell / max(healthy_polls - 1, 1))
+        else:
+            healthy_since, healthy_count = None, 0
+            wait = interval
+            interval = min(interval * backoff, max_interval)
+        if time.monotonic() + wait > deadline:
+            return None
+        time.sleep(wait)
+
+
+class Rollout:
+    """
+        Rollout scheduler pushing Brownfield action to many devices concurrently (up-to parallel devices at a time)
+        in waves, canary devices first then cumulative percentage of devices per wave
+
+        Each device gets its config as one confirmed-commit transaction which is confirmed only once topology
+        converges back to Baseline health, so device rolls back by itself in-case not. When failure rate of a wave
+        crosses max_failure_rate, rollout halts and (optionally) already deployed devices are rolled back
+
+        FleetHealth (optional) answers Baseline health before deployment from memory, after deployment health is
+        always verified on the device itself
+
+        AuditWriter (optional) records outcome of every device deployment (and rollback) off the rollout path
+    """
+    def __init__(self, pool, action, parallel=10, canary=1, waves=(10, 50, 100), max_failure_rate=0.2,
+                 convergence_timeout=60, confirm_timeout=120, rollback=True, health=None, audit=None):
+        if action not in ACTIONS:
+            raise ValueError(f"unknown action {action}")
+
+        self.pool = pool
+        self.action = action
+        self.parallel = parallel
+        self.canary = canary
+        self.waves = waves
+        self.max_failure_rate = max_failure_rate
+        self.convergence_timeout = convergence_timeout
+        self.confirm_timeout = confirm_timeout
+        self.rollback = rollback
+        self.health = health
+        self.audit = audit
+
+        self.results = []
+        self.halted = False
+        self.rolled_back = []
+        self.device_index = {}
+
+    def plan(self, devices):
+        """
+            Split devices into waves, returns list of (wave name, devices)
+        """
+        devices = list(devices)
+        plan = []
+        if self.canary:
+            plan.append(('canary', devices[:self.canary]))
+
+        done = min(self.canary, len(devices))
+        for percent in self.waves:
+            upto = max(done, -(-len(devices) * percent // 100))
+            if upto > done:
+                plan.append((f'{percent}%', devices[done:upto]))
+                done = upto
+
+        if done < len(devices):
+            plan.append(('rest', devices[done:]))
+
+        return plan
+
+    def run(self, devices):
+        self.device_index = {device_dc.host_name: device_dc for device_dc in devices}
+
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix='Rollout') as executor:
+            for name, wave_devices in self.plan(devices):
+                start = time.monotonic()
+                wave = WaveResult(name, list(executor.map(lambda device_dc: self.deploy(device_dc, self.action),
+                                                          wave_devices)))
+                wave.elapsed = time.monotonic() - start
+                self.results.append(wave)
+
+                print(f"LOG : wave {name:<8} devices={len(wave.devices)} failure_rate={wave.failure_rate():.0%} "
+                      f"elapsed={wave.elapsed:.1f}s")
+
+                if wave.failure_rate() > self.max_failure_rate:
+                    print(f"ERROR : wave {name} failure rate crossed {self.max_failure_rate:.0%}, halting rollout..")
+                    self.halted = True
+                    if self.rollback:
+                        self.rollback_deployed(executor)
+                    break
+
+        return not self.halted
+
+    def deploy(self, device_dc, action, baseline=True):
+        """
+            Deploy action on single device, Baseline health verified before (unless baseline=False, roll back of
+            device not healthy) and after convergence
+        """
+        result = self._deploy(device_dc, action, baseline)
+        if self.audit is not None:
+            # nothing to verify on devices skipped (or) already as intended
+            verified = bool(result.convergence_time) if result.status not in ('skipped', 'unchanged') else None
+            self.audit.record('deploy', result.host_name, action, result.status, duration=result.deploy_time,
+                              verified=verified, detail=result.error)
+        return result
+
+    def _deploy(self, device_dc, action, baseline):
+        result = DeviceResult(device_dc.host_name)
+        build_snippets, _ = ACTIONS[action]
+        txn = None
+
+        try:
+            with self.pool.lease(device_dc) as device, rpc_priority('deployment'):
+                if baseline and not verify_baseline_health(device, self.health):
+                    result.status = 'skipped'
+                    result.error = 'not per expected Baseline before deployment'
+                    return result
+
+                start = time.monotonic()
+                with device.transaction(confirmed=True, confirm_timeout=self.confirm_timeout) as txn:
+                    for config_snippet in build_snippets(device, device_dc):
+                        txn.add(config_snippet)
+                    txn.verify = lambda: self._converged(device, result)
+
+                result.deploy_time = time.monotonic() - start
+                # device already holding the intended config is no change, nothing to roll back either
+                result.status = ('success' if txn.applied else 'unchanged') if txn.ok else 'failed'
+        except Exception as err:
+            result.status = 'failed'
+            result.error = repr(err)
+
+        # change may be left on the device even when failed (roll back of it failed, error after commit)
+        result.applied = txn is not None and txn.applied
+        return result
+
+    def _converged(self, device, result):
+        result.convergence_time = wait_for_convergence(device, self.convergence_timeout)
+        if result.convergence_time is None:
+            result.error = 'not per expected Baseline after deployment'
+            return False
+        return True
+
+    def rollback_deployed(self, executor):
+        """
+            Roll back devices whose change is left applied: deployed successfully and failed ones whose change wasn't
+            reverted on the device. Devices unchanged (already as intended) keep their config
+        """
+        _, rollback_action = ACTIONS[self.action]
+        devices = [self.device_index[result.host_name] for wave in self.results for result in wave.devices
+                   if result.applied]
+
+        print(f"LOG : rolling back {len(devices)} deployed devices with {rollback_action}..")
+        for result in executor.map(lambda device_dc: self.deploy(device_dc, rollback_action, baseline=False),
+                                   devices):
+            self.rolled_back.append(result)
+
+    def report(self):
+        print(f"\n{'wave':<8} {'device':<16} {'status':<10} {'deploy(s)':>10} {'converge(s)':>12}  error")
+        for wave in self.results:
+            for result in wave.devices:
+                convergence = f"{result.convergence_time:.1f}" if result.convergence_time else '-'
+                print(f"{wave.name:<8} {result.host_name:<16} {result.status:<10} {result.deploy_time:>10.1f} "
+                      f"{convergence:>12}  {result.error}")
+        for result in self.rolled_back:
+            print(f"{'rollback':<8} {result.host_name:<16} {result.status:<10} {result.deploy_time:>10.1f} "
+                  f"{'-':>12}  {result.error}")
+
+        total = sum(wave.elapsed for wave in self.results)
+        print(f"\nLOG : waves={len(self.results)} devices={sum(len(wave.devices) for wave in self.results)} "
+              f"elapsed={total:.1f}s halted={self.halted}")
 
 
 def main():
     """
         This is for Brownfield deployment which works as below,
             1) Based on required action like "ospf_enable", "ospf_disable" etc it execute relevant config (or) un-config
-                by using NETCONF
+                by using NETCONF on the devices from Single Source-of-Truth, many devices concurrently in waves
             2) This also ensures Baseline verifications before and after required action initiated to verify Topology is
-                in stable condition not impacted by Brownfield deployment changes
+                in stable condition not impacted by Brownfield deployment changes, rollout halts (and rolls back) when
+                too many devices of a wave fail
 
-            Note: This is expandable by adding more cases like "mpls_enable", "mpls_disable" etc
+            Note: This is expandable by adding more cases like "mpls_enable", "mpls_disable" etc to ACTIONS
     """
 
-    # flag to identify success/failure of Brownfield deployment changes
-    fail_flag = False
-
     # MySQL Database login credentials  taken through command line arguments for security reasons..
-    if len(sys.argv) != 3:
-        print(f"usage: {os.path.basename(__file__)} <database_username> <database_username>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('database_username')
+    parser.add_argument('database_password')
+    parser.add_argument('--action', default='ospf_enable', choices=sorted(ACTIONS))
+    parser.add_argument('--devices', default='R1', help="comma separated host names (or) 'all'")
+    parser.add_argument('--parallel', type=int, default=10)
+    parser.add_argument('--canary', type=int, default=1)
+    parser.add_argument('--waves', default='10,50,100', help="cumulative percentage of devices per wave")
+    parser.add_argument('--max-failure-rate', type=float, default=0.2)
+    parser.add_argument('--convergence-timeout', type=float, default=60)
+    parser.add_argument('--no-rollback', action='store_true')
+    parser.add_argument('--health-interval', type=float, default=30, help="seconds between health polls of device")
+    parser.add_argument('--health-parallel', type=int, default=32, help="devices health polled at a time")
+    args = parser.parse_args()
+    if args.convergence_timeout <= 0:
+        parser.error("--convergence-timeout must be positive")
+
+    # transaction / session pool messages of utils_library, ncclient itself only when something is wrong
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    logging.getLogger('ncclient').setLevel(logging.WARNING)
 
     # Connect to Database for Single Source of Truth
-    DB = Database(ip='localhost', username=sys.argv[1], password=sys.argv[2])
+    DB = Database(ip='localhost', username=args.database_username, password=args.database_password)
 
-    R1_DC = DB.fetch_by_device('R1')
-    # R2_DC = DB.fetch_by_device('R2')
+    # Bulk load SSOT into memory so that deployment reads IPAM data without further round trips
+    SSOT = SsotCache(DB)
+    SSOT.load()
 
     # Gracefully close the Database connection
     DB.close()
 
-    # Connect to Routers of topology
-    R1 = Device(ip=R1_DC.mgmt_ip, username=R1_DC.user_name, password=R1_DC.password)
-    # R2 = Device(ip=R2_DC.mgmt_ip, username=R2_DC.user_name, password=R2_DC.password)
-
-    # Verify the Baseline health of topology
-    if not verify_baseline_health(R1):
-        print("Topology devices not per expected Baselines..")
-        sys.exit(0)
-
-    action = 'ospf_enable'
-
-    match action:
-        case 'ospf_enable':
-            # Deploy OSPF on existing topology
-            if not R1.edit_config_ospf(process_id='10',
-                                router_id='1.1.1.1',
-                                network_ip='19.1.0.0', network_mask='0.0.0.255',
-                                area_id='0',
-                                action='enable'):
-                fail_flag = True
-
-        case 'ospf_disable':
-            # Remove OSPF from existing topology
-            if not R1.edit_config_ospf(process_id='10',
-                                router_id='1.1.1.1',
-                                network_ip='19.1.0.0', network_mask='0.0.0.255',
-                                area_id='0',
-                                action='disable'):
-                fail_flag = True
-
-        case 'xxx_enable':
-            # can be expanded easily adding more cases..
-            pass
+    # Outcome of every device written to audit table in batches by background thread over pooled connections
+    AUDIT = AuditWriter(Database.connection_pool('localhost', args.database_username,
+                                                 args.database_password).get_connection, AUDIT_SPILL_FILE)
+    AUDIT.start()
 
-    # Verify if Brownfield deployment changes went through Success (or) Failure
-    if fail_flag:
-        print("ERROR : --- --- --- --- BrownField Deployment attempt failed --- --- --- ---")
+    if args.devices == 'all':
+        devices = SSOT.devices()
     else:
-        print("LOG : --- --- --- --- BrownField Deployment attempt success --- --- --- ---")
+        devices = SSOT.get_many(args.devices.split(','))
+    if not devices:
+        print("ERROR : no devices to deploy found in Single Source-of-Truth")
+        AUDIT.close()
+        sys.exit(1)
 
-    # Verify the Baseline health of topology after convergence
-    time.sleep(7)
-    if not verify_baseline_health(R1):
-        print("ERROR : FAILED: Topology devices not per expected Baselines after Brownfield deployment changes..")
+    # Warm NETCONF session pool, the leased session serves deployment changes and convergence checks, second session
+    # per device for fleet health polls
+    POOL = DevicePool(max_per_device=2, max_sessions=args.parallel + args.health_parallel)
+
+    # Baseline health of the devices polled concurrently upfront, then kept fresh in background during rollout
+    HEALTH = FleetHealth(SSOT, POOL, interval=args.health_interval, max_parallel=args.health_parallel,
+                         host_names=[device_dc.host_name for device_dc in devices])
+    HEALTH.start()
+    print(f"LOG : fleet Baseline health {HEALTH.report()}")
+
+    rollout = Rollout(POOL, args.action, parallel=args.parallel, canary=args.canary,
+                      waves=[int(percent) for percent in args.waves.split(',')],
+                      max_failure_rate=args.max_failure_rate, convergence_timeout=args.convergence_timeout,
+                      rollback=not args.no_rollback, health=HEALTH, audit=AUDIT)
+
+    # Verify if Brownfield deployment changes went through Success (or) Failure
+    if rollout.run(devices):
+        print("LOG : --- --- --- --- BrownField Deployment attempt success --- --- --- ---")
     else:
-        print("LOG : SUCCESS: Topology devices as per expected Baselines after Brownfield deployment changes..")
+        print("ERROR : --- --- --- --- BrownField Deployment attempt failed --- --- --- ---")
+
+    rollout.report()
 
     # Gracefully close the Router NETCONF connections
-    R1.close()
-    # R2.close()
+    HEALTH.stop()
+    POOL.close()
+    print(f"LOG : NETCONF session pool {POOL.stats.report()}")
+    print(f"LOG : RPC scheduler {POOL.rpc_report()}")
+    AUDIT.close()
+    print(f"LOG : audit writer {AUDIT.stats.report()}")
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,40 +1,247 @@
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import yaml
 from jinja2 import Environment, FileSystemLoader
 
 
-def handle_yaml():
+GREENFIELD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GreenField')
+OUTPUT_DIR = os.path.join(GREENFIELD_DIR, 'DHCP_server_upload')
+
+# content hash of each device inputs + template of last run, so that unchanged devices are skipped
+MANIFEST_FILE = os.path.join(GREENFIELD_DIR, '.render_manifest.json')
+
+# below this many changed devices rendering in-process is quicker than starting process pool
+MIN_PARALLEL_DEVICES = 64
+
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def stream_devices(yaml_text):
+    """
+        Yield (device name, YAML source of the device) for each device of the `devices:` list, one at a time
+
+        Only YAML events are scanned (libyaml based when available), nothing is constructed so that unchanged devices
+        cost just a hash of their source. Device source is self-contained YAML (indentation preserved) which is
+        constructed with yaml.load only if device needs to be rendered, hence anchors/aliases across devices are not
+        supported
+    """
+    loader = YamlLoader(yaml_text)
+    try:
+        # StreamStart, DocumentStart and MappingStart of top level document
+        for _ in range(3):
+            loader.get_event()
+
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.get_event()
+            if not (isinstance(key, yaml.ScalarEvent) and key.value == 'devices'):
+                _skip_node(loader)
+                continue
+
+            loader.get_event()
+            while not loader.check_event(yaml.SequenceEndEvent):
+                start = loader.peek_event().start_mark
+                name, end = _scan_device(loader)
+                yield name, ' ' * start.column + yaml_text[start.index:end.index]
+            loader.get_event()
+    finally:
+        loader.dispose()
+
+
+def _skip_node(loader):
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return event.end_mark
+
+
+def _scan_device(loader):
+    # walk events of one device mapping, picking value of its top level `name` key on the way
+    name = None
+    depth = 0
+    expect_key = True
+    key = None
+    while True:
+        event = loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            raise ValueError(f"YAML aliases not supported within devices ({event.start_mark})")
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+            if depth == 1:
+                expect_key = True
+        elif depth == 1 and isinstance(event, yaml.ScalarEvent):
+            if expect_key:
+                key = event.value
+            elif key == 'name':
+                name = event.value
+            expect_key = not expect_key
+
+        if depth == 0:
+            return name, event.end_mark
+
+
+def load_template():
+    # Read Jinja template file
+    env = Environment(loader=FileSystemLoader(GREENFIELD_DIR),
+                      trim_blocks=True,
+                      lstrip_blocks=True)
+    return env.get_template('template.j2')
+
+
+def template_digest():
+    with open(os.path.join(GREENFIELD_DIR, 'template.j2'), 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def device_digest(device_source, template_hash):
+    """
+        Content hash of device inputs plus template, changes whenever rendered config would change
+    """
+    return hashlib.sha256(f'{template_hash}:{device_source}'.encode()).hexdigest()
+
+
+def write_atomic(path, content):
+    """
+        Write file through temporary file + rename, so that DHCP/TFTP server never serves half written config
+    """
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.tmp-', delete=False) as file:
+        file.write(content)
+        temp_path = file.name
+    os.chmod(temp_path, 0o644)
+
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+
+_template = None
+_template_hash = None
+
+
+def _init_worker():
+    # each worker process loads and compiles the Jinja template once
+    global _template
+    _template = load_template()
+
+
+def render_device(device_source):
+    """
+        Render CONFIG of single device from its YAML source and write it as "hostname-config" at the location
+        DHCP_server_upload/
+    """
+    if _template is None:
+        _init_worker()
+
+    device = yaml.load(device_source, Loader=YamlLoader)
+
+    write_atomic(os.path.join(OUTPUT_DIR, f'{device["name"]}-config'),
+                 _template.render(device=device["name"], interfaces=device["interfaces"],
+                                  logging_snmp_traps=device["logging_snmp_traps"],
+                                  snmp_enable_traps=device["snmp_enable_traps"],
+                                  netconf_yang_traps=device["netconf_yang_traps"],
+                                  bgp_asn=device["bgp_asn"], bgp_neighbors=device["bgp_neighbors"]))
+
+    return device["name"]
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def handle_yaml(yaml_file=os.path.join(GREENFIELD_DIR, 'devices.yaml'), workers=None, force=False, batch_size=1024):
     """
         This is for Greenfield deployment which works as below,
-            1) Takes input from YAML file for each of Router Configurations
+            1) Takes input from YAML file for each of Router Configurations, streamed one device at a time
             2) Generate individual Router config files as "hostname-config" at the folder DHCP_server_upload/ so that
                 these individual config files to be uploaded to DHCP (or) TFTP server based on Cisco (or) Juniper
                 workflow of ZTP/auto-install followed for Day-0 bring-up
+
+        Generation is incremental, devices whose inputs and template are unchanged since last run (content hash) are
+        skipped, changed ones are rendered in process pool and written atomically. Returns (rendered, skipped)
     """
+    global _template, _template_hash
+    template_hash = template_digest()
+    if _template_hash != template_hash:
+        # long-running process (automation daemon), template changed since compiled in-process
+        _template = None
+        _template_hash = template_hash
+
+    previous = {} if force else load_manifest()
+    manifest = {}
+    rendered = skipped = 0
+
+    executor = None
+    pending = []
+
+    def flush():
+        nonlocal executor, rendered
+        if not pending:
+            return
+        if executor is None and (len(pending) >= MIN_PARALLEL_DEVICES and workers != 1):
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        if executor is not None:
+            chunksize = max(1, len(pending) // ((workers or os.cpu_count()) * 4))
+            rendered += sum(1 for _ in executor.map(render_device, pending, chunksize=chunksize))
+        else:
+            rendered += sum(1 for _ in map(render_device, pending))
+        pending.clear()
 
     # Read YAML input file
-    with open("GreenField/devices.yaml") as file:
-        device_info = yaml.safe_load(file)
+    with open(yaml_file) as file:
+        yaml_text = file.read()
 
-    # Read Jinja template file
-    env = Environment(loader=FileSystemLoader('GreenField/'),
-                      trim_blocks=True,
-                      lstrip_blocks=True)
-    template = env.get_template('template.j2')
+    try:
+        # iterate over the devices described in yaml file and use jinja to render the configuration
+        for name, device_source in stream_devices(yaml_text):
+            digest = device_digest(device_source, template_hash)
+            manifest[name] = digest
+
+            if previous.get(name) == digest and os.path.exists(os.path.join(OUTPUT_DIR, f'{name}-config')):
+                skipped += 1
+                continue
+
+            pending.append(device_source)
+            if len(pending) >= batch_size:
+                flush()
+
+        flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    # iterate over the devices described in yaml file and use jinja to render the configuration
-    for device in device_info["devices"]:
-        # write new CONFIG files for each of Routers at the location DHCP_server_upload/
-        with open(f'GreenField/DHCP_server_upload/{device["name"]}-config', 'w') as file:
-            file.write(template.render(device=device["name"], interfaces=device["interfaces"],
-                                       logging_snmp_traps=device["logging_snmp_traps"],
-                                       snmp_enable_traps=device["snmp_enable_traps"],
-                                       netconf_yang_traps=device["netconf_yang_traps"],
-                                       bgp_asn=device["bgp_asn"], bgp_neighbors=device["bgp_neighbors"]))
+    write_atomic(MANIFEST_FILE, json.dumps(manifest, sort_keys=True))
 
-    print("LOG : SUCCESS: configuration files generated and please find at DHCP_server_upload/ directory..")
+    print(f"LOG : SUCCESS: configuration files generated ({rendered} rendered, {skipped} unchanged) and please find "
+          f"at DHCP_server_upload/ directory..")
+
+    return rendered, skipped
 
 
 if __name__ == "__main__":
-    # generate the CONFIG files of Router of Topology
-    handle_yaml()
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('yaml_file', nargs='?', default=os.path.join(GREENFIELD_DIR, 'devices.yaml'))
+    parser.add_argument('--workers', type=int, default=None, help="render processes (default: CPU count)")
+    parser.add_argument('--force', action='store_true', help="re-render all the devices")
+    args = parser.parse_args()
 
+    # generate the CONFIG files of Router of Topology
+    handle_yaml(args.yaml_file, workers=args.workers, force=args.force)
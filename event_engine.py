@@ -0,0 +1,234 @@
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from ncclient.transport.session import SessionListener, NotificationHandler
+from ncclient.xml_ import qualify, NETCONF_NOTIFICATION_NS
+
+from instrumentation import METRICS
+
+
+LOGGER = logging.getLogger('event_engine')
+
+NOTIFICATION_TAG = qualify('notification', NETCONF_NOTIFICATION_NS)
+
+
+class RawNotification:
+    """
+        Light-weight NETCONF notification as received on the session, XML kept as raw string so that nothing is
+        parsed before the handler decides it is interested (same attribute as ncclient Notification). received is
+        monotonic timestamp taken on the session thread, start of the healing pipeline latency
+    """
+    __slots__ = ('notification_xml', 'received')
+
+    def __init__(self, notification_xml, received=None):
+        self.notification_xml = notification_xml
+        self.received = received
+
+
+@dataclass
+class EngineStats:
+    """
+        Dataclass to handle throughput, backpressure and drop/overflow accounting of EventEngine
+    """
+    received: int = 0
+    processed: int = 0
+    failed: int = 0
+    dropped: int = 0
+    overflow: int = 0
+    backpressure_waits: int = 0
+    queue_high_watermark: int = 0
+
+    def report(self):
+        return (f"received={self.received} processed={self.processed} failed={self.failed} "
+                f"dropped={self.dropped} overflow={self.overflow} backpressure_waits={self.backpressure_waits} "
+                f"queue_high_watermark={self.queue_high_watermark}")
+
+
+class NotificationListener(SessionListener):
+    """
+        ncclient session listener handing every received notification of one device straight to EventEngine
+    """
+    def __init__(self, engine, source):
+        self.engine = engine
+        self.source = source
+
+    def callback(self, root, raw):
+        tag, _ = root
+        if tag == NOTIFICATION_TAG:
+            received = time.monotonic()
+            if self.engine.journal is not None:
+                self.engine.journal.append(self.source, received, raw)
+            self.engine.submit(self.source, RawNotification(raw, received))
+
+    def errback(self, ex):
+        LOGGER.error(f"NETCONF session of {self.source} failed : {ex}")
+
+
+class EventEngine:
+    """
+        asyncio based engine which multiplexes NETCONF notification streams of many devices in a single event loop
+
+        ncclient session (already one reader per SSH session) hands each notification to the loop, no thread per
+        device (or) per notification created. Notifications go to bounded work queue drained by fixed pool of workers
+        which runs the blocking handler (NETCONF RPCs, sleeps) on fixed size thread pool
+
+        Queue depth, active workers and accounting below are exported as METRICS gauges/counters
+
+        When the work queue is full the overflow policy applies,
+            'drop_oldest'   oldest queued notification dropped in favour of new one (accounted as overflow)
+            'drop_newest'   new notification dropped (accounted as dropped)
+            'block'         session reader waits for free slot, which stops reading socket so that TCP pushes back
+                            on the device (explicit backpressure)
+
+        JournalWriter (optional) records every notification as received, before any overflow policy applies
+    """
+    def __init__(self, handler, workers=10, queue_size=1000, overflow='drop_oldest', journal=None):
+        if overflow not in ('drop_oldest', 'drop_newest', 'block'):
+            raise ValueError(f"unknown overflow policy {overflow}")
+
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.journal = journal
+        self.stats = EngineStats()
+        self.active_workers = 0
+
+        self.loop = None
+        self.queue = None
+        self.stopping = None
+        self.drain = True
+        self.ready = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='EventWorker')
+        self.thread = threading.Thread(target=self._run, name='EventEngine', daemon=True)
+
+    def start(self):
+        METRICS.register_callback('event_engine_queue_depth', 'gauge', self.queue_depth,
+                                  "Notifications waiting in work queue")
+        METRICS.register_callback('event_engine_active_workers', 'gauge', lambda: self.active_workers,
+                                  "Workers running the handler")
+        METRICS.register_callback('event_engine_received_total', 'counter', lambda: self.stats.received,
+                                  "Notifications received")
+        METRICS.register_callback('event_engine_dropped_total', 'counter',
+                                  lambda: self.stats.dropped + self.stats.overflow,
+                                  "Notifications dropped as work queue was full")
+        METRICS.register_callback('event_engine_failed_total', 'counter', lambda: self.stats.failed,
+                                  "Notifications whose handler raised")
+
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self, drain=True):
+        """
+            Stop the engine, by default once already queued notifications are handled
+        """
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._request_stop, drain)
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def attach(self, session, source):
+        """
+            Route notifications of given ncclient session to the engine, returns listener to detach later
+
+            ncclient's default handler only feeds its unbounded queue for take_notification() so it is removed
+        """
+        default_handler = session.get_listener_instance(NotificationHandler)
+        if default_handler is not None:
+            session.remove_listener(default_handler)
+
+        listener = NotificationListener(self, source)
+        session.add_listener(listener)
+
+        return listener
+
+    @staticmethod
+    def detach(session, listener):
+        session.remove_listener(listener)
+
+    def submit(self, source, notification):
+        """
+            Thread safe entry for notifications, called from ncclient session threads
+        """
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        try:
+            if self.overflow == 'block':
+                asyncio.run_coroutine_threadsafe(self._put(source, notification), self.loop).result()
+            else:
+                self.loop.call_soon_threadsafe(self._put_nowait, source, notification)
+        except RuntimeError:
+            # event loop already closed as engine stopped
+            pass
+
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.stopping = asyncio.Event()
+
+        worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.ready.set()
+
+        await self.stopping.wait()
+        if self.drain:
+            await self.queue.join()
+
+        for task in worker_tasks:
+            task.cancel()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+
+    def _request_stop(self, drain):
+        self.drain = drain
+        self.stopping.set()
+
+    def _account_enqueue(self):
+        self.stats.queue_high_watermark = max(self.stats.queue_high_watermark, self.queue.qsize())
+
+    def _put_nowait(self, source, notification):
+        self.stats.received += 1
+        try:
+            self.queue.put_nowait((source, notification))
+        except asyncio.QueueFull:
+            if self.overflow == 'drop_newest':
+                self.stats.dropped += 1
+                return
+
+            # drop oldest queued notification to make room for the new one
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait((source, notification))
+            self.stats.overflow += 1
+
+        self._account_enqueue()
+
+    async def _put(self, source, notification):
+        self.stats.received += 1
+        if self.queue.full():
+            self.stats.backpressure_waits += 1
+        await self.queue.put((source, notification))
+        self._account_enqueue()
+
+    async def _worker(self):
+        while True:
+            source, notification = await self.queue.get()
+            self.active_workers += 1
+            try:
+                await self.loop.run_in_executor(self.executor, self.handler, source, notification)
+                self.stats.processed += 1
+            except Exception as err:
+                self.stats.failed += 1
+                LOGGER.error(f"notification handler failed for {source} : {err!r}")
+            finally:
+                self.active_workers -= 1
+                self.queue.task_done()
@@ -0,0 +1,277 @@
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import METRICS
+from utils_library import rpc_priority
+
+
+LOGGER = logging.getLogger('fleet_health')
+
+
+class DeviceHealth:
+    """
+        BGP peer states of one device as of its last poll, replaced (never mutated) on every poll so that readers
+        need no lock. error is set when the last poll failed, peers then are the ones last known
+    """
+    __slots__ = ('host_name', 'mgmt_ip', 'peers', 'polled_at', 'error', 'failures')
+
+    def __init__(self, host_name, mgmt_ip, peers, polled_at, error=None, failures=0):
+        self.host_name = host_name
+        self.mgmt_ip = mgmt_ip
+        self.peers = peers
+        self.polled_at = polled_at
+        self.error = error
+        self.failures = failures
+
+    @property
+    def healthy(self):
+        return self.error is None and bool(self.peers) and all(state == 'established'
+                                                               for state in self.peers.values())
+
+
+class FleetHealth:
+    """
+        Baseline health of every device in Single Source-of-Truth kept in memory, so that checking health of
+        thousands of routers is a dictionary read instead of thousands of blocking `<get>` RPCs
+
+        Each device is polled with one `<get>` of the whole BGP4-MIB peer table (all peers) on a session leased from
+        DevicePool, at most max_parallel devices at a time. Polls are spread uniformly over the interval and every
+        next poll is jittered (+/- jitter x interval) so that the fleet never polls in lock-step (thundering herd).
+        Devices added to (or) removed from SSOT are picked up once per interval
+
+        State older than stale_after seconds (default 3 intervals) counts as unknown. host_names (optional) limits
+        the fleet to these devices of SSOT
+
+        Usage:
+            FLEET = FleetHealth(SSOT, POOL, interval=30)
+            FLEET.start()
+            FLEET.healthy('R1')                 True / False / None (unknown)
+            verify_baseline_health(device, FLEET)
+    """
+    def __init__(self, ssot, pool, interval=30, jitter=0.2, max_parallel=32, stale_after=None, lease_timeout=5,
+                 host_names=None):
+        self.ssot = ssot
+        self.host_names = set(host_names) if host_names is not None else None
+        self.pool = pool
+        self.interval = interval
+        self.jitter = jitter
+        self.max_parallel = max_parallel
+        self.stale_after = stale_after if stale_after is not None else interval * 3
+        self.lease_timeout = lease_timeout
+
+        self.table = {}
+        self.by_mgmt_ip = {}
+        self.devices = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_parallel)
+        self.stopping = threading.Event()
+        self.random = random.Random()
+        self.sequence = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='FleetPoll')
+        self.thread = threading.Thread(target=self._run, name='FleetHealth', daemon=True)
+
+    def start(self, initial_sweep=True):
+        """
+            Start background polling, by default after polling whole fleet once so that the table is filled on return
+        """
+        METRICS.register_callback('fleet_devices_healthy', 'gauge', lambda: self.summary()['healthy'],
+                                  "Devices with all BGP peers established")
+        METRICS.register_callback('fleet_devices_unhealthy', 'gauge', lambda: self.summary()['unhealthy'],
+                                  "Devices with BGP peers not established (or) no peers")
+        METRICS.register_callback('fleet_devices_unreachable', 'gauge', lambda: self.summary()['unreachable'],
+                                  "Devices whose last poll failed")
+        METRICS.register_callback('fleet_devices_unknown', 'gauge', lambda: self.summary()['unknown'],
+                                  "Devices not polled yet (or) state stale")
+
+        self._sync_devices()
+        if initial_sweep:
+            self.poll_all()
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def set_host_names(self, host_names):
+        """
+            Limit fleet to these devices of SSOT from now on (None is all), newly added ones are polled from next
+            interval
+        """
+        self.host_names = set(host_names) if host_names is not None else None
+        self._sync_devices()
+
+    def poll_all(self, devices=None):
+        """
+            Poll given devices (default whole fleet) right now concurrently, returns once all are polled
+        """
+        devices = list(devices) if devices is not None else list(self.devices.values())
+        for _ in self.executor.map(self._poll_slot, devices):
+            pass
+
+    def _poll_slot(self, device_dc):
+        with self.slots:
+            self.poll(device_dc)
+
+    def poll(self, device_dc):
+        """
+            One `<get>` of all BGP peers of device into the table
+        """
+        with self.lock:
+            if device_dc.host_name in self.in_flight:
+                return
+            self.in_flight.add(device_dc.host_name)
+
+        start = time.monotonic()
+        peers, error = None, None
+        try:
+            with self.pool.lease(device_dc, timeout=self.lease_timeout) as device, rpc_priority('polling'):
+                peers = device.get_bgp_peers()
+        except TimeoutError:
+            # all sessions of device busy (or) poll didn't get its turn (deployment, healing..), try again next interval
+            with self.lock:
+                self.in_flight.discard(device_dc.host_name)
+            return
+        except Exception as err:
+            error = repr(err)
+        finally:
+            METRICS.observe('fleet_poll_seconds', time.monotonic() - start)
+
+        self._record(device_dc, peers, error)
+
+    def _record(self, device_dc, peers, error):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight.discard(device_dc.host_name)
+            previous = self.table.get(device_dc.host_name)
+            if error is None:
+                health = DeviceHealth(device_dc.host_name, device_dc.mgmt_ip, peers, now)
+            else:
+                health = DeviceHealth(device_dc.host_name, device_dc.mgmt_ip, previous.peers if previous else {},
+                                      now, error, (previous.failures if previous else 0) + 1)
+                METRICS.inc('fleet_poll_failures_total', device=device_dc.host_name)
+            self.table[device_dc.host_name] = health
+            self.by_mgmt_ip[device_dc.mgmt_ip] = health
+
+        if error is not None:
+            if previous is None or previous.error is None:
+                LOGGER.error(f"health poll of {device_dc.host_name} failed : {error}")
+        elif previous is not None:
+            for peer_ip, state in peers.items():
+                if previous.peers.get(peer_ip) != state:
+                    LOGGER.info(f"BGP peer {peer_ip} of {device_dc.host_name} {previous.peers.get(peer_ip)} -> "
+                                f"{state}")
+
+    def _jittered(self):
+        return self.interval * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _sync_devices(self):
+        devices = {device_dc.host_name: device_dc for device_dc in self.ssot.devices()
+                   if self.host_names is None or device_dc.host_name in self.host_names}
+        with self.lock:
+            for host_name in set(self.table) - set(devices):
+                health = self.table.pop(host_name)
+                self.by_mgmt_ip.pop(health.mgmt_ip, None)
+            self.devices = devices
+
+    def _run(self):
+        # first polls spread uniformly over interval, later ones each jittered
+        now = time.monotonic()
+        heap = [(now + self.random.uniform(0, self.interval), next(self.sequence), host_name)
+                for host_name in self.devices]
+        heapq.heapify(heap)
+        scheduled = {host_name for _, _, host_name in heap}
+        next_sync = now + self.interval
+
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            if now >= next_sync:
+                self._sync_devices()
+                for host_name in set(self.devices) - scheduled:
+                    heapq.heappush(heap, (now + self.random.uniform(0, self.interval), next(self.sequence),
+                                          host_name))
+                    scheduled.add(host_name)
+                next_sync = now + self.interval
+
+            if not heap or heap[0][0] > now:
+                due = heap[0][0] if heap else next_sync
+                self.stopping.wait(min(due, next_sync) - now)
+                continue
+
+            _, _, host_name = heapq.heappop(heap)
+            device_dc = self.devices.get(host_name)
+            if device_dc is None:
+                # removed from SSOT (or) fleet
+                scheduled.discard(host_name)
+                continue
+            heapq.heappush(heap, (now + self._jittered(), next(self.sequence), host_name))
+
+            # bounded parallelism, scheduler waits for free slot
+            while not self.slots.acquire(timeout=1):
+                if self.stopping.is_set():
+                    return
+            self.executor.submit(self._poll_release, device_dc)
+
+    def _poll_release(self, device_dc):
+        try:
+            self.poll(device_dc)
+        finally:
+            self.slots.release()
+
+    def get(self, host_name):
+        return self.table.get(host_name)
+
+    def _fresh(self, health, max_age):
+        if health is None:
+            return None
+        max_age = self.stale_after if max_age is None else max_age
+        return health if time.monotonic() - health.polled_at <= max_age else None
+
+    def healthy(self, host_name, max_age=None):
+        """
+            True/False as of last poll not older than max_age (default stale_after), None when unknown (or) stale
+        """
+        health = self._fresh(self.table.get(host_name), max_age)
+        return health.healthy if health is not None else None
+
+    def healthy_ip(self, mgmt_ip, max_age=None):
+        health = self._fresh(self.by_mgmt_ip.get(mgmt_ip), max_age)
+        return health.healthy if health is not None else None
+
+    def peer_state(self, host_name, peer_ip):
+        health = self.table.get(host_name)
+        return health.peers.get(peer_ip) if health is not None else None
+
+    def unhealthy(self):
+        """
+            Host names of devices known not healthy (incl. unreachable)
+        """
+        now = time.monotonic()
+        return sorted(health.host_name for health in list(self.table.values())
+                      if now - health.polled_at <= self.stale_after and not health.healthy)
+
+    def summary(self):
+        counts = {'healthy': 0, 'unhealthy': 0, 'unreachable': 0, 'unknown': 0}
+        now = time.monotonic()
+        table = self.table
+        for host_name in list(self.devices):
+            health = table.get(host_name)
+            if health is None or now - health.polled_at > self.stale_after:
+                counts['unknown'] += 1
+            elif health.error is not None:
+                counts['unreachable'] += 1
+            elif health.healthy:
+                counts['healthy'] += 1
+            else:
+                counts['unhealthy'] += 1
+        return counts
+
+    def report(self):
+        return ' '.join(f'{state}={count}' for state, count in self.summary().items())
@@ -0,0 +1,355 @@
+import sys
+import json
+import time
+import queue
+import bisect
+import logging
+import itertools
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging.handlers import QueueHandler, QueueListener
+
+
+# seconds, from sub-millisecond parsing up-to BGP convergence
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LOG_FORMAT = '%(asctime)s %(threadName)s %(levelname)s : %(message)s'
+
+
+class Histogram:
+    """
+        Cumulative-bucket latency histogram of one labelled series, as in Prometheus
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricFamily:
+    """
+        Metric name with its type, help and labelled series (or) callback giving the value at scrape time
+    """
+    __slots__ = ('name', 'kind', 'help', 'series', 'callback')
+
+    def __init__(self, name, kind, help_text='', callback=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.series = {}
+        self.callback = callback
+
+
+class MetricsRegistry:
+    """
+        In-process counters, gauges and histograms keyed by metric name and labels, rendered in Prometheus text format
+
+        Updates are dictionary operations under one lock, cheap enough for every notification. Gauges of other
+        components (queue depth, active workers) are callbacks evaluated only when scraped
+
+        Usage:
+            METRICS.inc('healing_rpc_errors_total', device='R1')
+            METRICS.observe('healing_stage_seconds', 0.002, device='R1', stage='parsed')
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def describe(self, name, kind, help_text):
+        with self.lock:
+            family = self.families.setdefault(name, MetricFamily(name, kind))
+            family.kind = kind
+            family.help = help_text
+
+    def register_callback(self, name, kind, callback, help_text=''):
+        """
+            Metric whose value is read from callback at scrape time, re-registering replaces the callback
+        """
+        with self.lock:
+            self.families[name] = MetricFamily(name, kind, help_text, callback)
+
+    def _family(self, name, kind):
+        # caller holds self.lock
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, kind)
+        return family
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._family(name, 'counter').series
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._family(name, 'gauge').series[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._family(name, 'histogram').series
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def value(self, name, **labels):
+        """
+            Current value of counter/gauge series (count of histogram series), None if not recorded yet
+        """
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                return None
+            if family.callback is not None:
+                return family.callback()
+            value = family.series.get(tuple(sorted(labels.items())))
+        return value.count if isinstance(value, Histogram) else value
+
+    def samples(self, name):
+        """
+            All series of counter/gauge as {labels dict items tuple: value}
+        """
+        with self.lock:
+            family = self.families.get(name)
+            return dict(family.series) if family is not None else {}
+
+    def snapshot(self):
+        """
+            Picklable copy of all metrics as [(name, kind, help, [(labels key, value)])], callbacks evaluated and
+            histograms as (bucket counts, sum, count), e.g. to send to another process
+        """
+        with self.lock:
+            families = [(family.name, family.kind, family.help, family.callback,
+                         [(key, (list(value.counts), value.sum, value.count) if isinstance(value, Histogram)
+                           else value) for key, value in family.series.items()])
+                        for family in self.families.values()]
+
+        snapshot = []
+        for name, kind, help_text, callback, series in families:
+            if callback is not None:
+                try:
+                    series = [((), callback())]
+                except Exception:
+                    continue
+            snapshot.append((name, kind, help_text, series))
+        return snapshot
+
+    def render(self, remote=()):
+        """
+            Prometheus text exposition format (version 0.0.4)
+
+            remote (optional) are (labels, snapshot) of other processes merged in, their series told apart by the
+            given labels e.g. ({'worker': '1'}, snapshot)
+        """
+        merged = {}
+        for name, kind, help_text, series in self.snapshot():
+            merged[name] = (kind, help_text, list(series))
+        for labels, snapshot in remote:
+            extra = tuple(labels.items())
+            for name, kind, help_text, series in snapshot:
+                family = merged.setdefault(name, (kind, help_text, []))
+                family[2].extend((tuple(sorted(key + extra)), value) for key, value in series)
+
+        lines = []
+        for name, (kind, help_text, series) in sorted(merged.items()):
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for key, value in sorted(series):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_labels(key)} {value}")
+                    continue
+
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(key)} {total}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in key) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class TraceBuffer:
+    """
+        Ring buffer of the latest pipeline stage events, oldest overwritten once full. Appending is a single
+        deque.append (thread safe, no lock) so tracing every notification costs next to nothing
+    """
+    def __init__(self, size=10000):
+        self.events = deque(maxlen=size)
+
+    def record(self, device, trace_id, stage, delta, elapsed):
+        self.events.append((time.time(), device, trace_id, stage, delta, elapsed))
+
+    def dump(self, file=None, device=None):
+        """
+            Write trace events as JSON lines (oldest first), optionally of one device only
+        """
+        file = file or sys.stdout
+        for timestamp, event_device, trace_id, stage, delta, elapsed in list(self.events):
+            if device is None or device == event_device:
+                file.write(json.dumps({'time': timestamp, 'device': event_device, 'trace': trace_id, 'stage': stage,
+                                       'delta': delta, 'elapsed': elapsed}) + '\n')
+
+    def __len__(self):
+        return len(self.events)
+
+
+# Registry and trace buffer shared by the whole process
+METRICS = MetricsRegistry()
+TRACE = TraceBuffer()
+
+METRICS.describe('healing_stage_seconds', 'histogram',
+                 "Seconds spent reaching each auto-healing stage since the previous one")
+METRICS.describe('healing_pipeline_seconds', 'histogram',
+                 "Seconds from notification received to heal verified")
+METRICS.describe('healing_events_total', 'counter', "Interested events parsed from notifications")
+METRICS.describe('healing_attempts_total', 'counter', "Auto-healing attempts by result")
+METRICS.describe('healing_rpc_errors_total', 'counter', "Failed remediation RPCs")
+METRICS.describe('rpc_queue_wait_seconds', 'histogram',
+                 "Seconds RPC waited for its turn on the device, by RPC priority class")
+
+_trace_ids = itertools.count(1)
+
+
+class PipelineTrace:
+    """
+        Monotonic timestamps of one notification going through the healing pipeline, every mark feeds stage latency
+        histogram (time since previous mark) and the trace ring buffer
+
+        Stages: queued (received -> worker picked it), parsed, correlated, rpc_sent, rpc_acked, verified
+    """
+    __slots__ = ('device', 'trace_id', 'started', 'last')
+
+    def __init__(self, device, started=None):
+        now = time.monotonic()
+        self.device = device
+        self.trace_id = next(_trace_ids)
+        self.started = started if started is not None else now
+        self.last = self.started
+
+    def mark(self, stage):
+        now = time.monotonic()
+        delta = now - self.last
+        self.last = now
+
+        METRICS.observe('healing_stage_seconds', delta, device=self.device, stage=stage)
+        TRACE.record(self.device, self.trace_id, stage, delta, now - self.started)
+
+        return delta
+
+    def finish(self, stage='verified'):
+        self.mark(stage)
+        METRICS.observe('healing_pipeline_seconds', self.last - self.started, device=self.device)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+        GET /metrics    Prometheus text format
+        GET /trace      trace ring buffer as JSON lines, ?device=R1 for one device only
+    """
+    registry = METRICS
+    trace = TRACE
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path == '/metrics':
+            body = self.registry.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/trace':
+            params = dict(item.partition('=')[::2] for item in query.split('&') if item)
+            lines = _Lines()
+            self.trace.dump(lines, params.get('device'))
+            body = ''.join(lines).encode()
+            content_type = 'application/x-ndjson'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a log line each
+        pass
+
+
+class _Lines(list):
+    def write(self, line):
+        self.append(line)
+
+
+class MetricsServer:
+    """
+        HTTP endpoint for Prometheus scraping and trace dump, served from a daemon thread
+
+        registry (optional, default METRICS) is anything with render() giving Prometheus text
+    """
+    def __init__(self, host='127.0.0.1', port=9108, registry=None):
+        handler = MetricsHandler
+        if registry is not None:
+            handler = type('MetricsHandler', (MetricsHandler,), {'registry': registry})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_queue_logging(level=logging.INFO, stream=None):
+    """
+        Non-blocking logging: callers only put records on unbounded queue, one listener thread formats and writes them
+        so that slow terminal (or) file never stalls event workers. Returns listener to stop() at exit (flushes)
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    # ncclient logs every RPC/session event at INFO, far too chatty under a notification storm
+    logging.getLogger('ncclient').setLevel(max(level, logging.WARNING))
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+    return listener
@@ -0,0 +1,307 @@
+import os
+import sys
+import mmap
+import time
+import zlib
+import queue
+import struct
+import logging
+import argparse
+import threading
+from dataclasses import dataclass
+
+from event_engine import RawNotification
+
+
+LOGGER = logging.getLogger('notification_journal')
+
+SEGMENT_SUFFIX = '.ncj'
+
+# segment header: magic, wall clock and monotonic time at segment open (maps record timestamps to wall clock)
+SEGMENT_MAGIC = b'NCJ1'
+SEGMENT_HEADER = struct.Struct('<4sdd')
+
+# record header: crc32 of rest of record, monotonic received time, flags, source length, payload length
+RECORD_HEADER = struct.Struct('<IdBHI')
+FLAG_ZLIB = 0x01
+
+# payloads compressed only when this long, short notifications don't gain from it
+COMPRESS_MIN_SIZE = 256
+
+_STOP = object()
+
+
+@dataclass
+class JournalStats:
+    """
+        Dataclass to handle accounting of JournalWriter
+    """
+    appended: int = 0
+    written: int = 0
+    dropped: int = 0
+    bytes: int = 0
+    segments: int = 0
+    fsyncs: int = 0
+
+    def report(self):
+        return (f"appended={self.appended} written={self.written} dropped={self.dropped} bytes={self.bytes} "
+                f"segments={self.segments} fsyncs={self.fsyncs}")
+
+
+class JournalWriter:
+    """
+        Append-only journal of raw NETCONF notifications as received, so that production storms can be replayed
+
+        Journal is a directory of segment files (00000001.ncj, ...), each at most segment_size bytes. Every record
+        holds source (device) name, monotonic received timestamp and notification XML (zlib compressed if worth it),
+        with crc32 so that torn tail of crashed writer is detected by reader. New segment is started on every start()
+        so existing segments are never written again
+
+        append() only puts on a bounded queue, called from session threads. One writer thread encodes and writes
+        records in batches and fsyncs at most every fsync_interval seconds. When writer can't keep up notifications
+        are dropped from journal (accounted), never delaying auto-healing
+
+        Usage:
+            JOURNAL = JournalWriter('Journal/')
+            JOURNAL.start()
+            ENGINE = EventEngine(handler=handle_notification, journal=JOURNAL)
+            ...
+            JOURNAL.close()
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_interval=0.5, batch_size=512,
+                 queue_size=100000):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.stats = JournalStats()
+
+        self.queue = queue.Queue(queue_size)
+        self.file = None
+        self.segment = None
+        self.sequence = 0
+        self.segment_bytes = 0
+        self.thread = threading.Thread(target=self._run, name='JournalWriter', daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = list_segments(self.directory)
+        self.sequence = int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)]) if segments else 0
+        self._open_segment()
+        self.thread.start()
+
+    def append(self, source, received, notification_xml):
+        """
+            Thread safe, non-blocking. Journal notification of source (device name) received at monotonic time
+        """
+        try:
+            self.queue.put_nowait((str(source), received if received is not None else time.monotonic(),
+                                   notification_xml))
+            self.stats.appended += 1
+        except queue.Full:
+            self.stats.dropped += 1
+
+    def close(self):
+        """
+            Write out queued notifications, fsync and close current segment
+        """
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def _open_segment(self):
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+
+        self.sequence += 1
+        self.segment = os.path.join(self.directory, f'{self.sequence:08d}{SEGMENT_SUFFIX}')
+        self.file = open(self.segment, 'xb')
+        self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, time.time(), time.monotonic()))
+        self.segment_bytes = SEGMENT_HEADER.size
+        self.stats.segments += 1
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.stats.fsyncs += 1
+
+    def _run(self):
+        last_sync = time.monotonic()
+        dirty = False
+        stopping = False
+        while not stopping:
+            # wait for records, but not beyond next due fsync of what is written already
+            try:
+                item = self.queue.get(timeout=self.fsync_interval if dirty else None)
+            except queue.Empty:
+                item = None
+
+            batch = []
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            try:
+                for source, received, notification_xml in batch:
+                    record = encode_record(source, received, notification_xml)
+                    if self.segment_bytes + len(record) > self.segment_size and \
+                            self.segment_bytes > SEGMENT_HEADER.size:
+                        self._open_segment()
+                        last_sync = time.monotonic()
+                    self.file.write(record)
+                    self.segment_bytes += len(record)
+                    self.stats.written += 1
+                    self.stats.bytes += len(record)
+                dirty = dirty or bool(batch)
+
+                now = time.monotonic()
+                if dirty and (stopping or now - last_sync >= self.fsync_interval):
+                    self._sync()
+                    last_sync = now
+                    dirty = False
+            except OSError as err:
+                self.stats.dropped += len(batch)
+                LOGGER.error(f"notification journal {self.segment} write failed : {err}")
+
+        self.file.close()
+        self.file = None
+
+
+def encode_record(source, received, notification_xml):
+    """
+        One journal record as bytes: header, source name, notification XML (compressed when long)
+    """
+    source = source.encode()
+    payload = notification_xml.encode() if isinstance(notification_xml, str) else notification_xml
+    flags = 0
+    if len(payload) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_ZLIB
+
+    body = RECORD_HEADER.pack(0, received, flags, len(source), len(payload))[4:] + source + payload
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def list_segments(directory):
+    """
+        Segment files of journal in write order
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if name.endswith(SEGMENT_SUFFIX)]
+
+
+def read_segment(path):
+    """
+        Yield (wall clock time, source, notification XML) of every record of segment, memory mapped so that big
+        segments are decoded record by record without reading them into memory. Stops at torn (or) corrupt tail
+    """
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            magic, wall_base, monotonic_base = SEGMENT_HEADER.unpack_from(view, 0)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError(f"{path} is not a notification journal segment")
+
+            offset = SEGMENT_HEADER.size
+            while offset + RECORD_HEADER.size <= size:
+                crc, received, flags, source_len, payload_len = RECORD_HEADER.unpack_from(view, offset)
+                end = offset + RECORD_HEADER.size + source_len + payload_len
+                if end > size or zlib.crc32(view[offset + 4:end]) != crc:
+                    LOGGER.warning(f"notification journal {path} truncated at offset {offset}")
+                    return
+
+                start = offset + RECORD_HEADER.size
+                source = view[start:start + source_len].decode()
+                payload = view[start + source_len:end]
+                if flags & FLAG_ZLIB:
+                    payload = zlib.decompress(payload)
+                yield wall_base + (received - monotonic_base), source, payload.decode()
+
+                offset = end
+
+
+def read_journal(directory, sources=None):
+    """
+        Yield (wall clock time, source, notification XML) of every record of the journal in order written,
+        optionally of given sources (names) only
+    """
+    for path in list_segments(directory):
+        for record in read_segment(path):
+            if sources is None or record[1] in sources:
+                yield record
+
+
+def replay(records, submit, speed=1.0):
+    """
+        Feed journal records to submit(source name, RawNotification) keeping their original spacing in time divided
+        by speed (2 = twice as fast), speed 0 as fast as possible. e.g. submit of EventEngine mapped to EventTrigger
+        of the recorded device, notifications get received timestamp of their replay
+
+        Returns number of notifications replayed
+    """
+    replayed = 0
+    start = first = None
+    for recorded, source, notification_xml in records:
+        if speed:
+            if first is None:
+                start, first = time.monotonic(), recorded
+            delay = start + (recorded - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        submit(source, RawNotification(notification_xml, time.monotonic()))
+        replayed += 1
+
+    return replayed
+
+
+def main():
+    """
+        Summary of journal (or) dump its notifications
+    """
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('directory')
+    parser.add_argument('--dump', action='store_true', help="print every notification")
+    parser.add_argument('--source', action='append', help="only notifications of this source (repeatable)")
+    args = parser.parse_args()
+
+    sources = set(args.source) if args.source else None
+    count = 0
+    per_source = {}
+    first = last = None
+    for recorded, source, notification_xml in read_journal(args.directory, sources):
+        if args.dump:
+            print(f"{recorded:.6f} {source} {notification_xml}")
+        count += 1
+        per_source[source] = per_source.get(source, 0) + 1
+        first = recorded if first is None else first
+        last = recorded
+
+    if not count:
+        print(f"LOG : no notifications in journal {args.directory}")
+        sys.exit(0)
+
+    print(f"LOG : {count} notifications of {len(per_source)} sources over {last - first:.1f}s "
+          f"in {len(list_segments(args.directory))} segments")
+    for source, source_count in sorted(per_source.items()):
+        print(f"LOG :   {source:<30} {source_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+import os
+import re
+import time
+import string
+import logging
+import threading
+from contextlib import nullcontext
+
+import yaml
+
+from utils_library import rpc_priority
+
+
+LOGGER = logging.getLogger('rule_engine')
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+WILDCARD = '*'
+
+
+def compile_field_template(template):
+    """
+        Precompile '{field}' style template into function of fields dict, plain '{field}' is a direct lookup and
+        non string values (numbers etc) are constants
+    """
+    if not isinstance(template, str):
+        return lambda fields: template
+    parsed = list(string.Formatter().parse(template))
+    names = [field_name for _, field_name, _, _ in parsed if field_name is not None]
+
+    if len(parsed) == 1 and parsed[0][0] == '' and names and not parsed[0][2] and not parsed[0][3]:
+        name = names[0]
+        return lambda fields: fields[name]
+    if not names:
+        return lambda fields: template
+    return lambda fields: template.format_map(fields)
+
+
+class RuleContext:
+    """
+        What a rule acts on for one event: monitored device, its SSOT record and the fleet InterfaceTable, shared
+        stores and the pipeline trace
+
+        Session for remediation RPCs is leased from pool lazily on first use and held till the rule is done, so that
+        action and its verification run on the same session
+    """
+    __slots__ = ('device', 'device_dc', 'event_store', 'pool', 'bgp_cache', 'trace', 'interfaces', 'acted_at',
+                 '_lease', '_heal_device')
+
+    def __init__(self, device, device_dc, event_store, pool=None, bgp_cache=None, trace=None, interfaces=None):
+        self.device = device
+        self.device_dc = device_dc
+        self.interfaces = interfaces
+        self.event_store = event_store
+        self.pool = pool
+        self.bgp_cache = bgp_cache
+        self.trace = trace
+        self.acted_at = None
+        self._lease = None
+        self._heal_device = None
+
+    def heal_device(self):
+        if self._heal_device is None:
+            self._lease = self.pool.lease(self.device_dc) if self.pool else nullcontext(self.device)
+            self._heal_device = self._lease.__enter__()
+        return self._heal_device
+
+    def release(self):
+        if self._lease is not None:
+            self._lease.__exit__(None, None, None)
+            self._lease = self._heal_device = None
+
+    def mark(self, stage):
+        if self.trace is not None:
+            self.trace.mark(stage)
+
+    def finish(self, stage='verified'):
+        if self.trace is not None:
+            self.trace.finish(stage)
+
+
+class TokenBucket:
+    """
+        Remediations allowed per device: `burst` at once, refilled at `rate` per second
+    """
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+        Stops remediation which keeps failing: opens after `threshold` consecutive failures, after cooldown one trial
+        remediation is let through (half-open) which closes it on success (or) opens it again on failure
+    """
+    __slots__ = ('failures', 'opened_at', 'trial')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self, cooldown, now):
+        if self.opened_at is None:
+            return True
+        if self.trial or now - self.opened_at < cooldown:
+            return False
+        self.trial = True
+        return True
+
+    def record(self, ok, threshold, now):
+        """
+            Account result of remediation, returns True in-case breaker got opened by it
+        """
+        self.trial = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return False
+
+        self.failures += 1
+        if self.failures >= threshold:
+            self.opened_at = now
+            return True
+        return False
+
+
+class RemediationGuard:
+    """
+        Keeps notification storms (link flaps etc) from multiplying remediation RPCs on the device under stress,
+            dedup           identical events of device within dedup_window seconds are handled once
+            single-flight   one remediation per (device, rule, target e.g. interface) at a time, triggers meanwhile
+                            attach to the one in flight instead of starting their own
+            rate limit      per device token bucket of remediations (burst, then `rate` per second)
+            circuit breaker per (device, rule, target) opened by consecutive failures, retried after cooldown
+
+        Shared by all rules of RuleEngine and kept across rule reloads
+    """
+    def __init__(self, dedup_window=1.0, rate=0.2, burst=3, failure_threshold=3, cooldown=300):
+        self.dedup_window = dedup_window
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+            Forget seen events, rate limits and circuit breakers and zero the stats
+        """
+        self.seen = {}
+        self.purged_at = time.monotonic()
+        self.flights = {}
+        self.buckets = {}
+        self.breakers = {}
+        self.stats = {'deduplicated': 0, 'coalesced': 0, 'rate_limited': 0, 'circuit_open': 0, 'circuits_opened': 0}
+
+    def duplicate(self, device, facility, msg_name, text):
+        """
+            True in-case the same event of device was seen within dedup window
+        """
+        if not self.dedup_window:
+            return False
+
+        key = (device, facility, msg_name, text)
+        now = time.monotonic()
+        with self.lock:
+            # expired events dropped once per window so that seen events can't grow unbounded
+            if now - self.purged_at >= self.dedup_window:
+                self.seen = {key: seen for key, seen in self.seen.items() if now - seen < self.dedup_window}
+                self.purged_at = now
+
+            seen = self.seen.get(key)
+            if seen is not None and now - seen < self.dedup_window:
+                self.stats['deduplicated'] += 1
+                return True
+            self.seen[key] = now
+            return False
+
+    def admit(self, device, key):
+        """
+            None in-case remediation of key on device may run now (caller must call done()), else the reason it
+            can't: 'coalesced', 'circuit_open' (or) 'rate_limited'
+        """
+        flight_key = (device, key)
+        now = time.monotonic()
+        with self.lock:
+            if flight_key in self.flights:
+                self.flights[flight_key] += 1
+                reason = 'coalesced'
+            elif flight_key in self.breakers and not self.breakers[flight_key].allow(self.cooldown, now):
+                reason = 'circuit_open'
+            elif not self.buckets.setdefault(device, TokenBucket(self.burst, now)).take(self.rate, self.burst, now):
+                reason = 'rate_limited'
+            else:
+                self.flights[flight_key] = 0
+                return None
+
+            self.stats[reason] += 1
+            return reason
+
+    def done(self, device, key, ok):
+        """
+            Remediation admitted earlier finished, ok None when it had nothing to do. Returns number of triggers
+            which attached to it
+        """
+        flight_key = (device, key)
+        with self.lock:
+            attached = self.flights.pop(flight_key, 0)
+            if ok is None:
+                return attached
+
+            breaker = self.breakers.get(flight_key)
+            if breaker is None:
+                if ok:
+                    return attached
+                breaker = self.breakers[flight_key] = CircuitBreaker()
+            if breaker.record(ok, self.failure_threshold, time.monotonic()):
+                self.stats['circuits_opened'] += 1
+                LOGGER.error(f"remediation {key[0]} of {device} failed {breaker.failures} times in a row, circuit "
+                             f"open for {self.cooldown}s")
+            if ok:
+                del self.breakers[flight_key]
+
+        return attached
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats, in_flight=len(self.flights),
+                         open_circuits=sum(1 for breaker in self.breakers.values() if breaker.opened_at is not None))
+        return ', '.join(f'{name}={value}' for name, value in stats.items())
+
+
+class Correlation:
+    """
+        Recorded event which must be seen within window seconds, its value bound to field `bind`
+    """
+    __slots__ = ('event', 'subject', 'within', 'bind')
+
+    def __init__(self, spec):
+        self.event = spec['event']
+        self.subject = compile_field_template(spec['subject'])
+        self.within = float(spec['within']) if spec.get('within') is not None else None
+        self.bind = spec.get('as', spec['event'].lower())
+
+
+class Rule:
+    """
+        One compiled remediation rule,
+            trigger     facility / msg_name of syslog event, '*' matches any
+            pattern     regex searched in message text, named groups become fields
+            record      event stored in EventStore for later correlation
+            correlate   events which must have been recorded within window, values bound to fields
+            action      remediation, name of registered action with its arguments
+            verify      check after successful action, name of registered check with its arguments
+            guard       whether action goes through RemediationGuard (default), single-flight keyed by action arguments
+    """
+    __slots__ = ('name', 'facility', 'msg_name', 'pattern', 'record', 'correlate', 'action', 'action_args',
+                 'verify', 'verify_args', 'guarded')
+
+    def __init__(self, spec, actions, checks):
+        self.name = spec.get('name')
+        if not self.name:
+            raise ValueError(f"rule without name : {spec}")
+
+        trigger = spec.get('trigger') or {}
+        self.facility = str(trigger.get('facility', WILDCARD))
+        self.msg_name = str(trigger.get('msg_name', WILDCARD))
+        if self.facility == WILDCARD and self.msg_name != WILDCARD:
+            raise ValueError(f"rule {self.name}: msg_name needs facility")
+
+        try:
+            self.pattern = re.compile(spec['pattern']) if spec.get('pattern') else None
+        except re.error as err:
+            raise ValueError(f"rule {self.name}: invalid pattern : {err}") from None
+
+        record = spec.get('record')
+        self.record = None
+        if record:
+            self.record = (record['event'], compile_field_template(record['subject']),
+                           compile_field_template(record.get('value', '{text}')))
+
+        self.correlate = tuple(Correlation(correlation) for correlation in spec.get('correlate') or ())
+
+        self.action, self.action_args = self._compile_call(spec.get('action'), actions, 'action')
+        self.verify, self.verify_args = self._compile_call(spec.get('verify'), checks, 'verify')
+        self.guarded = bool(spec.get('guard', True))
+
+    def _compile_call(self, spec, registry, kind):
+        if not spec:
+            return None, ()
+        if isinstance(spec, str):
+            spec = {'name': spec}
+
+        spec = dict(spec)
+        name = spec.pop('name', None)
+        if name not in registry:
+            raise ValueError(f"rule {self.name}: unknown {kind} {name}, expected one of {sorted(registry)}")
+
+        return registry[name], tuple((key, compile_field_template(value)) for key, value in spec.items())
+
+    def apply(self, context, fields, guard=None):
+        """
+            Run rule for an event whose trigger matched, returns None when rule doesn't apply (pattern, correlation),
+            has no action (or) action returned None i.e. nothing to heal, else outcome 'success', 'failed' (or) reason
+            of guard for not running it ('coalesced', 'circuit_open', 'rate_limited')
+        """
+        if self.pattern is not None:
+            match = self.pattern.search(fields['text'])
+            if match is None:
+                return None
+            fields.update(match.groupdict())
+
+        host_name = context.device_dc.host_name
+        if self.record is not None:
+            event, subject, value = self.record
+            context.event_store.record(host_name, event, subject(fields), value(fields))
+
+        for correlation in self.correlate:
+            value = context.event_store.latest(host_name, correlation.event, correlation.subject(fields),
+                                               within=correlation.within)
+            if value is None:
+                return None
+            fields[correlation.bind] = value
+        if self.correlate:
+            context.mark('correlated')
+
+        if self.action is None:
+            return None
+
+        arguments = {key: value(fields) for key, value in self.action_args}
+        key = None
+        if guard is not None and self.guarded:
+            key = (self.name,) + tuple(arguments.values())
+            reason = guard.admit(host_name, key)
+            if reason is not None:
+                return reason
+
+        ok = False
+        try:
+            # RPCs of heal go ahead of deployment pushes and polls queued on the device
+            context.acted_at = time.monotonic()
+            with rpc_priority('remediation'):
+                ok = self.action(context, fields, **arguments)
+            if ok and self.verify is not None:
+                with rpc_priority('verification'):
+                    ok = self.verify(context, fields, **{key: value(fields) for key, value in self.verify_args})
+                if ok:
+                    context.finish('verified')
+        except Exception as err:
+            # failure of one action (or) check is a failed attempt, never the end of dispatch of the other rules
+            LOGGER.error(f"rule {self.name} on {host_name} failed : {err!r}")
+            ok = False
+        finally:
+            context.release()
+            if key is not None:
+                guard.done(host_name, key, ok)
+
+        if ok is None:
+            return None
+        return 'success' if ok else 'failed'
+
+
+class RuleSet:
+    """
+        Rules compiled into dispatch table keyed by (facility, msg_name), each key holding in declaration order the
+        rules triggered by it incl. wildcard ones, so that finding rules of an event is one dict lookup
+    """
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+
+        names = [rule.name for rule in self.rules]
+        duplicates = {name for name in names if names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"duplicate rule names {sorted(duplicates)}")
+
+        keys = {(rule.facility, rule.msg_name) for rule in self.rules}
+        keys.update((facility, WILDCARD) for facility, _ in list(keys))
+        keys.add((WILDCARD, WILDCARD))
+
+        self.table = {key: tuple(rule for rule in self.rules if self._triggers(rule, *key)) for key in keys}
+        self.max_window = max((correlation.within or 0 for rule in self.rules for correlation in rule.correlate),
+                              default=0)
+        self.interest = self._interest()
+
+    @staticmethod
+    def _triggers(rule, facility, msg_name):
+        return (rule.facility in (facility, WILDCARD) and
+                (rule.msg_name == WILDCARD or (rule.msg_name == msg_name and msg_name != WILDCARD)))
+
+    def lookup(self, facility, msg_name):
+        table = self.table
+        rules = table.get((facility, msg_name))
+        if rules is None:
+            rules = table.get((facility, WILDCARD))
+            if rules is None:
+                rules = table[(WILDCARD, WILDCARD)]
+        return rules
+
+    def _interest(self):
+        # Events the rules are triggered by as facility -> msg names (None means all), None when any facility
+        interest = {}
+        for rule in self.rules:
+            if rule.facility == WILDCARD:
+                return None
+            if rule.msg_name == WILDCARD:
+                interest[rule.facility] = None
+            elif rule.facility not in interest or interest[rule.facility] is not None:
+                interest[rule.facility] = interest.get(rule.facility, frozenset()) | {rule.msg_name}
+        return interest
+
+
+class RuleEngine:
+    """
+        Loads remediation rules declared in YAML and dispatches events to them, actions and checks the rules name are
+        looked up in given registries (name -> function(context, fields, **arguments) returning True on success,
+        action may return None when there was nothing to heal). RemediationGuard (optional) dedups events and guards
+        the actions against storms
+
+        Rules file is hot reloaded: at most every check_interval seconds its modification is checked on dispatch and
+        new rule set compiled and swapped atomically, monitors keep running. Invalid file is logged and current rules
+        kept. Note subscription filter built from interest() at subscribe time is not changed by reload
+
+        Usage:
+            RULES = RuleEngine('Rules/healing_rules.yaml', ACTIONS, CHECKS)
+            RULES.dispatch('BGP', 'ADJCHANGE', 'neighbor 19.1.0.2 Down', context)
+    """
+    def __init__(self, path, actions, checks, check_interval=2, guard=None):
+        self.path = path
+        self.actions = actions
+        self.checks = checks
+        self.check_interval = check_interval
+        self.guard = guard
+
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = time.monotonic()
+        self.ruleset = self._load()
+
+    def _file_version(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        # version noted before reading so that a file changed meanwhile (or) invalid one is not retried till changed
+        self.version = self._file_version()
+        with open(self.path) as file:
+            spec = yaml.load(file, Loader=YamlLoader) or {}
+
+        return RuleSet(Rule(rule, self.actions, self.checks) for rule in spec.get('rules') or ())
+
+    def reload(self):
+        """
+            Compile rules file again and swap it in, returns False (current rules kept) in-case file is invalid
+        """
+        with self.lock:
+            return self._reload()
+
+    def _reload(self):
+        try:
+            ruleset = self._load()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, yaml.YAMLError) as err:
+            LOGGER.error(f"healing rules {self.path} not reloaded, keeping current rules : {err}")
+            return False
+
+        self.ruleset = ruleset
+        LOGGER.info(f"healing rules reloaded from {self.path} : {len(ruleset.rules)} rules")
+        return True
+
+    def current(self):
+        """
+            Current rule set, reloaded first in-case rules file changed (checked at most every check_interval)
+        """
+        now = time.monotonic()
+        if now - self.checked_at >= self.check_interval and self.lock.acquire(blocking=False):
+            try:
+                self.checked_at = now
+                try:
+                    changed = self._file_version() != self.version
+                except OSError:
+                    changed = False
+                if changed:
+                    self._reload()
+            finally:
+                self.lock.release()
+
+        return self.ruleset
+
+    def interest(self):
+        """
+            Events the current rules are triggered by, as parse_clog_notification / clog_subscription_filter interest
+        """
+        return self.current().interest
+
+    def dispatch(self, facility, msg_name, text, context):
+        """
+            Apply every rule triggered by the event, returns list of (rule name, outcome) of rules which acted, empty
+            for duplicate event
+        """
+        guard = self.guard
+        if guard is not None and guard.duplicate(context.device_dc.host_name, facility, msg_name, text):
+            return []
+
+        results = []
+        for rule in self.current().lookup(facility, msg_name):
+            fields = {'facility': facility, 'msg_name': msg_name, 'text': text,
+                      'device': context.device_dc.host_name}
+            result = rule.apply(context, fields, guard)
+            if result is not None:
+                results.append((rule.name, result))
+
+        return results
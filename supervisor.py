@@ -0,0 +1,505 @@
+import os
+import sys
+import time
+import queue
+import bisect
+import signal
+import hashlib
+import logging
+import argparse
+import threading
+import multiprocessing
+from functools import partial
+from dataclasses import asdict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils_library import Database, SsotCache, DevicePool, EventStore, clog_subscription_filter
+from event_engine import EventEngine
+from fleet_health import FleetHealth
+from auto_healing import EventTrigger, handle_notification, register_guard_metrics, RULES, GUARD, EVENT_STORE_TTL
+from instrumentation import METRICS, MetricsServer, start_queue_logging
+
+
+LOGGER = logging.getLogger('supervisor')
+
+# Prometheus scrape endpoint of supervisor, metrics of all the workers merged in with worker label
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Options of worker process, overridden per Supervisor by worker_options
+WORKER_OPTIONS = {
+    'stream': 'snmpevents',
+    'engine_workers': 10,
+    'queue_size': 1000,
+    'max_per_device': 4,
+    'max_sessions': 1000,
+    'port': 830,
+    'lease_timeout': 30,
+    'ssot_ttl': 300,
+    'health_interval': 30,
+    'health_parallel': 32,
+    'report_interval': 5,
+    'log_level': logging.INFO,
+}
+
+
+class HashRing:
+    """
+        Consistent hashing of device host names onto workers. Every worker is placed on the ring at `replicas`
+        virtual points so that devices spread evenly, and adding (or) removing a worker moves only the devices of
+        its share of the ring, the rest of the fleet stays on its worker (subscriptions and correlation state kept)
+
+        Usage:
+            RING = HashRing([0, 1, 2])
+            RING.node_for('R1')                 0 / 1 / 2
+            RING.assign(['R1', 'R2', 'R3'])     {0: ['R2'], 1: ['R1', 'R3'], 2: []}
+    """
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        # stable across processes and runs unlike hash() of str
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f'{node}#{replica}')
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def nodes(self):
+        return set(self.owners)
+
+    def node_for(self, key):
+        if not self.points:
+            return None
+        return self.owners[bisect.bisect(self.points, self._hash(key)) % len(self.points)]
+
+    def assign(self, keys):
+        """
+            {node: [keys]} of every node on the ring
+        """
+        assignment = {node: [] for node in self.nodes()}
+        for key in keys:
+            assignment[self.node_for(key)].append(key)
+        return assignment
+
+
+class ShardWorker:
+    """
+        Monitoring of the devices assigned to one worker process, everything as in auto_healing.main() but only for
+        its share of the fleet: EventTrigger per device on EventEngine of its own, correlation EventStore, remediation
+        guard and FleetHealth of its devices. Devices which couldn't be subscribed are retried on every tick
+    """
+    def __init__(self, worker_id, ssot, options):
+        self.worker_id = worker_id
+        self.ssot = ssot
+        self.options = options
+
+        self.pool = DevicePool(max_per_device=options['max_per_device'], max_sessions=options['max_sessions'],
+                               port=options['port'])
+        self.engine = EventEngine(handler=handle_notification, workers=options['engine_workers'],
+                                  queue_size=options['queue_size'], overflow='drop_oldest')
+        self.events = EventStore(ttl=max(EVENT_STORE_TTL, RULES.current().max_window))
+        self.health = FleetHealth(ssot, self.pool, interval=options['health_interval'],
+                                  max_parallel=options['health_parallel'], host_names=())
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='Subscribe')
+
+        self.wanted = set()
+        self.triggers = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        register_guard_metrics(GUARD)
+        self.engine.start()
+        self.health.start(initial_sweep=False)
+
+    def assign(self, host_names):
+        """
+            Monitor exactly these devices from now on
+        """
+        self.wanted = set(host_names)
+        self.health.set_host_names(self.wanted)
+
+        with self.lock:
+            removed = [self.triggers.pop(host_name) for host_name in set(self.triggers) - self.wanted]
+        for trigger in removed:
+            self._unmonitor(trigger)
+        if removed:
+            LOGGER.info(f"worker {self.worker_id} released {len(removed)} devices")
+
+        self.tick()
+
+    def tick(self):
+        """
+            Subscribe wanted devices not monitored yet (newly assigned (or) unreachable so far)
+        """
+        missing = sorted(self.wanted - set(self.triggers))
+        devices = self.ssot.get_many(missing)
+        if len(devices) < len(missing):
+            # assigned from newer SSOT than ours
+            try:
+                self.ssot.refresh()
+            except Exception as err:
+                LOGGER.error(f"worker {self.worker_id} SSOT refresh failed : {err}")
+            devices = self.ssot.get_many(missing)
+
+        added = sum(self.executor.map(self._monitor, devices))
+        if added:
+            LOGGER.info(f"worker {self.worker_id} monitoring {added} more devices, {len(self.triggers)} in total")
+
+    def _monitor(self, device_dc):
+        try:
+            device = self.pool.acquire(device_dc, timeout=self.options['lease_timeout'])
+        except Exception as err:
+            LOGGER.error(f"worker {self.worker_id} can't connect to {device_dc.host_name} : {err}")
+            return 0
+
+        trigger = EventTrigger(device, device_dc, self.options['stream'], self.engine, self.pool, self.ssot,
+                               clog_subscription_filter(RULES.interest()), self.events)
+        try:
+            trigger.start()
+        except Exception as err:
+            LOGGER.error(f"worker {self.worker_id} can't subscribe to {device_dc.host_name} : {err}")
+            self._unmonitor(trigger)
+            return 0
+
+        with self.lock:
+            # re-assigned meanwhile
+            keep = device_dc.host_name in self.wanted and device_dc.host_name not in self.triggers
+            if keep:
+                self.triggers[device_dc.host_name] = trigger
+        if not keep:
+            self._unmonitor(trigger)
+            return 0
+        return 1
+
+    def _unmonitor(self, trigger):
+        trigger.stop()
+        # session carries the subscription, closed instead of going back to pool as idle
+        try:
+            trigger.device.close()
+        except Exception:
+            pass
+        self.pool.release(trigger.device)
+
+    def report(self):
+        return {
+            'worker': self.worker_id,
+            'pid': os.getpid(),
+            'assigned': len(self.wanted),
+            'monitored': len(self.triggers),
+            'engine': asdict(self.engine.stats),
+            'health': self.health.summary(),
+            'metrics': METRICS.snapshot(),
+        }
+
+    def stop(self):
+        with self.lock:
+            triggers = list(self.triggers.values())
+            self.triggers.clear()
+        for trigger in triggers:
+            trigger.stop()
+        self.engine.stop(drain=False)
+        self.health.stop()
+        for trigger in triggers:
+            self._unmonitor(trigger)
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+
+def worker_main(worker_id, database_factory, commands, reports, options):
+    """
+        Entry of worker process. Takes commands ('assign', [host names]) (or) ('stop',) from supervisor and reports
+        its state every report_interval seconds, exits by itself when supervisor is gone
+    """
+    # Ctrl-C reaches whole process group, supervisor is the one stopping workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = start_queue_logging(options['log_level'])
+    parent = os.getppid()
+
+    ssot = SsotCache(database_factory(), ttl=options['ssot_ttl'])
+    ssot.load()
+
+    shard = ShardWorker(worker_id, ssot, options)
+    shard.start()
+    reports.put(shard.report())
+    try:
+        while os.getppid() == parent:
+            try:
+                command = commands.get(timeout=options['report_interval'])
+            except queue.Empty:
+                shard.tick()
+            else:
+                if command[0] == 'stop':
+                    break
+                if command[0] == 'assign':
+                    shard.assign(command[1])
+            reports.put(shard.report())
+    finally:
+        shard.stop()
+        reports.put(shard.report())
+        log_listener.stop()
+
+
+class WorkerHandle:
+    """
+        Supervisor side of one worker process
+    """
+    __slots__ = ('worker_id', 'process', 'commands', 'started', 'restart_at', 'restarts', 'assigned')
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.commands = None
+        self.started = None
+        self.restart_at = 0.0
+        self.restarts = 0
+        self.assigned = None
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    """
+        Splits monitored devices across worker processes by consistent hashing (HashRing) so that notification
+        parsing and correlation run on as many cores as workers instead of one GIL. Each worker owns NETCONF
+        subscriptions, correlation state and health polling of its devices (ShardWorker)
+
+        Supervisor checks every check_interval seconds whether workers are alive and which devices are in SSOT.
+        Devices of died worker are re-assigned to remaining ones at once, worker is re-spawned after restart_delay
+        and takes its share back. Devices added to (or) removed from SSOT are assigned on the next check. A device
+        moved between workers may be monitored by both for a moment, remediation is idempotent (restores intended
+        config) so it is safe
+
+        Workers report engine stats, health summary and metrics snapshot every report_interval seconds, aggregated
+        by health(), report() and render() (all the workers' metrics with worker label, for MetricsServer)
+
+        database_factory is called in every process for its own Database (or) stand-in, must be picklable as
+        workers are spawned (not forked, no inherited threads and connections)
+
+        Usage:
+            SUPERVISOR = Supervisor(partial(Database, 'localhost', username, password), workers=4)
+            SUPERVISOR.start()
+            SUPERVISOR.report()
+            SUPERVISOR.stop()
+    """
+    def __init__(self, database_factory, workers=None, replicas=128, check_interval=2, restart_delay=5,
+                 worker_options=None):
+        self.database_factory = database_factory
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.options = dict(WORKER_OPTIONS, **(worker_options or {}))
+
+        self.context = multiprocessing.get_context('spawn')
+        self.reports = self.context.Queue()
+        self.handles = {worker_id: WorkerHandle(worker_id) for worker_id in range(workers or os.cpu_count() or 1)}
+        self.ring = HashRing(replicas=replicas)
+        self.latest = {}
+        self.database = None
+        self.ssot = None
+        self.moved = 0
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.check_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='Supervisor', daemon=True)
+
+    def start(self):
+        self.database = self.database_factory()
+        # same SSOT freshness as the workers, worker_options ssot_ttl
+        self.ssot = SsotCache(self.database, ttl=self.options['ssot_ttl'])
+        self.ssot.load()
+
+        METRICS.register_callback('supervisor_workers_alive', 'gauge',
+                                  lambda: sum(handle.alive() for handle in self.handles.values()),
+                                  "Worker processes alive")
+        METRICS.register_callback('supervisor_worker_restarts_total', 'counter',
+                                  lambda: sum(handle.restarts for handle in self.handles.values()),
+                                  "Worker processes re-spawned after they died")
+        METRICS.register_callback('supervisor_devices_moved_total', 'counter', lambda: self.moved,
+                                  "Devices re-assigned to other worker")
+
+        for handle in self.handles.values():
+            self._spawn(handle)
+        self._rebalance()
+        self.thread.start()
+
+    def stop(self, timeout=30):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        for handle in self.handles.values():
+            if handle.alive():
+                handle.commands.put(('stop',))
+        deadline = time.monotonic() + timeout
+        for handle in self.handles.values():
+            if handle.process is not None:
+                handle.process.join(max(0, deadline - time.monotonic()))
+                if handle.process.is_alive():
+                    LOGGER.error(f"worker {handle.worker_id} not stopped in {timeout}s, terminating")
+                    handle.process.terminate()
+                    handle.process.join()
+        self._collect()
+
+        if self.database is not None:
+            self.database.close()
+
+    def refresh(self):
+        """
+            Re-read SSOT and re-assign devices right away, e.g. on SIGHUP
+        """
+        with self.check_lock:
+            self.ssot.refresh()
+            self._rebalance()
+
+    def _spawn(self, handle):
+        handle.commands = self.context.Queue()
+        handle.process = self.context.Process(target=worker_main, name=f'worker-{handle.worker_id}', daemon=True,
+                                              args=(handle.worker_id, self.database_factory, handle.commands,
+                                                    self.reports, self.options))
+        handle.process.start()
+        handle.started = time.monotonic()
+        handle.assigned = None
+        self.ring.add(handle.worker_id)
+        LOGGER.info(f"worker {handle.worker_id} started, pid {handle.process.pid}")
+
+    def _run(self):
+        while not self.stopping.wait(self.check_interval):
+            try:
+                self._collect()
+                with self.check_lock:
+                    self._check_workers()
+                    self._rebalance()
+            except Exception as err:
+                LOGGER.error(f"supervisor check failed : {err!r}")
+
+    def _collect(self):
+        while True:
+            try:
+                report = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.latest[report['worker']] = report
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for handle in self.handles.values():
+            if handle.process is not None and not handle.process.is_alive():
+                LOGGER.error(f"worker {handle.worker_id} (pid {handle.process.pid}) died with exit code "
+                             f"{handle.process.exitcode}, re-assigning its devices")
+                self.ring.remove(handle.worker_id)
+                handle.process = None
+                handle.restart_at = now + self.restart_delay
+                with self.lock:
+                    self.latest.pop(handle.worker_id, None)
+            elif handle.process is None and now >= handle.restart_at:
+                handle.restarts += 1
+                self._spawn(handle)
+
+    def _rebalance(self):
+        host_names = sorted(device_dc.host_name for device_dc in self.ssot.devices())
+        assignment = self.ring.assign(host_names)
+        if host_names and not assignment:
+            LOGGER.error(f"no worker alive, {len(host_names)} devices not monitored")
+            return
+
+        for worker_id, worker_hosts in assignment.items():
+            handle = self.handles[worker_id]
+            wanted = frozenset(worker_hosts)
+            if handle.assigned == wanted:
+                continue
+            if handle.assigned is not None:
+                self.moved += len(wanted - handle.assigned)
+            handle.commands.put(('assign', sorted(wanted)))
+            handle.assigned = wanted
+            LOGGER.info(f"worker {worker_id} assigned {len(wanted)} devices")
+
+    def health(self):
+        """
+            Fleet health summed over the workers, as FleetHealth.summary()
+        """
+        totals = {'healthy': 0, 'unhealthy': 0, 'unreachable': 0, 'unknown': 0}
+        with self.lock:
+            reports = list(self.latest.values())
+        for report in reports:
+            for state, count in report['health'].items():
+                totals[state] += count
+        return totals
+
+    def report(self):
+        with self.lock:
+            reports = list(self.latest.values())
+        processed = sum(report['engine']['processed'] for report in reports)
+        dropped = sum(report['engine']['dropped'] + report['engine']['overflow'] for report in reports)
+        monitored = sum(report['monitored'] for report in reports)
+        health = ' '.join(f'{state}={count}' for state, count in self.health().items())
+        return (f"workers={sum(handle.alive() for handle in self.handles.values())}/{len(self.handles)} "
+                f"devices={len(self.ssot.devices())} monitored={monitored} processed={processed} dropped={dropped} "
+                f"restarts={sum(handle.restarts for handle in self.handles.values())} moved={self.moved} {health}")
+
+    def render(self):
+        """
+            Prometheus text of supervisor and all the workers (worker label)
+        """
+        with self.lock:
+            reports = list(self.latest.values())
+        return METRICS.render([({'worker': str(report['worker'])}, report['metrics']) for report in reports])
+
+
+def main():
+    """
+        Auto-healing of whole fleet of Single Source-of-Truth across worker processes (default one per core),
+        each monitoring its share of devices as auto_healing.main() does for R1. SIGHUP re-reads SSOT right away
+    """
+
+    # MySQL Database login credentials  taken through command line arguments for security reasons..
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+    parser.add_argument('database_username')
+    parser.add_argument('database_password')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--engine-workers', type=int, default=10, help="EventEngine workers per process")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT)
+    args = parser.parse_args()
+
+    LOG_LISTENER = start_queue_logging()
+
+    SUPERVISOR = Supervisor(partial(Database, 'localhost', args.database_username, args.database_password),
+                            workers=args.workers, worker_options={'engine_workers': args.engine_workers})
+    SUPERVISOR.start()
+
+    # Metrics of all the workers served from one endpoint
+    METRICS_SERVER = MetricsServer(METRICS_HOST, args.metrics_port, registry=SUPERVISOR)
+    METRICS_SERVER.start()
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: SUPERVISOR.refresh())
+
+    try:
+        while True:
+            time.sleep(60)
+            LOGGER.info(f"supervisor {SUPERVISOR.report()}")
+    except KeyboardInterrupt:
+        LOGGER.info("Stopping workers...")
+        SUPERVISOR.stop()
+        LOGGER.info(f"supervisor {SUPERVISOR.report()}")
+
+    METRICS_SERVER.stop()
+    LOG_LISTENER.stop()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,43 @@
+import os
+import sys
 import threading
+import time
 import re
-from dataclasses import dataclass
+import string
+import socket
+import bisect
+import functools
+import itertools
+import copy
+import logging
+from array import array
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
 
 import mysql.connector
-import xmltodict
+import mysql.connector.pooling
+from lxml import etree
 from ncclient import manager, xml_
+from ncclient.transport.session import SessionListener
+from ncclient.operations import RPCError
+
+from instrumentation import METRICS
+
+
+LOGGER = logging.getLogger('utils_library')
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Templates')
+
+# clogMessageGenerated (syslog) events auto-healing acts on: facility -> interested message names (None means all)
+CLOG_NS = 'urn:ietf:params:xml:ns:yang:smiv2:CISCO-SYSLOG-MIB'
+CLOG_EVENTS = {'BGP': None, 'IP': frozenset({'DUPADDR'}), 'SYS': frozenset({'CONFIG_I'})}
+
+BGP4_MIB_NS = 'urn:ietf:params:xml:ns:yang:smiv2:BGP4-MIB'
+
+# key leaves of YANG list entries used while merging config snippets
+CONFIG_LIST_KEYS = frozenset({'name', 'id', 'ip'})
 
 
 @dataclass
@@ -24,6 +57,257 @@ class DeviceData:
     GigabitEthernet4_mask: str
 
 
+class CompiledTemplate:
+    """
+        NETCONF payload template precompiled once into a format plan i.e. literal chunks and substitution slots so
+        that rendering is a single join without re-parsing the format string
+    """
+    __slots__ = ('name', 'plan', 'fields')
+
+    def __init__(self, name, source):
+        self.name = name
+
+        plan = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(source):
+            if format_spec or conversion:
+                raise ValueError(f"template {name}: format spec/conversion not supported for slot {field_name}")
+            if field_name is not None and not field_name.isidentifier():
+                raise ValueError(f"template {name}: invalid substitution slot '{{{field_name}}}'")
+            plan.append(literal)
+            plan.append(field_name)
+
+        self.plan = tuple(plan)
+        self.fields = frozenset(field for field in plan[1::2] if field is not None)
+
+        # validate template renders into well-formed XML
+        try:
+            ET.fromstring(self.render(dict.fromkeys(self.fields, '')))
+        except ET.ParseError as err:
+            raise ValueError(f"template {name}: not well-formed XML : {err}") from None
+
+    def render(self, variables):
+        missing = self.fields.difference(variables)
+        if missing:
+            raise KeyError(f"template {self.name}: missing variables {sorted(missing)}")
+
+        plan = self.plan
+        return ''.join([chunk if index % 2 == 0 else ('' if chunk is None else str(variables[chunk]))
+                        for index, chunk in enumerate(plan)])
+
+
+class TemplateRegistry:
+    """
+        Loads, validates and precompiles every Templates/*.xml once at startup so that building NETCONF payloads on hot
+        path (auto-healing) doesn't read from disk. Rendered payloads for identical variables are memoized with LRU
+        eviction
+
+        Usage:
+            TEMPLATES.render('interface_config', mg_1_groups_0='2', ip_address='19.1.0.1', mask_1='255.255.255.0')
+    """
+    def __init__(self, directory=TEMPLATES_DIR, cache_size=1024):
+        self.directory = directory
+        self.templates = {}
+
+        for file_name in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(file_name)
+            if extension == '.xml':
+                with open(os.path.join(directory, file_name), 'r') as file:
+                    self.templates[name] = CompiledTemplate(name, file.read())
+
+        self._render_cached = functools.lru_cache(maxsize=cache_size)(self._render_items)
+
+    def render(self, name, **variables):
+        return self._render_cached(name, tuple(sorted(variables.items())))
+
+    def render_uncached(self, name, **variables):
+        return self.templates[name].render(variables)
+
+    def _render_items(self, name, items):
+        return self.templates[name].render(dict(items))
+
+    def cache_info(self):
+        return self._render_cached.cache_info()
+
+
+# Templates loaded once at startup
+TEMPLATES = TemplateRegistry()
+
+
+# RPC classes of per-device RPC scheduler in order of priority, RPCs outside of rpc_priority() are 'deployment'
+RPC_CLASSES = ('remediation', 'verification', 'deployment', 'polling')
+DEFAULT_RPC_CLASS = 'deployment'
+
+# RPCs of class at a time per device (None is up-to one per session), so that bulk work never holds all sessions
+RPC_CLASS_LIMITS = {'remediation': None, 'verification': None, 'deployment': 1, 'polling': 1}
+
+# seconds RPC of class may wait for its turn before failing with RpcDeadlineExceeded
+RPC_CLASS_DEADLINES = {'remediation': 30, 'verification': 30, 'deployment': 300, 'polling': 10}
+
+_RPC_CONTEXT = threading.local()
+
+
+class RpcDeadlineExceeded(TimeoutError):
+    """
+        RPC didn't get its turn on the device before its deadline
+    """
+
+
+@contextmanager
+def rpc_priority(rpc_class, deadline=None):
+    """
+        RPCs made by this thread within the block are scheduled as rpc_class, with deadline (optional) all of them
+        must get their turn within deadline seconds from now. Nested block keeps higher priority (and earlier
+        deadline) of the outer one, so that e.g. a poll made while healing still goes as remediation
+
+        Usage:
+            with rpc_priority('remediation'):
+                device.edit_config_interface(...)
+    """
+    if rpc_class not in RPC_CLASSES:
+        raise ValueError(f"unknown RPC class {rpc_class}")
+
+    outer = getattr(_RPC_CONTEXT, 'current', None)
+    absolute = time.monotonic() + deadline if deadline is not None else None
+    if outer is not None:
+        if RPC_CLASSES.index(outer[0]) < RPC_CLASSES.index(rpc_class):
+            rpc_class = outer[0]
+        if outer[1] is not None and (absolute is None or outer[1] < absolute):
+            absolute = outer[1]
+
+    _RPC_CONTEXT.current = (rpc_class, absolute)
+    try:
+        yield
+    finally:
+        _RPC_CONTEXT.current = outer
+
+
+def current_rpc_priority():
+    """
+        (RPC class, absolute monotonic deadline (or) None) of this thread
+    """
+    current = getattr(_RPC_CONTEXT, 'current', None)
+    return current if current is not None else (DEFAULT_RPC_CLASS, None)
+
+
+@dataclass
+class RpcClassStats:
+    """
+        Dataclass to handle queue wait accounting of one RPC class of RpcScheduler
+    """
+    rpcs: int = 0
+    queued: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    expired: int = 0
+
+    def merge(self, other):
+        self.rpcs += other.rpcs
+        self.queued += other.queued
+        self.wait_total += other.wait_total
+        self.wait_max = max(self.wait_max, other.wait_max)
+        self.expired += other.expired
+
+    def report(self):
+        wait_avg = self.wait_total / self.rpcs * 1000 if self.rpcs else 0.0
+        return (f"rpcs={self.rpcs} queued={self.queued} wait_avg={wait_avg:.1f}ms "
+                f"wait_max={self.wait_max * 1000:.1f}ms expired={self.expired}")
+
+
+class RpcScheduler:
+    """
+        Orders RPCs of all the sessions of one device (DevicePool hands the same scheduler to every Device of it) so
+        that remediation is never stuck behind bulk config pushes (or) health polls
+
+        Every RPC of Device takes a turn first: one RPC at a time per session, at most RPC_CLASS_LIMITS RPCs of a
+        class at a time on the device, and of the waiting RPCs the one of highest priority class goes first (FIFO
+        within class). An RPC not getting its turn before its deadline fails with RpcDeadlineExceeded. RPCs already
+        sent are never interrupted, thread holding the turn of session (transaction) re-enters it freely
+    """
+    def __init__(self, name, limits=None, deadlines=None):
+        self.name = name
+        self.limits = dict(RPC_CLASS_LIMITS, **(limits or {}))
+        self.deadlines = dict(RPC_CLASS_DEADLINES, **(deadlines or {}))
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.busy = {}
+        self.in_flight = dict.fromkeys(RPC_CLASSES, 0)
+        self.sequence = itertools.count()
+        self.stats = {rpc_class: RpcClassStats() for rpc_class in RPC_CLASSES}
+
+    @contextmanager
+    def turn(self, session):
+        """
+            Context manager held while RPC(s) are sent on session (Device), scheduled as RPC class of this thread
+        """
+        key = id(session)
+        if self.busy.get(key) == threading.get_ident():
+            yield
+            return
+
+        rpc_class = self._acquire(key)
+        try:
+            yield
+        finally:
+            with self.condition:
+                del self.busy[key]
+                self.in_flight[rpc_class] -= 1
+                self.condition.notify_all()
+
+    def _acquire(self, key):
+        rpc_class, deadline = current_rpc_priority()
+        start = time.monotonic()
+        if self.deadlines.get(rpc_class) is not None:
+            class_deadline = start + self.deadlines[rpc_class]
+            deadline = class_deadline if deadline is None else min(deadline, class_deadline)
+
+        entry = (RPC_CLASSES.index(rpc_class), next(self.sequence), key, rpc_class)
+        stats = self.stats[rpc_class]
+        with self.condition:
+            bisect.insort(self.waiting, entry)
+            try:
+                if not self._first_eligible(entry):
+                    stats.queued += 1
+                while not self._first_eligible(entry):
+                    timeout = deadline - time.monotonic() if deadline is not None else None
+                    if timeout is not None and timeout <= 0:
+                        stats.expired += 1
+                        raise RpcDeadlineExceeded(f"{rpc_class} RPC on {self.name} didn't get its turn in "
+                                                  f"{time.monotonic() - start:.1f}s")
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting.remove(entry)
+                # whoever is next (other session (or) class) re-checks
+                self.condition.notify_all()
+
+            self.busy[key] = threading.get_ident()
+            self.in_flight[rpc_class] += 1
+
+            wait = time.monotonic() - start
+            stats.rpcs += 1
+            stats.wait_total += wait
+            stats.wait_max = max(stats.wait_max, wait)
+
+        METRICS.observe('rpc_queue_wait_seconds', wait, device=self.name, rpc_class=rpc_class)
+        return rpc_class
+
+    def _eligible(self, entry):
+        _, _, key, rpc_class = entry
+        limit = self.limits[rpc_class]
+        return key not in self.busy and (limit is None or self.in_flight[rpc_class] < limit)
+
+    def _first_eligible(self, entry):
+        # caller holds self.condition.. waiters blocked by busy session (or) class limit don't hold up others
+        for waiting in self.waiting:
+            if self._eligible(waiting):
+                return waiting is entry
+        return False
+
+    def report(self):
+        with self.condition:
+            return ' | '.join(f"{rpc_class} {stats.report()}" for rpc_class, stats in self.stats.items())
+
+
 class Device:
     """
         Handle Device specific like connection, config, operational
@@ -31,78 +315,122 @@ class Device:
         Note: when need to Scale up for multiple scenarios like BGP, OSPF, MPLS it can be easily
         done through Inheritance
     """
-    def __init__(self, ip, username, password):
+    def __init__(self, ip, username, password, keepalive=None, snapshots=None, port=830, scheduler=None):
         self.ip = ip
         self.username = username
         self.password = password
 
-        self.nc_port = 830
+        self.nc_port = port
         self.nc_dev_type = 'iosxe'
+        self.keepalive = keepalive
+        self.nc_con = None
+
+        # running config snapshots, shared by all sessions of the device when handed out by DevicePool
+        self.snapshots = snapshots if snapshots is not None else ConfigSnapshots()
+        # RPC ordering by priority class, shared by all sessions of the device when handed out by DevicePool
+        self.scheduler = scheduler if scheduler is not None else RpcScheduler(ip)
+        self.connect()
+
+    def connect(self):
+        """
+            Open the NETCONF session, SSH keepalive packets (if given) helps detect dead sessions while idle
+        """
         self.nc_con = manager.connect(host=self.ip, port=self.nc_port, username=self.username,
-                                      password=self.password, device_params={'name': self.nc_dev_type})
+                                      password=self.password, device_params={'name': self.nc_dev_type},
+                                      keepalive=self.keepalive)
+
+    def is_alive(self):
+        """
+            Cheap check (no RPC) whether underlying NETCONF/SSH session is still connected
+        """
+        return self.nc_con is not None and self.nc_con.connected
 
     def get_capabilities(self):
         return self.nc_con.server_capabilities
 
-    def get_config(self):
-        return self.nc_con.get_config('running')
+    def get_config(self, netconf_filter=None):
+        with self.scheduler.turn(self):
+            if netconf_filter is None:
+                return self.nc_con.get_config('running')
+            return self.nc_con.get_config('running', filter=netconf_filter)
+
+    def running_config(self, netconf_filter, refresh=False):
+        """
+            Parsed `<data>` of running config selected by subtree filter, served from snapshot unless missing, expired
+            (or) invalidated by config change of the device
+        """
+        running = None if refresh else self.snapshots.get(self.ip, netconf_filter)
+        if running is None:
+            running = self.get_config(netconf_filter).data_ele
+            self.snapshots.put(self.ip, netconf_filter, running)
+
+        return running
+
+    def diff_config(self, config_snippet, netconf_filter=None, refresh=False):
+        """
+            Delta of intended config snippet against running config snapshot (fresh get-config with refresh=True),
+            None in-case device already holds the intended values. Full snippet returned when running config can't be
+            retrieved
+        """
+        try:
+            running = self.running_config(netconf_filter or config_filter(config_snippet), refresh)
+        except RPCError as err:
+            LOGGER.error(f"running config of {self.ip} not retrieved, sending full config : {err}")
+            return config_snippet
+
+        return config_delta(config_snippet, running)
 
     def verify_bgp_mib(self):
         """
             This verifies BGP operational state using NETCONF
         """
 
-        with open('Templates/bgp_oper.xml', 'r') as file:
-            netconf_filter = file.read()
+        peers = self.get_bgp_peers()
+
+        return True if peers and all(state == 'established' for state in peers.values()) else False
 
-        # Make the `<get>` RPC request applying the filter and parse using xmltodict
-        nc_rpc_reply = self.nc_con.get(filter=netconf_filter).xml
-        nc_reply_dict = xmltodict.parse(nc_rpc_reply)
+    def get_bgp_peers(self):
+        """
+            This gets BGP state of all the peers with single `<get>` RPC, returns dict of peer IP -> state
+        """
+        netconf_filter = TEMPLATES.render('bgp_oper')
 
-        session_state = parse_nested_dict(nc_reply_dict, 'rpc-reply', 'data', 'BGP4-MIB',
-                                          'bgpPeerTable', 'bgpPeerEntry', 'bgpPeerState')
+        with self.scheduler.turn(self):
+            nc_rpc_reply = self.nc_con.get(filter=netconf_filter).xml
 
-        return True if session_state == 'established' else False
+        return parse_bgp_peers(nc_rpc_reply)
 
-    def edit_config_interface(self, interface='', ip_address='', mask=''):
+    def verify_bgp_peer(self, peer_ip):
         """
-            This configures interface with given details using NETCONF
+            This verifies BGP state of given peer only, per-peer subtree filter instead of whole peer table
+        """
+        netconf_filter = TEMPLATES.render('bgp_peer_oper', peer_ip=peer_ip)
+
+        with self.scheduler.turn(self):
+            nc_rpc_reply = self.nc_con.get(filter=netconf_filter).xml
+
+        return parse_bgp_peers(nc_rpc_reply).get(peer_ip) == 'established'
+
+    def interface_config(self, interface='', ip_address='', mask=''):
+        """
+            This builds interface config snippet with given details, None in-case interface not in expected format
         """
 
         # Define the variables which gets variable substitution in the templates file
         if mg_1 := re.search(r'[A-Za-z]([0-9])', interface):
             variables = {'mg_1_groups_0': mg_1.groups()[0], 'ip_address': ip_address, 'mask_1': mask}
-            mg_1_groups_0 = mg_1.groups()[0]
-            mask_1 = mask
         else:
-            print("ERROR : interface given not in expected format")
-            return False
-
-        # Open template file to read yang model
-        with open('Templates/interface_config.xml', 'r') as file:
-            config_snippet = file.read()
-
-        # String format approach with dictionary unpacking
-        config_snippet = config_snippet.format(**variables)
+            LOGGER.error("interface given not in expected format")
+            return None
 
-        # Make the `<get>` RPC edit config the filter
-        nc_rpc_reply = self.nc_con.edit_config(config=config_snippet, target="running")
-        nc_reply_dict = xmltodict.parse(nc_rpc_reply.xml)
+        # Precompiled template of yang model, substitution with dictionary unpacking
+        return TEMPLATES.render('interface_config', **variables)
 
-        if 'ok' in nc_reply_dict['rpc-reply']:
-            return True
-        else:
-            return False
-
-    def edit_config_ospf(self, process_id, router_id, network_ip, network_mask, area_id, action):
+    def ospf_config(self, process_id, router_id, network_ip, network_mask, area_id, action):
         """
-            This configures OSPF with given details using NETCONF
+            This builds OSPF config snippet with given details
         """
 
-        # Open template file to read yang model
-        with open('Templates/ospf_config.xml', 'r') as file:
-            config_snippet = file.read()
-
         if action == 'disable':
             delete = ' operation="delete"'
         else:
@@ -112,18 +440,55 @@ class Device:
         variables = {'process_id': process_id, 'router_id': router_id, 'network_ip': network_ip,
                      'network_mask': network_mask, 'area_id': area_id, 'action': delete}
 
-        # String format approach with dictionary unpacking
-        config_snippet = config_snippet.format(**variables)
-
-        # Make the `<get>` RPC edit config the filter
-        nc_rpc_reply = self.nc_con.edit_config(config=config_snippet, target="running")
-        nc_reply_dict = xmltodict.parse(nc_rpc_reply.xml)
+        # Precompiled template of yang model, substitution with dictionary unpacking
+        return TEMPLATES.render('ospf_config', **variables)
 
-        if 'ok' in nc_reply_dict['rpc-reply']:
-            return True
-        else:
+    def edit_config_interface(self, interface='', ip_address='', mask='', refresh=False):
+        """
+            This configures interface with given details using NETCONF
+        """
+        config_snippet = self.interface_config(interface, ip_address, mask)
+        if config_snippet is None:
             return False
 
+        return self.edit_config_running(config_snippet, refresh=refresh)
+
+    def edit_config_ospf(self, process_id, router_id, network_ip, network_mask, area_id, action):
+        """
+            This configures OSPF with given details using NETCONF
+        """
+        config_snippet = self.ospf_config(process_id, router_id, network_ip, network_mask, area_id, action)
+
+        return self.edit_config_running(config_snippet)
+
+    def edit_config_running(self, config_snippet, diff=True, refresh=False):
+        """
+            This applies config snippet directly on running datastore, by default only the part differing from running
+            config snapshot is sent and nothing at all when device already holds the intended values. refresh=True
+            diffs against fresh get-config instead of the snapshot (remediation, operator push)
+        """
+        if diff:
+            netconf_filter = config_filter(config_snippet)
+            config_snippet = self.diff_config(config_snippet, netconf_filter, refresh)
+            if config_snippet is None:
+                LOGGER.info(f"running config of {self.ip} already as intended, edit-config skipped..")
+                return True
+
+        # Make the `<edit-config>` RPC
+        with self.scheduler.turn(self):
+            nc_rpc_reply = self.nc_con.edit_config(config=config_snippet, target="running")
+
+        if diff and nc_rpc_reply.ok:
+            self.snapshots.apply(self.ip, netconf_filter, config_snippet)
+
+        return nc_rpc_reply.ok
+
+    def transaction(self, confirmed=False, confirm_timeout=120):
+        """
+            Batch several config snippets into single edit-config + commit, see ConfigTransaction
+        """
+        return ConfigTransaction(self, confirmed, confirm_timeout)
+
     def close(self):
         """
             Gracefully close the NETCONF connection
@@ -131,18 +496,446 @@ class Device:
         self.nc_con.close_session()
 
 
+class ConfigTransaction:
+    """
+        Collects several config snippets and merges them into one `<config>` payload so that a change touching many
+        features is one edit-config RPC and one short window of inconsistent state on the device instead of many
+
+        Only the delta of the payload against fresh running config is sent, nothing when device already holds it.
+        When device supports :candidate, the payload is edited into candidate and committed. With confirmed=True
+        (and :confirmed-commit support) commit is confirmed-commit which the device rolls back automatically unless
+        confirmed within confirm_timeout seconds, verify callback decides whether to confirm (or) roll back at once.
+        Otherwise the payload is applied on running with rollback-on-error
+
+        Where there is no confirmed-commit (plain commit, edit on running) and verify fails, the inverse of the delta
+        built from pre-change running config is pushed back. applied tells whether the change is left on the device
+
+        Usage:
+            with device.transaction(confirmed=True) as txn:
+                txn.add(device.ospf_config(...))
+                txn.add(device.interface_config(...))
+                txn.verify = lambda: verify_baseline_health(device)
+            txn.ok
+    """
+    def __init__(self, device, confirmed=False, confirm_timeout=120, verify=None):
+        self.device = device
+        self.confirmed = confirmed
+        self.confirm_timeout = confirm_timeout
+        self.verify = verify
+        self.snippets = []
+        self.ok = None
+        self.applied = False
+        self.undo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.ok = False
+
+    def add(self, config_snippet):
+        if config_snippet is None:
+            raise ValueError("config snippet not built")
+        self.snippets.append(config_snippet)
+
+    def payload(self):
+        return merge_config(self.snippets)
+
+    def commit(self):
+        """
+            Send all the collected snippets in single edit-config, returns True on success
+        """
+        if not self.snippets:
+            self.ok = True
+            return self.ok
+
+        nc_con = self.device.nc_con
+
+        # only the delta against fresh running config is sent, re-run of already applied change is no-op. Snapshot
+        # could miss out-of-band change (no CONFIG_I invalidation outside auto-healing) and skip a needed push
+        payload = self.payload()
+        config = self.device.diff_config(payload, refresh=True)
+        if config is None:
+            LOGGER.info(f"running config of {self.device.ip} already as intended, commit skipped..")
+            self.ok = True
+            return self.ok
+
+        if self.verify is not None and not (self.confirmed and ':candidate' in nc_con.server_capabilities and
+                                            ':confirmed-commit' in nc_con.server_capabilities):
+            # no confirmed-commit to fall back on, keep the way back to pre-change config
+            try:
+                self.undo = config_inverse(config, self.device.running_config(config_filter(payload)))
+            except RPCError as err:
+                LOGGER.error(f"running config of {self.device.ip} not retrieved, change can't be rolled back : {err}")
+
+        try:
+            # whole lock..commit sequence (incl. verify) is one turn on the session, nothing interleaves with it
+            with self.device.scheduler.turn(self.device):
+                return self._commit(nc_con, config)
+        finally:
+            self.device.snapshots.invalidate(self.device.ip)
+
+    def _commit(self, nc_con, config):
+        if ':candidate' not in nc_con.server_capabilities:
+            nc_rpc_reply = nc_con.edit_config(config=config, target="running", error_option='rollback-on-error')
+            self.applied = nc_rpc_reply.ok
+            self.ok = nc_rpc_reply.ok and (self.verify is None or self.verify())
+            if self.applied and not self.ok:
+                self._revert(nc_con, "running")
+            return self.ok
+
+        confirmed = self.confirmed and ':confirmed-commit' in nc_con.server_capabilities
+
+        with nc_con.locked('candidate'):
+            try:
+                nc_con.discard_changes()
+                nc_con.edit_config(config=config, target="candidate")
+
+                if not confirmed:
+                    self.applied = nc_con.commit().ok
+                    self.ok = self.applied and (self.verify is None or self.verify())
+                    if self.applied and not self.ok:
+                        self._revert(nc_con, "candidate")
+                    return self.ok
+
+                nc_con.commit(confirmed=True, timeout=str(self.confirm_timeout))
+                self.applied = True
+            except RPCError as err:
+                LOGGER.error(f"config transaction on {self.device.ip} failed : {err}")
+                nc_con.discard_changes()
+                self.ok = False
+                return self.ok
+
+        # confirming commit only if change verified, otherwise roll back now rather than at confirm timeout
+        if self.verify is None or self.verify():
+            self.ok = nc_con.commit().ok
+        else:
+            LOGGER.error(f"config transaction on {self.device.ip} not verified, rolling back..")
+            nc_con.cancel_commit()
+            self.ok = False
+        # not confirmed change is rolled back by device at confirm timeout at the latest
+        self.applied = self.ok
+
+        return self.ok
+
+    def _revert(self, nc_con, target):
+        # change was applied but not verified and there's no confirmed-commit, push pre-change config back
+        if self.undo is None:
+            LOGGER.error(f"config transaction on {self.device.ip} not verified and can't be rolled back..")
+            return
+
+        LOGGER.error(f"config transaction on {self.device.ip} not verified, rolling back..")
+        try:
+            nc_rpc_reply = nc_con.edit_config(config=self.undo, target=target, error_option='rollback-on-error')
+            if target == "candidate":
+                nc_rpc_reply = nc_con.commit()
+        except RPCError as err:
+            LOGGER.error(f"roll back of config transaction on {self.device.ip} failed : {err}")
+            if target == "candidate":
+                nc_con.discard_changes()
+            return
+
+        self.applied = not nc_rpc_reply.ok
+
+
+class ConfigSnapshots:
+    """
+        Running config snapshots kept as parsed subtrees keyed by device IP and subtree filter, so that diffing intended
+        config before every edit-config costs one filtered `<get-config>` of just that subtree, not whole datastore
+
+        Snapshots of device are dropped when its config changes (SYS CONFIG_I notification, committed transaction)
+        and after ttl seconds as safety net for changes not notified. Own successful edit-config is written through
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(netconf_filter):
+        return tuple(netconf_filter) if isinstance(netconf_filter, list) else netconf_filter
+
+    def get(self, device_ip, netconf_filter):
+        with self.lock:
+            entry = self.snapshots.get(device_ip, {}).get(self._key(netconf_filter))
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry[0]
+
+    def put(self, device_ip, netconf_filter, running):
+        with self.lock:
+            self.snapshots.setdefault(device_ip, {})[self._key(netconf_filter)] = (running, time.monotonic())
+
+    def apply(self, device_ip, netconf_filter, config_snippet):
+        """
+            Write own successful edit-config through into the snapshot it was diffed against, other snapshots of the
+            device may overlap the change so they are dropped. Deletes just drop the snapshot
+        """
+        with self.lock:
+            device_snapshots = self.snapshots.pop(device_ip, {})
+            entry = device_snapshots.get(self._key(netconf_filter))
+            if entry is None or 'operation=' in config_snippet:
+                return
+
+            running = copy.deepcopy(entry[0])
+            _merge_element(running, etree.fromstring(config_snippet.encode(), _NOTIFICATION_PARSER))
+            self.snapshots[device_ip] = {self._key(netconf_filter): (running, entry[1])}
+
+    def invalidate(self, device_ip):
+        with self.lock:
+            if self.snapshots.pop(device_ip, None):
+                self.invalidations += 1
+
+    def report(self):
+        with self.lock:
+            devices = len(self.snapshots)
+            subtrees = sum(len(device_snapshots) for device_snapshots in self.snapshots.values())
+        return (f"devices={devices} subtrees={subtrees} hits={self.hits} misses={self.misses} "
+                f"invalidations={self.invalidations}")
+
+
+@dataclass
+class PoolStats:
+    """
+        Dataclass to handle connect latency and session re-use statistics of DevicePool
+    """
+    connects: int = 0
+    connect_failures: int = 0
+    connect_time_total: float = 0.0
+    connect_time_max: float = 0.0
+    reuse_hits: int = 0
+    reconnects: int = 0
+    evictions: int = 0
+
+    def report(self):
+        leases = self.reuse_hits + self.connects
+        avg_ms = (self.connect_time_total / self.connects * 1000) if self.connects else 0.0
+        hit_ratio = (self.reuse_hits / leases * 100) if leases else 0.0
+        return (f"leases={leases} connects={self.connects} reuse_hits={self.reuse_hits} ({hit_ratio:.1f}%) "
+                f"reconnects={self.reconnects} evictions={self.evictions} failures={self.connect_failures} "
+                f"connect_avg={avg_ms:.1f}ms connect_max={self.connect_time_max * 1000:.1f}ms")
+
+
+class DevicePool:
+    """
+        Keeps warm NETCONF sessions keyed by mgmt_ip so that scripts and threads lease an already connected Device
+        instead of paying SSH handshake and capability exchange for every Device built
+
+        All the sessions of the pool share one ConfigSnapshots cache of running config, sessions of same device share
+        one RpcScheduler (rpc_limits/rpc_deadlines (optional) override RPC_CLASS_LIMITS/RPC_CLASS_DEADLINES).
+        Idle sessions are keepalive-checked when leased and transparently re-connected in-case dead. Concurrent
+        sessions are capped per device (max_per_device) and fleet-wide (max_sessions), when fleet-wide cap reached
+        least recently used idle session of some other device is evicted to make room
+
+        Usage:
+            with pool.lease(device_dc) as device:
+                device.edit_config_interface(...)
+    """
+    def __init__(self, max_per_device=2, max_sessions=100, keepalive=30, snapshots=None, port=830, rpc_limits=None,
+                 rpc_deadlines=None):
+        self.max_per_device = max_per_device
+        self.max_sessions = max_sessions
+        self.keepalive = keepalive
+        self.port = port
+        self.snapshots = snapshots if snapshots is not None else ConfigSnapshots()
+        self.rpc_limits = rpc_limits
+        self.rpc_deadlines = rpc_deadlines
+        self.schedulers = {}
+
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.device_slots = {}
+        self.fleet_slots = threading.BoundedSemaphore(max_sessions)
+        self.open_sessions = 0
+        self.stats = PoolStats()
+
+    @contextmanager
+    def lease(self, device_dc, timeout=None):
+        """
+            Context manager handing out a connected Device for exclusive use, returned to the pool on exit
+        """
+        device = self.acquire(device_dc, timeout)
+        try:
+            yield device
+        finally:
+            self.release(device)
+
+    def acquire(self, device_dc, timeout=None):
+        """
+            Lease a connected Device for given DeviceData record, blocks (up-to timeout seconds) while caps reached
+        """
+        key = device_dc.mgmt_ip
+        with self.lock:
+            slots = self.device_slots.setdefault(key, threading.BoundedSemaphore(self.max_per_device))
+
+        if not slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no free NETCONF session slot for {key}")
+        if not self.fleet_slots.acquire(timeout=timeout):
+            slots.release()
+            raise TimeoutError("no free fleet-wide NETCONF session slot")
+
+        try:
+            return self._checkout(device_dc)
+        except Exception:
+            self.fleet_slots.release()
+            slots.release()
+            raise
+
+    def release(self, device):
+        """
+            Return leased Device to the pool, dead sessions are dropped instead of being kept idle
+        """
+        key = device.ip
+        alive = device.is_alive()
+
+        with self.lock:
+            if alive:
+                self.idle.setdefault(key, []).append((device, time.monotonic()))
+            else:
+                self.open_sessions -= 1
+            slots = self.device_slots[key]
+
+        self.fleet_slots.release()
+        slots.release()
+
+    def _checkout(self, device_dc):
+        key = device_dc.mgmt_ip
+
+        with self.lock:
+            idle = self.idle.get(key)
+            device = idle.pop()[0] if idle else None
+
+        if device is not None:
+            if device.is_alive():
+                with self.lock:
+                    self.stats.reuse_hits += 1
+                return device
+
+            # session died while idle, re-connect transparently
+            self._discard(device)
+            with self.lock:
+                self.stats.reconnects += 1
+
+        return self._connect(device_dc)
+
+    def _connect(self, device_dc):
+        # make room by evicting least recently used idle session of any device when fleet-wide cap reached
+        with self.lock:
+            victim = None
+            if self.open_sessions >= self.max_sessions:
+                victim = self._pop_lru_idle()
+            self.open_sessions += 1
+            scheduler = self.schedulers.get(device_dc.mgmt_ip)
+            if scheduler is None:
+                scheduler = self.schedulers[device_dc.mgmt_ip] = RpcScheduler(device_dc.host_name, self.rpc_limits,
+                                                                              self.rpc_deadlines)
+
+        if victim is not None:
+            self._close_quietly(victim)
+
+        start = time.monotonic()
+        try:
+            device = Device(ip=device_dc.mgmt_ip, username=device_dc.user_name, password=device_dc.password,
+                            keepalive=self.keepalive, snapshots=self.snapshots, port=self.port, scheduler=scheduler)
+        except Exception:
+            with self.lock:
+                self.open_sessions -= 1
+                self.stats.connect_failures += 1
+            raise
+
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.stats.connects += 1
+            self.stats.connect_time_total += elapsed
+            self.stats.connect_time_max = max(self.stats.connect_time_max, elapsed)
+
+        return device
+
+    def _pop_lru_idle(self):
+        # caller holds self.lock
+        lru_key, lru_time = None, None
+        for key, idle in self.idle.items():
+            if idle and (lru_time is None or idle[0][1] < lru_time):
+                lru_key, lru_time = key, idle[0][1]
+
+        if lru_key is None:
+            return None
+
+        self.open_sessions -= 1
+        self.stats.evictions += 1
+        return self.idle[lru_key].pop(0)[0]
+
+    def _discard(self, device):
+        with self.lock:
+            self.open_sessions -= 1
+        self._close_quietly(device)
+
+    @staticmethod
+    def _close_quietly(device):
+        try:
+            device.close()
+        except Exception:
+            # session already gone, nothing more to clean-up
+            pass
+
+    def close(self):
+        """
+            Gracefully close all idle NETCONF sessions of the pool
+        """
+        with self.lock:
+            devices = [device for idle in self.idle.values() for device, _ in idle]
+            self.idle.clear()
+            self.open_sessions -= len(devices)
+
+        for device in devices:
+            self._close_quietly(device)
+
+    def rpc_report(self):
+        """
+            Queue wait of RPCs per class over all the devices of the pool
+        """
+        totals = {rpc_class: RpcClassStats() for rpc_class in RPC_CLASSES}
+        for scheduler in list(self.schedulers.values()):
+            with scheduler.condition:
+                for rpc_class, stats in scheduler.stats.items():
+                    totals[rpc_class].merge(stats)
+        return ' | '.join(f"{rpc_class} {stats.report()}" for rpc_class, stats in totals.items())
+
+
 class Database:
     """
         Handle Database specific like connection, query
     """
+    DATABASE = 'ipam_database'
+
     def __init__(self, ip, username, password):
         self.host = ip
         self.user = username
         self.password = password
-        self.database = 'ipam_database'
+        self.database = self.DATABASE
         self.conn = mysql.connector.connect(host=self.host, user=self.user, passwd=self.password,
                                            database=self.database)
         self.cursr = self.conn.cursor()
+        self.closed = False
+
+    @classmethod
+    def connection_pool(cls, ip, username, password, size=2, name='automation', connection_timeout=5):
+        """
+            Pool of connections to the same database for background writers, connection handed out by
+            get_connection() goes back to pool on close()
+        """
+        return mysql.connector.pooling.MySQLConnectionPool(pool_name=name, pool_size=size, host=ip, user=username,
+                                                           passwd=password, database=cls.DATABASE,
+                                                           connection_timeout=connection_timeout)
 
     def fetch_by_device(self, host_name):
         """
@@ -164,63 +957,575 @@ class Database:
 
         return record
 
+    def fetch_all(self, batch_size=500):
+        """
+            This streams all the records from database in batches, using unbuffered (server-side) cursor so that rows
+            are not materialized all at once on client
+        """
+        cursr = self.conn.cursor(buffered=False)
+        try:
+            cursr.execute("SELECT * FROM ipam_db_table")
+            while rows := cursr.fetchmany(batch_size):
+                for row in rows:
+                    yield DeviceData(*row)
+        finally:
+            # unread rows must be drained before the connection can serve next query
+            self.conn.consume_results()
+            cursr.close()
+
+    def fetch_many(self, host_names, batch_size=500):
+        """
+            This fetch the details of many devices with one query per batch of host names instead of one per device
+        """
+        host_names = list(host_names)
+        cursr = self.conn.cursor(buffered=False)
+        try:
+            for start in range(0, len(host_names), batch_size):
+                batch = host_names[start:start + batch_size]
+                query = f"SELECT * FROM ipam_db_table WHERE host_name IN ({', '.join(['%s'] * len(batch))})"
+                cursr.execute(query, batch)
+                while rows := cursr.fetchmany(batch_size):
+                    for row in rows:
+                        yield DeviceData(*row)
+        finally:
+            self.conn.consume_results()
+            cursr.close()
+
+    def has_interface_table(self):
+        """
+            Whether IPAM has normalized interface table (host_name, interface, ip_address, mask), one row per interface
+        """
+        self.cursr.execute("SHOW TABLES LIKE 'ipam_interface_table'")
+        return self.cursr.fetchall() != []
+
+    def fetch_interfaces(self, batch_size=500):
+        """
+            This streams (host_name, interface, ip_address, mask) of all the interfaces from ipam_interface_table
+        """
+        cursr = self.conn.cursor(buffered=False)
+        try:
+            cursr.execute("SELECT host_name, interface, ip_address, mask FROM ipam_interface_table")
+            while rows := cursr.fetchmany(batch_size):
+                yield from rows
+        finally:
+            self.conn.consume_results()
+            cursr.close()
+
+    def table_checksum(self):
+        """
+            Cheap change-detection of IPAM table content, this changes whenever any of row changes (of interface table
+            too when present)
+        """
+        tables = 'ipam_db_table, ipam_interface_table' if self.has_interface_table() else 'ipam_db_table'
+        self.cursr.execute(f"CHECKSUM TABLE {tables}")
+        rows = self.cursr.fetchall()
+
+        return tuple(row[1] for row in rows) if rows else None
+
+    def ping(self):
+        """
+            Verify connection is still usable, re-connect if server closed it as idle
+        """
+        self.conn.ping(reconnect=True, attempts=3, delay=1)
+
+    def is_connected(self):
+        """
+            False once closed. Local flag, no server round trip (COM_PING) which could interleave with another thread's
+            unbuffered fetch on the connection. Server closing idle connection is handled by ping() on refresh
+        """
+        return not self.closed
+
     def close(self):
         """
             Gracefully close the DATABASE connection
         """
+        self.closed = True
         self.cursr.close()
         self.conn.close()
 
 
-class ThreadSafeDict:
+def ip_to_int(ip_address):
+    return int.from_bytes(socket.inet_aton(ip_address), 'big')
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+
+def interface_rows(records):
+    """
+        (host_name, interface, ip_address, mask) of DeviceData records, one per `<interface>_ip` field
     """
-        As multi-threading implementation during multiple threads access data at same time may conflict, this helps
-        safe data access across threads by implementing Locking
+    ip_fields = [field.name for field in fields(DeviceData) if field.name.endswith('_ip') and field.name != 'mgmt_ip']
+    for record in records:
+        for ip_field in ip_fields:
+            interface = ip_field[:-3]
+            ip_address = getattr(record, ip_field)
+            if ip_address:
+                yield record.host_name, interface, ip_address, getattr(record, f'{interface}_mask', None)
+
+
+class InterfaceTable:
     """
+        Intended interface addressing of the whole fleet, any number of interfaces per device, column-wise in compact
+        arrays (IPv4 address as 32-bit int, prefix length as byte, interned host/interface names) with indexes,
+            by owner        (host_name, interface) -> entry, intended IP lookup in O(1)
+            by IP           IP -> (host_name, interface) owning it, O(1) e.g. whose address is a duplicate address
+            by subnet       per prefix length network -> entries, interfaces whose subnet contains IP in O(prefix
+                            lengths in use)
+            sorted IPs      interfaces with IP within given prefix in O(log n + matches)
+
+        Built once (bulk load) and never mutated so that lookups need no lock, SsotCache swaps in new table on change
+    """
+    __slots__ = ('hosts', 'names', 'ips', 'prefix_lens', 'by_owner', 'by_ip', 'by_device', 'by_subnet',
+                 'sorted_ips', 'sorted_entries')
+
+    def __init__(self, rows=()):
+        self.hosts = []
+        self.names = []
+        self.ips = array('I')
+        self.prefix_lens = array('B')
+        self.by_owner = {}
+        self.by_ip = {}
+        self.by_device = {}
+        self.by_subnet = {}
+
+        for host_name, interface, ip_address, mask in rows:
+            try:
+                ip = ip_to_int(ip_address)
+                prefix_len = bin(ip_to_int(mask)).count('1') if mask else 32
+            except (OSError, TypeError):
+                LOGGER.error(f"invalid address {ip_address}/{mask} of {host_name} {interface} in SSOT, skipped")
+                continue
+
+            host_name, interface = sys.intern(host_name), sys.intern(interface)
+            entry = self.by_owner.get((host_name, interface))
+            if entry is None:
+                entry = len(self.hosts)
+                self.hosts.append(host_name)
+                self.names.append(interface)
+                self.ips.append(ip)
+                self.prefix_lens.append(prefix_len)
+                self.by_owner[(host_name, interface)] = entry
+                self.by_device.setdefault(host_name, []).append(entry)
+            else:
+                self.ips[entry] = ip
+                self.prefix_lens[entry] = prefix_len
+
+        # indexes built once all rows are in, later rows of the same interface win
+        for entry, (ip, prefix_len) in enumerate(zip(self.ips, self.prefix_lens)):
+            self.by_ip.setdefault(ip, entry)
+            network = ip & (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+            self.by_subnet.setdefault(prefix_len, {}).setdefault(network, []).append(entry)
+
+        order = sorted(range(len(self.ips)), key=self.ips.__getitem__)
+        self.sorted_ips = array('I', (self.ips[entry] for entry in order))
+        self.sorted_entries = array('I', order)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+            Table of the fixed `<interface>_ip/_mask` columns of DeviceData records
+        """
+        return cls(interface_rows(records))
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def _entry(self, entry):
+        return (self.hosts[entry], self.names[entry], int_to_ip(self.ips[entry]),
+                int_to_ip((0xFFFFFFFF << (32 - self.prefix_lens[entry])) & 0xFFFFFFFF))
+
+    def intended(self, host_name, interface):
+        """
+            (ip_address, mask) intended on interface of device, None in-case not in SSOT
+        """
+        entry = self.by_owner.get((host_name, interface))
+        if entry is None:
+            return None
+        return self._entry(entry)[2:]
+
+    def owner(self, ip_address):
+        """
+            (host_name, interface) which should own the IP address, None in-case no interface has it
+        """
+        entry = self.by_ip.get(ip_to_int(ip_address))
+        if entry is None:
+            return None
+        return self.hosts[entry], self.names[entry]
+
+    def interfaces(self, host_name):
+        """
+            (host_name, interface, ip_address, mask) of all the interfaces of device
+        """
+        return [self._entry(entry) for entry in self.by_device.get(host_name, ())]
+
+    def containing(self, ip_address):
+        """
+            (host_name, interface, ip_address, mask) of interfaces whose subnet contains the IP, longest prefix first
+        """
+        ip = ip_to_int(ip_address)
+        found = []
+        for prefix_len in sorted(self.by_subnet, reverse=True):
+            network = ip & (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+            found.extend(self._entry(entry) for entry in self.by_subnet[prefix_len].get(network, ()))
+        return found
+
+    def within(self, prefix):
+        """
+            (host_name, interface, ip_address, mask) of interfaces with IP inside prefix e.g. '19.1.0.0/16'
+        """
+        network, _, prefix_len = prefix.partition('/')
+        prefix_len = int(prefix_len or 32)
+        start = ip_to_int(network) & (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+        end = start + (1 << (32 - prefix_len))
+
+        low = bisect.bisect_left(self.sorted_ips, start)
+        high = bisect.bisect_left(self.sorted_ips, end)
+        return [self._entry(self.sorted_entries[index]) for index in range(low, high)]
+
+
+class SsotCache:
+    """
+        In-process Single Source-of-Truth cache so that auto-healing and deployment paths read IPAM data from memory
+        instead of MySQL
+
+        Records are bulk loaded with Database.fetch_all and indexed by host_name and mgmt_ip for O(1) lookups, interfaces
+        into InterfaceTable from ipam_interface_table (else the fixed interface columns of the records). Once ttl
+        seconds are elapsed the table checksum is compared (change-detection) and records re-loaded only if changed,
+        lookups never wait for a refresh as indexes are swapped atomically once new ones are built
+    """
+    def __init__(self, database, ttl=300, batch_size=500):
+        self.database = database
+        self.ttl = ttl
+        self.batch_size = batch_size
+
+        self.by_host_name = {}
+        self.by_mgmt_ip = {}
+        self.interface_table = InterfaceTable()
+        self.checksum = None
+        self.loaded_at = None
+        self.refresh_lock = threading.Lock()
+
+    def load(self):
+        """
+            Bulk load all the records and build indexes
+        """
+        with self.refresh_lock:
+            self._load()
+
+        return len(self.by_host_name)
+
+    def _load(self):
+        checksum = self.database.table_checksum()
+
+        by_host_name = {}
+        by_mgmt_ip = {}
+        for record in self.database.fetch_all(self.batch_size):
+            by_host_name[record.host_name] = record
+            by_mgmt_ip[record.mgmt_ip] = record
+
+        if self.database.has_interface_table():
+            interface_table = InterfaceTable(self.database.fetch_interfaces(self.batch_size))
+        else:
+            interface_table = InterfaceTable.from_records(by_host_name.values())
+
+        self.by_host_name, self.by_mgmt_ip, self.interface_table = by_host_name, by_mgmt_ip, interface_table
+        self.checksum = checksum
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        """
+            Re-load records only if IPAM table changed since last load (change-detection)
+        """
+        with self.refresh_lock:
+            self._check_and_load()
+
+    def _check_and_load(self):
+        self.database.ping()
+        if self.loaded_at is None or self.database.table_checksum() != self.checksum:
+            self._load()
+        else:
+            self.loaded_at = time.monotonic()
+
+    def _refresh_if_stale(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+            return
+
+        # only one thread refreshes, others keep reading current indexes.. database closed means frozen snapshot.
+        # Connection is checked only under the lock, a load (or) refresh may be streaming on it meanwhile
+        if self.refresh_lock.acquire(blocking=False):
+            try:
+                if self.database.is_connected():
+                    self._check_and_load()
+            except mysql.connector.Error as err:
+                LOGGER.error(f"SSOT cache refresh failed, serving cached records : {err}")
+                self.loaded_at = time.monotonic()
+            finally:
+                self.refresh_lock.release()
+
+    def get(self, host_name):
+        self._refresh_if_stale()
+        return self.by_host_name.get(host_name)
+
+    def get_by_ip(self, mgmt_ip):
+        self._refresh_if_stale()
+        return self.by_mgmt_ip.get(mgmt_ip)
+
+    def get_many(self, host_names):
+        self._refresh_if_stale()
+        return [self.by_host_name[host_name] for host_name in host_names if host_name in self.by_host_name]
+
+    def devices(self):
+        self._refresh_if_stale()
+        return list(self.by_host_name.values())
+
+    def interfaces(self):
+        """
+            Current InterfaceTable of the fleet
+        """
+        self._refresh_if_stale()
+        return self.interface_table
+
+
+class EventShard:
+    """
+        One shard of EventStore, keys kept in order of last update so that expired keys are always at the front
+    """
+    __slots__ = ('lock', 'events', 'next_sweep')
+
     def __init__(self):
-        self.dict = {}
         self.lock = threading.Lock()
+        self.events = OrderedDict()
+        self.next_sweep = 0.0
 
-    def set_item(self, key, value):
-        with self.lock:
-            self.dict[key] = value
 
-    def get_item(self, key):
-        with self.lock:
-            return self.dict.get(key)
+class EventStore:
+    """
+        Time-windowed correlation store of recent Events keyed by (device, event type, subject) where subject is the
+        IP address, interface, peer etc. the Event is about, example ('R1', 'DUPADDR', '19.1.0.2')
 
-    def remove_item(self, key):
-        with self.lock:
-            if key in self.dict:
-                del self.dict[key]
+        This helps answer Multi-Criteria questions like "DUPADDR for IP X on R1 within last N seconds" in O(1)
+            1)  Keys are spread over shards each with own lock so that writers from many worker threads don't contend,
+                readers don't take any lock at all
+            2)  Each key keeps bounded ring buffer of recent (monotonic timestamp, value) and Events older than ttl are
+                evicted, so that stale Event from hours ago never correlates
+            3)  Memory is capped no matter how large the storm, least recently updated keys evicted beyond max_keys
+    """
+    def __init__(self, ttl=300, shards=16, max_events_per_key=8, max_keys=100000, sweep_interval=5):
+        self.ttl = ttl
+        self.max_events_per_key = max_events_per_key
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.sweep_interval = sweep_interval
+        self.shards = tuple(EventShard() for _ in range(shards))
 
-    def contains_item(self, key):
-        with self.lock:
-            if key in self.dict:
-                return True
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def record(self, device, event_type, subject, value, timestamp=None):
+        """
+            Record Event, timestamp is time.monotonic() based
+        """
+        key = (device, event_type, subject)
+        shard = self._shard(key)
+        now = time.monotonic() if timestamp is None else timestamp
+
+        with shard.lock:
+            events = shard.events.get(key)
+            if events is None:
+                events = deque(maxlen=self.max_events_per_key)
+                shard.events[key] = events
+                if len(shard.events) > self.max_keys_per_shard:
+                    shard.events.popitem(last=False)
+            else:
+                shard.events.move_to_end(key)
+            events.append((now, value))
+
+            if now >= shard.next_sweep:
+                self._sweep(shard, now)
+
+    def latest(self, device, event_type, subject, within=None):
+        """
+            Value of most recent Event for the key within last `within` seconds (default ttl), else None
+        """
+        events = self._shard((device, event_type, subject)).events.get((device, event_type, subject))
+        try:
+            timestamp, value = events[-1]
+        except (IndexError, TypeError):
+            return None
+
+        window = self.ttl if within is None else min(within, self.ttl)
+        return value if time.monotonic() - timestamp <= window else None
+
+    def recent(self, device, event_type, subject, within=None):
+        """
+            All the (timestamp, value) still buffered for the key within last `within` seconds, oldest first
+        """
+        events = self._shard((device, event_type, subject)).events.get((device, event_type, subject))
+        if not events:
+            return []
+
+        window = self.ttl if within is None else min(within, self.ttl)
+        oldest = time.monotonic() - window
+        return [(timestamp, value) for timestamp, value in list(events) if timestamp >= oldest]
+
+    def contains(self, device, event_type, subject, within=None):
+        return self.latest(device, event_type, subject, within) is not None
+
+    def _sweep(self, shard, now):
+        # caller holds shard.lock, keys are ordered by last update so stop at first key not expired
+        oldest = now - self.ttl
+        while shard.events:
+            key, events = next(iter(shard.events.items()))
+            if events and events[-1][0] >= oldest:
+                break
+            del shard.events[key]
+        shard.next_sweep = now + self.sweep_interval
+
+    def evict_expired(self):
+        now = time.monotonic()
+        for shard in self.shards:
+            with shard.lock:
+                self._sweep(shard, now)
+
+    def __len__(self):
+        return sum(len(shard.events) for shard in self.shards)
 
     def print_items(self):
-        with self.lock:
-            for k, v in self.dict.items():
-                print(f"{k:<15} -- {v:<30}")
+        now = time.monotonic()
+        for shard in self.shards:
+            with shard.lock:
+                items = [(key, events[-1]) for key, events in shard.events.items() if events]
+            for (device, event_type, subject), (timestamp, value) in items:
+                print(f"{device:<10} {event_type:<10} {str(subject):<18} -- {now - timestamp:>6.1f}s ago -- {value}")
 
 
-def verify_baseline_health(device):
+class BgpStateCache:
     """
-        To verify initial Baseline health of topology
+        Operational BGP state of one device indexed by peer IP, kept up-to-date by BgpTelemetry so that healing
+        verification is event-driven wait on "peer X established" instead of polling full BGP4-MIB `<get>`
     """
-    return device.verify_bgp_mib()
+    def __init__(self):
+        self.peers = {}
+        self.condition = threading.Condition()
+        self.live = False
+        self.updated_at = None
+        self.peer_updated_at = {}
+
+    def update(self, peers):
+        with self.condition:
+            now = time.monotonic()
+            self.peers.update(peers)
+            self.peer_updated_at.update(dict.fromkeys(peers, now))
+            self.updated_at = now
+            self.condition.notify_all()
+
+    def set_live(self, live):
+        with self.condition:
+            self.live = live
+            self.condition.notify_all()
 
+    def is_live(self):
+        return self.live
+
+    def state(self, peer_ip):
+        return self.peers.get(peer_ip)
+
+    def wait_established(self, peer_ip, timeout, since=None):
+        """
+            Block till peer is established (True), timeout (or) telemetry stopped being live (False). With since
+            (time.monotonic() of remediation) only state reported after it counts, cached state from before can be stale
+        """
+        def established():
+            return self.peers.get(peer_ip) == 'established' and (since is None or
+                                                                 self.peer_updated_at.get(peer_ip, since) > since)
 
-def parse_nested_dict(data, *args):
+        with self.condition:
+            self.condition.wait_for(lambda: established() or not self.live, timeout)
+            return established()
+
+
+class BgpTelemetry(SessionListener):
     """
-        Handle nested dictionary as being multi-level nested being XML response from NETCONF
+        Feeds BgpStateCache from YANG-push subscription of BGP4-MIB peer table, on-change by default (or) periodic
+        when period (centiseconds) given. Needs its own NETCONF session as the notifications arrive on it
+
+        Cache is seeded with one `<get>` so that peers not changing since subscription are known too
     """
-    if args and data:
-        element = args[0]
-        if element:
-            value = data.get(element)
-            return value if len(args) == 1 else parse_nested_dict(value, *args[1:])
+    def __init__(self, device, cache, period=None):
+        self.device = device
+        self.cache = cache
+        self.period = period
+
+    def start(self):
+        if self.period is None:
+            update_trigger = '<yp:dampening-period>0</yp:dampening-period>'
+        else:
+            update_trigger = f'<yp:period>{self.period}</yp:period>'
+
+        session = self.device.nc_con._session
+        session.add_listener(self)
+        try:
+            self.device.nc_con.dispatch(xml_.to_ele(TEMPLATES.render('bgp_establish_subscription',
+                                                                     update_trigger=update_trigger)))
+        except RPCError:
+            session.remove_listener(self)
+            raise
+
+        self.cache.update(self.device.get_bgp_peers())
+        self.cache.set_live(True)
+
+    def stop(self):
+        self.cache.set_live(False)
+        self.device.nc_con._session.remove_listener(self)
+
+    def callback(self, root, raw):
+        tag, _ = root
+        if tag.endswith('}notification') and 'push-' in raw:
+            peers = parse_bgp_peers(raw)
+            if peers:
+                self.cache.update(peers)
+
+    def errback(self, ex):
+        # session lost, verification falls back to polling
+        LOGGER.error(f"BGP telemetry session of {self.device.ip} failed : {ex}")
+        self.cache.set_live(False)
+
+
+def wait_bgp_established(device, peer_ip, bgp_cache=None, timeout=20, interval=1, since=None):
+    """
+        Wait till BGP peer is established, event-driven on BgpStateCache when telemetry live else fall back to polling
+        the peer with per-peer subtree filter
+
+        since is time.monotonic() of the remediation, cache then counts only peer state reported after it. Peer which
+        stayed established (on-change telemetry reports nothing) is confirmed by one poll of the device at timeout
+    """
+    if bgp_cache is not None and bgp_cache.is_live():
+        if bgp_cache.wait_established(peer_ip, timeout, since):
+            return True
+        if bgp_cache.is_live():
+            return device.verify_bgp_peer(peer_ip)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        if device.verify_bgp_peer(peer_ip):
+            return True
+        if time.monotonic() + interval > deadline:
+            return False
+        time.sleep(interval)
+
+
+def verify_baseline_health(device, health=None, max_age=None):
+    """
+        To verify initial Baseline health of topology, read from FleetHealth table (if given) when it has recent state
+        of the device else verified with `<get>` on the device
+    """
+    if health is not None:
+        healthy = health.healthy_ip(device.ip, max_age)
+        if healthy is not None:
+            return healthy
+
+    return device.verify_bgp_mib()
 
 
 def print_xml(res):
@@ -230,3 +1535,258 @@ def print_xml(res):
     print(xml_.to_xml(res.data_ele, pretty_print=True))
 
 
+# Precompiled XPath pulling only the interested leaves of clogMessageGenerated notification
+_CLOG_XPATH_NS = {'c': CLOG_NS}
+_CLOG_FACILITY = etree.XPath('string(c:clogMessageGenerated/*/c:clogHistFacility)', namespaces=_CLOG_XPATH_NS)
+_CLOG_MSG_NAME = etree.XPath('string(c:clogMessageGenerated/*/c:clogHistMsgName)', namespaces=_CLOG_XPATH_NS)
+_CLOG_MSG_TEXT = etree.XPath('string(c:clogMessageGenerated/*/c:clogHistMsgText)', namespaces=_CLOG_XPATH_NS)
+_NOTIFICATION_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+
+
+def parse_clog_notification(notification_xml, interest=CLOG_EVENTS):
+    """
+        Fast extraction of (clogHistFacility, clogHistMsgName, clogHistMsgText) from NETCONF notification, returns None
+        for not-interested Events which are rejected before anything more than the facility is looked at. interest None
+        means every syslog Event
+    """
+    # cheap reject of non syslog notifications (linkUp/linkDown traps etc) without any XML parsing (or) encoding
+    is_text = isinstance(notification_xml, str)
+    if ('clogMessageGenerated' if is_text else b'clogMessageGenerated') not in notification_xml:
+        return None
+
+    if is_text:
+        notification_xml = notification_xml.encode()
+    root = etree.fromstring(notification_xml, _NOTIFICATION_PARSER)
+
+    facility = _CLOG_FACILITY(root)
+    if interest is not None and facility not in interest:
+        return None
+
+    msg_name = _CLOG_MSG_NAME(root)
+    msg_names = interest[facility] if interest is not None else None
+    if msg_names is not None and msg_name not in msg_names:
+        return None
+
+    return facility, msg_name, _CLOG_MSG_TEXT(root)
+
+
+def clog_subscription_filter(interest=CLOG_EVENTS):
+    """
+        Subtree filter for create-subscription so that router sends only clogMessageGenerated events we act on, interest
+        None subscribes to every syslog Event
+    """
+    if interest is None:
+        return [TEMPLATES.render('clog_subscription_filter', facility='', msg_name='')]
+
+    criteria = []
+    for facility, msg_names in interest.items():
+        for msg_name in sorted(msg_names) if msg_names is not None else ['']:
+            criteria.append(TEMPLATES.render('clog_subscription_filter', facility=facility, msg_name=msg_name))
+
+    return criteria
+
+
+_BGP_PEER_ENTRY = f'{{{BGP4_MIB_NS}}}bgpPeerEntry'
+_BGP_PEER_ADDR = f'{{{BGP4_MIB_NS}}}bgpPeerRemoteAddr'
+_BGP_PEER_STATE = f'{{{BGP4_MIB_NS}}}bgpPeerState'
+
+
+def parse_bgp_peers(nc_reply_xml):
+    """
+        Parse BGP4-MIB bgpPeerEntry elements of `<get>` reply (or) YANG-push notification as dict peer IP -> state,
+        handles any number of peers
+    """
+    if isinstance(nc_reply_xml, str):
+        nc_reply_xml = nc_reply_xml.encode()
+    root = etree.fromstring(nc_reply_xml, _NOTIFICATION_PARSER)
+
+    peers = {}
+    for entry in root.iter(_BGP_PEER_ENTRY):
+        peer_ip = entry.findtext(_BGP_PEER_ADDR)
+        state = entry.findtext(_BGP_PEER_STATE)
+        if peer_ip is not None and state is not None:
+            peers[peer_ip] = state
+
+    return peers
+
+
+def merge_config(config_snippets):
+    """
+        Merge several `<config>` snippets into one, containers with same tag (and list entries with same key leaf)
+        are merged recursively while leaves of later snippets win
+    """
+    merged = None
+    for config_snippet in config_snippets:
+        config = etree.fromstring(config_snippet.encode() if isinstance(config_snippet, str) else config_snippet,
+                                  _NOTIFICATION_PARSER)
+        if merged is None:
+            merged = config
+        else:
+            _merge_element(merged, config)
+
+    return etree.tostring(merged).decode() if merged is not None else None
+
+
+_NC_OPERATION = (f'{{{xml_.BASE_NS_1_0}}}operation', 'operation')
+
+
+def config_filter(config_snippet):
+    """
+        Subtree filter selecting exactly what `<config>` snippet touches, list entries matched by their key leaf and
+        every other leaf as selection node. Returns list of criteria, one per top level node
+    """
+    config = etree.fromstring(config_snippet.encode() if isinstance(config_snippet, str) else config_snippet,
+                              _NOTIFICATION_PARSER)
+    _strip_to_filter(config)
+
+    return [etree.tostring(child).decode() for child in config]
+
+
+def _strip_to_filter(element):
+    key_leaf = next(iter(element)) if _list_key(element) is not None else None
+    for name in _NC_OPERATION:
+        element.attrib.pop(name, None)
+
+    element.text = None
+    for child in list(element):
+        if not isinstance(child.tag, str):
+            element.remove(child)
+            continue
+        if len(child) != 0:
+            _strip_to_filter(child)
+        elif child is not key_leaf:
+            child.text = None
+        child.tail = None
+
+
+def config_delta(config_snippet, running):
+    """
+        Part of intended `<config>` snippet differing from running config (`<data>` of get-config by config_filter),
+        None when device already holds the intended values i.e. edit-config would be no-op
+
+        Unchanged subtrees are left out, while leaves of a changed container are all kept so that container needing
+        leaves together (address + mask) stays valid. Delete of node absent on device is no-op
+    """
+    config = etree.fromstring(config_snippet.encode() if isinstance(config_snippet, str) else config_snippet,
+                              _NOTIFICATION_PARSER)
+    if _delta_element(config, running) is None:
+        return None
+
+    return etree.tostring(config).decode()
+
+
+def _delta_element(intended, running):
+    # prunes intended in-place to what differs from running counterpart, None in-case nothing differs
+    changed = False
+    for child in list(intended):
+        if not isinstance(child.tag, str):
+            intended.remove(child)
+            continue
+
+        match = _find_entry(running, child)
+        operation = next((child.get(name) for name in _NC_OPERATION if name in child.attrib), None)
+
+        if operation in ('delete', 'remove'):
+            if match is None:
+                intended.remove(child)
+            else:
+                changed = True
+        elif operation not in (None, 'merge'):
+            changed = True
+        elif len(child) == 0:
+            if match is None or (match.text or '').strip() != (child.text or '').strip():
+                changed = True
+        elif _delta_element(child, match) is None:
+            intended.remove(child)
+        else:
+            changed = True
+
+    return intended if changed else None
+
+
+def config_inverse(config_snippet, running):
+    """
+        `<config>` undoing delta config snippet (config_delta) on device whose running config before the change was
+        running (`<data>` of get-config by config_filter). Changed leaves get their previous values back, nodes the
+        change created are removed and deleted (or) replaced subtrees are restored as they were
+    """
+    config = etree.fromstring(config_snippet.encode() if isinstance(config_snippet, str) else config_snippet,
+                              _NOTIFICATION_PARSER)
+    _inverse_element(config, running)
+
+    return etree.tostring(config).decode()
+
+
+def _inverse_element(changed, running):
+    # rewrites changed in-place into its inverse against running counterpart
+    key_leaf = next(iter(changed)) if _list_key(changed) is not None else None
+    for child in list(changed):
+        if not isinstance(child.tag, str):
+            changed.remove(child)
+            continue
+        if child is key_leaf:
+            continue
+
+        match = _find_entry(running, child)
+        operation = next((child.get(name) for name in _NC_OPERATION if name in child.attrib), None)
+
+        if match is None:
+            if operation in ('delete', 'remove'):
+                changed.remove(child)
+                continue
+            if len(child) != 0 and _list_key(child) is None:
+                # container may hold config the filter didn't select, only what the change created goes
+                _inverse_element(child, None)
+                continue
+            # created by the change, list entry is removed by its key
+            _strip_to_filter(child)
+            for leaf in list(child)[1 if _list_key(child) is not None else 0:]:
+                child.remove(leaf)
+            child.set(_NC_OPERATION[0], 'remove')
+        elif operation not in (None, 'merge'):
+            restored = copy.deepcopy(match)
+            restored.tail = child.tail
+            if operation not in ('delete', 'remove'):
+                restored.set(_NC_OPERATION[0], 'replace')
+            changed.replace(child, restored)
+        elif len(child) == 0:
+            child.text = match.text
+        else:
+            _inverse_element(child, match)
+
+
+def _find_entry(parent, element):
+    if parent is None:
+        return None
+    for candidate in parent.iterchildren(element.tag):
+        if _list_key(candidate) == _list_key(element):
+            return candidate
+    return None
+
+
+def _merge_element(target, source):
+    for child in list(source):
+        if not isinstance(child.tag, str):
+            # comments, processing instructions
+            continue
+
+        match = None
+        for candidate in target.iterchildren(child.tag):
+            if candidate.attrib == child.attrib and _list_key(candidate) == _list_key(child):
+                match = candidate
+                break
+
+        if match is None:
+            target.append(child)
+        elif len(child) == 0 or len(match) == 0:
+            target.replace(match, child)
+        else:
+            _merge_element(match, child)
+
+
+def _list_key(element):
+    # YANG list entries of the native models are identified by key leaf which comes first (name, id, ip..)
+    first = next(iter(element), None)
+    if first is None or len(first) != 0 or etree.QName(first).localname not in CONFIG_LIST_KEYS:
+        return None
+    return first.tag, (first.text or '').strip()